@@ -0,0 +1,70 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the registry of the backends used to compare configurations.
+
+The backends, such as the DBF reader and the exporters of ESF and water
+balance configurations, import large parts of other Lizard applications. To
+avoid that every process that imports this application pays for these
+imports, the backends are registered by name and only imported when they are
+first used.
+
+"""
+
+import logging
+import threading
+
+from django.utils.importlib import import_module
+
+logger = logging.getLogger(__name__)
+
+# Maps the name of each backend to the dotted path of the object that
+# implements it.
+BACKENDS = {
+    'dbf': 'dbfpy.dbf.Dbf',
+    'esf_configuration': 'lizard_esf.models.Configuration',
+    'esf_dbf_file': 'lizard_esf.models.DbfFile',
+    'esf_exporter': 'lizard_esf.export_dbf.DBFExporterToDict',
+    'wb_exporter': 'lizard_wbconfiguration.export_dbf.WbExporterToDict',
+    'configuration_to_validate':
+        'lizard_portal.models.ConfigurationToValidate',
+    }
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def get(name):
+    """Return the backend with the given name.
+
+    This function imports the backend the first time it is requested.
+
+    """
+    try:
+        return _loaded[name]
+    except KeyError:
+        pass
+    _lock.acquire()
+    try:
+        if name not in _loaded:
+            module_name, attr_name = BACKENDS[name].rsplit('.', 1)
+            logger.debug("load backend '%s' from module '%s'", name,
+                         module_name)
+            _loaded[name] = getattr(import_module(module_name), attr_name)
+        return _loaded[name]
+    finally:
+        _lock.release()
+
+
+def register(name, path):
+    """Register the backend with the given name at the given dotted path.
+
+    This function replaces any previously registered or loaded backend with
+    the same name.
+
+    """
+    _lock.acquire()
+    try:
+        BACKENDS[name] = path
+        _loaded.pop(name, None)
+    finally:
+        _lock.release()
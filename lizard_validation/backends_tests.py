@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import os
+import subprocess
+import sys
+
+from unittest import TestCase
+
+from lizard_validation import backends
+
+# Maximum number of seconds the import of the modules of this application may
+# take in a fresh process.
+IMPORT_BUDGET = 1.0
+
+# Modules that the import of this application should not import.
+HEAVY_MODULES = ('dbfpy', 'lizard_area', 'lizard_esf', 'lizard_portal',
+                 'lizard_wbconfiguration')
+
+IMPORT_BENCHMARK = """
+import sys
+import time
+start = time.time()
+import lizard_validation.config_comparer
+import lizard_validation.models
+import lizard_validation.validation
+import lizard_validation.views
+duration = time.time() - start
+heavy = [name for name in %r if name in sys.modules]
+sys.stdout.write('%%f %%s' %% (duration, ','.join(heavy)))
+""" % (HEAVY_MODULES,)
+
+
+def measure_import():
+    """Return the duration and the heavy modules of an import of this app.
+
+    This function imports the modules of this application in a fresh Python
+    process, so the result does not depend on the modules the current process
+    has already imported.
+
+    """
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'lizard_validation.testsettings')
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    process = subprocess.Popen([sys.executable, '-c', IMPORT_BENCHMARK],
+                               stdout=subprocess.PIPE, env=env)
+    output = process.communicate()[0]
+    duration, heavy = output.split(' ')
+    return float(duration), [name for name in heavy.split(',') if name]
+
+
+class BackendsTestSuite(TestCase):
+
+    def tearDown(self):
+        backends.BACKENDS.pop('test', None)
+        backends._loaded.pop('test', None)
+
+    def test_a(self):
+        """Test a backend is loaded on first use."""
+        backends.register('test', 'os.path.join')
+        self.assertTrue(backends.get('test') is os.path.join)
+
+    def test_b(self):
+        """Test a registered backend replaces a loaded backend."""
+        backends.register('test', 'os.path.join')
+        backends.get('test')
+        backends.register('test', 'os.path.split')
+        self.assertTrue(backends.get('test') is os.path.split)
+
+
+class ImportBenchmarkTestSuite(TestCase):
+
+    def setUp(self):
+        self.duration, self.heavy = measure_import()
+
+    def test_a(self):
+        """Test the import does not import the backends."""
+        self.assertEqual([], self.heavy)
+
+    def test_b(self):
+        """Test the import takes less than the budget."""
+        self.assertTrue(self.duration < IMPORT_BUDGET,
+                        'import took %.3fs' % self.duration)
@@ -9,33 +9,46 @@ from decimal import Decimal
 
 import logging
 
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
-from dbfpy import dbf
-
-from lizard_esf.export_dbf import DBFExporterToDict
-from lizard_esf.models import DbfFile
-from lizard_wbconfiguration.export_dbf import WbExporterToDict
+from lizard_validation.planner import iter_area_records
+from lizard_validation.sources import DbfSource
+from lizard_validation.sources import SnapshotSource
+from lizard_validation.sources import registry
+# The wrappers used to be defined in this module.
+from lizard_validation.sources import DatabaseWrapper
+from lizard_validation.sources import DbfWrapper
+from lizard_validation.sources import WaterbalanceFromDatabaseRetriever
 
 logger = logging.getLogger(__name__)
 
+# Whether the bucket and structure records of the DBFs are stored in the order
+# of their keys, in which case they are compared without sorting them.
+PRESORTED_DBFS = getattr(settings, 'LIZARD_VALIDATION_PRESORTED_DBFS', False)
+
 
 class ConfigComparer(object):
-    """Implements the functionality to compare two ESF configurations.
+    """Implements the functionality to compare two configurations.
 
-    One of the ESF configurations, the 'new' one, is retrieved from a DBF
-    file. The other ESF configuration, the 'current' one, is retrieved from the
-    Django database.
+    One of the configurations, the 'new' one, is retrieved from the source
+    with the name new_source. The other configuration, the 'current' one, is
+    retrieved from the source with the name current_source. The sources are
+    looked up in the given SourceRegistry. By default, this class compares the
+    area record of an ESF configuration in a DBF file to the area record
+    exported from the Django database.
 
-    """
-    def __init__(self):
-        tmp = AreaConfig()
-        tmp.open_database = lambda config: DbfWrapper(config.area_dbf)
-        self.get_new_attrs = tmp.as_dict
+    The record_type specifies the kind of records to compare, one of the keys
+    of RECORD_TYPES.
 
-        tmp = AreaConfig()
-        tmp.open_database = lambda config: DatabaseWrapper(config)
-        self.get_current_attrs = tmp.as_dict
+    """
+    def __init__(self, new_source='area_dbf', current_source='esf_export',
+                 record_type='area', sources=registry):
+        record_class, kwargs = RECORD_TYPES[record_type]
+        self.new_records = record_class(source=sources.get(new_source),
+                                        **kwargs)
+        self.current_records = \
+            record_class(source=sources.get(current_source), **kwargs)
 
     def compare(self, config):
         """Return the dict of differences for the given configuration.
@@ -47,9 +60,22 @@ class ConfigComparer(object):
         """
         new_attrs = self.get_new_attrs(config)
         current_attrs = self.get_current_attrs(config)
+        normalizer = self.new_records.normalizer
+        if normalizer is not None:
+            new_attrs = self.new_records.normalize(new_attrs, normalizer)
+            current_attrs = \
+                self.current_records.normalize(current_attrs, normalizer)
         return self.dict_compare(new_attrs, current_attrs)
 
     def dict_compare(self, new_attrs, current_attrs):
+        """Return the dict of differences of the given attributes.
+
+        When the attributes are records, such as buckets, each record that
+        differs is mapped to its own dict of differences. A record that is only
+        present on one side is compared to the empty record, so each of its
+        fields is reported as not present on the other side.
+
+        """
         diff = {}
         for new_attr_name, new_attr_value in new_attrs.items():
             current_attr_value = current_attrs.get(new_attr_name, _('not present'))
@@ -63,8 +89,13 @@ class ConfigComparer(object):
                     diff[new_attr_name] = \
                         (new_attr_value, current_attr_value)
         for current_attr_name, current_attr_value in current_attrs.items():
-            if current_attr_name not in new_attrs.keys():
-                diff[current_attr_name] = (_('not present'), current_attr_value)
+            if current_attr_name not in new_attrs:
+                if type(current_attr_value) == dict:
+                    diff[current_attr_name] = \
+                        self.dict_compare({}, current_attr_value)
+                else:
+                    diff[current_attr_name] = \
+                        (_('not present'), current_attr_value)
         return diff
 
     def values_differ(self, new_value, current_value):
@@ -87,215 +118,390 @@ class ConfigComparer(object):
     def get_new_attrs(self, config):
         """Return the dict of attributes of the new configuration.
 
-        The new configuration is stored in a DBF file which is specified by the
-        config parameter, which is a ConfigurationToValidate.
-
-        This method is not implemented here and should be set through
-        dependency injection.
+        The config parameter is a ConfigurationToValidate.
 
         """
-        pass
+        return self.new_records.as_dict(config)
 
     def get_current_attrs(self, config):
-        """Return the dict of attributes of the current configuration.
+        """Return the dict of attributes of the current configuration."""
+        return self.current_records.as_dict(config)
+
+
+class MissingFieldsError(Exception):
+    """Raised when a configuration lacks the fields to identify its records.
+
+    The exception specifies the configuration, the source that was opened and
+    the names of the missing fields.
+
+    """
+    def __init__(self, config, source, field_names):
+        self.config = config
+        self.source = source
+        self.field_names = field_names
+        Exception.__init__(self, "configuration for '%s' does not have the "
+                           "field(s) %s" % (config.area, ', '.join(field_names)))
+
+
+def check_fields(open_dbf, config, field_names):
+    """Raise a MissingFieldsError when open_dbf lacks one of the given fields.
+
+    This function checks the field names of the open database once, before any
+    of its records is retrieved. When the open database cannot tell its field
+    names in advance, this function does not check anything.
+
+    """
+    available_field_names = open_dbf.get_field_names()
+    if available_field_names is None:
+        return
+    missing = [name for name in field_names
+               if name not in available_field_names]
+    if missing:
+        logger.warning("configuration for '%s' does not have the field(s) %s",
+                       config.area, ', '.join(missing))
+        raise MissingFieldsError(config, open_dbf, missing)
+
+
+def get_normalizer(open_dbf):
+    """Return the Normalizer of the given open database or None.
+
+    Only an open DBF has a Normalizer, which is determined by its header.
+
+    """
+    get = getattr(open_dbf, 'get_normalizer', None)
+    if get is None:
+        return None
+    return get()
+
+
+class MergeComparer(ConfigComparer):
+    """Implements the comparison of two sequences of keyed records.
+
+    Where ConfigComparer retrieves each configuration as a dict of records,
+    this class merges the records of both configurations in the order of their
+    keys. The records of each configuration are retrieved as an iterable of
+    tuples of the record key and the dict of record attributes.
+
+    By default the comparer sorts the (key, record) tuples of each
+    configuration first, so it holds all records of both configurations in
+    memory, just like ConfigComparer, although it avoids the normalized copies
+    of all records that ConfigComparer.compare holds. Only when the records of
+    a configuration are already sorted by key, such as in a sorted DBF file,
+    and the comparer is told so, does it stream through them without holding
+    them: it then checks they are in order. For the DBFs this is the case when
+    the setting LIZARD_VALIDATION_PRESORTED_DBFS is set.
+
+    """
+    def __init__(self, **kwargs):
+        self.new_presorted = kwargs.pop('new_presorted', False)
+        self.current_presorted = kwargs.pop('current_presorted', False)
+        ConfigComparer.__init__(self, **kwargs)
+
+    def compare(self, config):
+        """Return the dict of differences for the given configuration.
+
+        The dict maps each key of a record that differs to the dict of
+        differences of that record, in the format of ConfigComparer.compare.
+
+        """
+        diff = {}
+        for change, key, record_diff in self.iter_changes(config):
+            diff[key] = record_diff
+        return diff
+
+    def iter_changes(self, config):
+        """Yield the records that differ for the given configuration.
+
+        This method yields each record that differs as a tuple of the kind of
+        change, the record key and the dict of differences of that record. The
+        kind of change is one of 'added', 'removed' and 'changed'.
 
-        The current configuration is stored in the Django database.
+        """
+        new_items = iter(self.sort(self.get_new_records(config),
+                                   self.new_presorted))
+        current_items = iter(self.sort(self.get_current_records(config),
+                                       self.current_presorted))
+        new_item = next(new_items, None)
+        current_item = next(current_items, None)
+        normalize = self.get_record_normalizer()
+        while new_item is not None or current_item is not None:
+            if current_item is None or \
+                    (new_item is not None and new_item[0] < current_item[0]):
+                key, record = new_item
+                yield 'added', key, self.dict_compare(normalize(record), {})
+                new_item = next(new_items, None)
+            elif new_item is None or current_item[0] < new_item[0]:
+                key, record = current_item
+                yield 'removed', key, self.dict_compare({}, normalize(record))
+                current_item = next(current_items, None)
+            else:
+                key = new_item[0]
+                record_diff = self.dict_compare(normalize(new_item[1]),
+                                                normalize(current_item[1]))
+                if record_diff:
+                    yield 'changed', key, record_diff
+                new_item = next(new_items, None)
+                current_item = next(current_items, None)
+
+    def get_record_normalizer(self):
+        """Return the function that normalizes a single record.
+
+        The normalizer is only known after the first new record has been
+        retrieved.
+
+        """
+        normalizer = self.new_records.normalizer
+        if normalizer is None:
+            return lambda record: record
+        return normalizer.normalize_record
 
-        This method is not implemented here and should be set through
-        dependency injection.
+    def sort(self, items, presorted):
+        """Return the given (key, record) tuples in the order of their key.
+
+        When the tuples are presorted, this method does not sort them but
+        returns a generator that raises a ValueError when a key is out of order.
+        Of the tuples with the same key only the last one is returned, just
+        like a dict of the records only keeps the last record with a key.
 
         """
-        pass
+        if presorted:
+            return collapse_duplicates(check_order(items))
+        return collapse_duplicates(sorted(items, key=lambda item: item[0]))
+
+    def get_new_records(self, config):
+        """Return the (key, record) tuples of the new configuration."""
+        return self.new_records.iter_records(config)
+
+    def get_current_records(self, config):
+        """Return the (key, record) tuples of the current configuration."""
+        return self.current_records.iter_records(config)
+
+
+def check_order(items):
+    """Yield the given (key, record) tuples and check their keys are sorted."""
+    previous_key = None
+    for index, item in enumerate(items):
+        if index > 0 and item[0] < previous_key:
+            raise ValueError("record with key '%s' follows record with key "
+                             "'%s'" % (item[0], previous_key))
+        previous_key = item[0]
+        yield item
+
+
+def collapse_duplicates(items):
+    """Yield the last of each run of sorted (key, record) tuples with the same
+    key."""
+    previous_item = None
+    for item in items:
+        if previous_item is not None and item[0] != previous_item[0]:
+            yield previous_item
+        previous_item = item
+    if previous_item is not None:
+        yield previous_item
 
 
 class AreaConfig(object):
     """Implements the retrieval of the single area record of a configuration."""
 
+    def __init__(self, **kwargs):
+        self.source = kwargs.get('source')
+        self.area_field_name = kwargs.get('area_field_name', 'GAFIDENT')
+        self.normalizer = None
+
     def as_dict(self, config):
-        """Return the area attributes of the specified configuration."""
+        """Return the area attributes of the specified configuration.
+
+        This method raises a MissingFieldsError when the configuration does not
+        have the field that specifies the area.
+
+        """
         attrs = {}
         open_dbf = self.open_database(config)
-        for record in open_dbf.get_records():
-            try:
-                if record['GAFIDENT'] == config.area.ident:
-                    attrs = record
-                    break
-            except KeyError:
-                logger.warning("area configuration file for '%s' does not have "
-                               "a GAFIDENT field", config.area)
+        try:
+            check_fields(open_dbf, config, [self.area_field_name])
+            self.normalizer = get_normalizer(open_dbf)
+            for record in iter_area_records(open_dbf, self.area_field_name,
+                                            config.area.ident):
+                attrs = record
                 break
-        open_dbf.close()
+        finally:
+            open_dbf.close()
         return attrs
 
+    def normalize(self, attrs, normalizer):
+        """Return the given area attributes normalized by the normalizer."""
+        if not attrs:
+            return attrs
+        return normalizer.normalize_record(attrs)
+
     def open_database(self, config):
         """Return an interface to the open database for the given configuration.
 
-        This method is not implemented here and should be set through
-        dependency injection.
+        This method opens the database through the source of this instance.
 
         """
-        pass
+        return self.source.open(config)
 
 
 class BucketConfig(object):
     """Implements the retrieval of bucket records of a configuration."""
 
     def __init__(self, **kwargs):
+        self.source = kwargs.get('source')
         self.area_field_name = kwargs.get('area_field_name', 'GEBIED_GW')
         self.id_field_name = kwargs.get('id_field_name', 'ID_GW')
+        self.normalizer = None
 
     def as_dict(self, config):
-        """Return the buckets and their attributes of the specified configuration."""
-        attrs = {}
-        open_dbf = self.open_database(config)
-        for record in open_dbf.get_records():
-            try:
-                if record[self.area_field_name] == config.area.ident:
-                    attrs[record[self.id_field_name]] = record
-            except KeyError:
-                logger.warning("configuration file for '%s' does not have a "
-                               "%s or %s field", config.area,
-                               self.area_field_name, self.id_field_name)
-                break
-        open_dbf.close()
-        return attrs
-
-    def open_database(self, config):
-        """Return an interface to the open database for the given configuration.
+        """Return the buckets and their attributes of the specified configuration.
 
-        This method is not implemented here and should be set through
-        dependency injection.
+        This method raises a MissingFieldsError when the configuration does not
+        have the fields that specify the area and the bucket.
 
         """
-        pass
-
-
-class DbfWrapper(object):
-    """Implements a wrapper around a single DBF file.
-
-    This class uses dbfpy to implement access to the DBF."""
+        return dict(self.iter_records(config))
 
-    def __init__(self, file_name):
-        """Open the DBF with the given name.
+    def iter_records(self, config):
+        """Yield the buckets and their attributes of the specified configuration.
 
-        This method uses dbfpy.dbf.Dbf to open the DBF. That method raises an
-        IOError when the DBGF cannot be opened, which this method reraises.
+        This method yields each bucket as a tuple of the bucket id and the dict
+        of bucket attributes, in the order in which they are stored. It raises
+        a MissingFieldsError when the configuration does not have the fields
+        that specify the area and the bucket.
 
         """
+        open_dbf = self.open_database(config)
         try:
-            self.dbf = dbf.Dbf(file_name)
-        except IOError:
-            logger.warning("configuration file '%s' cannot be opened", file_name)
-            raise
-
-    def close(self):
-        """Close the DBF."""
-        self.dbf.close()
+            check_fields(open_dbf, config,
+                         [self.area_field_name, self.id_field_name])
+            self.normalizer = get_normalizer(open_dbf)
+            for record in iter_area_records(open_dbf, self.area_field_name,
+                                            config.area.ident):
+                yield record[self.id_field_name], record
+        finally:
+            open_dbf.close()
+
+    def normalize(self, attrs, normalizer):
+        """Return the given buckets normalized by the given normalizer."""
+        keys = attrs.keys()
+        records = normalizer.normalize_records([attrs[key] for key in keys])
+        return dict(zip(keys, records))
 
-    def get_records(self):
-        """Return the records of the open DBF.
+    def open_database(self, config):
+        """Return an interface to the open database for the given configuration.
 
-        This method returns each record as a dict that maps attribute name to
-        attribute value.
+        This method opens the database through the source of this instance.
 
         """
-        for record in self.dbf:
-            yield record.asDict()
+        return self.source.open(config)
 
 
-class DatabaseWrapper(object):
-    """Implements a wrapper around the database to retrieve configurations.
+# Maps the name of each kind of records to the class that retrieves them and
+# the keyword arguments of that class.
+RECORD_TYPES = {
+    'area': (AreaConfig, {}),
+    'bucket': (BucketConfig, {}),
+    'structure': (BucketConfig, {'area_field_name': 'GEBIED',
+                                 'id_field_name': 'ID'}),
+    }
 
-    This wrapper is implemented to retrieve ESF configurations.
+# Maps the name of each comparison to the kind of records it compares, the
+# name of the source of the new records and the name of the source of the
+# current records.
+COMPARISONS = {
+    'esf_area': ('area', 'area_dbf', 'esf_export'),
+    'wb_area': ('area', 'area_dbf', 'wb_area_export'),
+    'wb_bucket': ('bucket', 'grondwatergebieden_dbf', 'wb_bucket_export'),
+    'wb_structure':
+        ('structure', 'pumpingstations_dbf', 'wb_structure_export'),
+    }
 
-    """
-    def __init__(self, config):
-        """Set the configuration to specify the records to retrieve.
 
-        The given config is a ConfigurationToValidate.
+def create_comparer(comparison, comparer_class=None, **kwargs):
+    """Return the comparer of the comparison with the given name.
 
-        """
-        self.config = config
+    By default, the records that are identified by a key, the buckets and the
+    structures, are compared by a MergeComparer and the area records by a
+    ConfigComparer. The new records of a MergeComparer, which are read from a
+    DBF, are considered sorted when PRESORTED_DBFS is set.
 
-    def close(self):
-        pass
+    The keyword arguments are passed to the constructor of the comparer and
+    can be used to replace the sources of the comparison.
 
-    def get_records(self):
-        """Return the records from the given configuration.
+    """
+    record_type, new_source, current_source = COMPARISONS[comparison]
+    if comparer_class is None:
+        if record_type == 'area':
+            comparer_class = ConfigComparer
+        else:
+            comparer_class = MergeComparer
+    if issubclass(comparer_class, MergeComparer):
+        kwargs.setdefault('new_presorted', PRESORTED_DBFS)
+    kwargs.setdefault('new_source', new_source)
+    kwargs.setdefault('current_source', current_source)
+    return comparer_class(record_type=record_type, **kwargs)
 
-        This method returns each record as a dict that maps attribute name to
-        attribute value.
+def create_wb_area_comparer():
+    return create_comparer('wb_area')
 
-        Although the configuration also specifies the area, this method
-        disregards that information and returns all records with the specified
-        (configuration) data set and type. The reason for this is that the code
-        used to retrieve the records, and which is used 'as is', only considers
-        the data set and type.
+def create_wb_bucket_comparer():
+    return create_comparer('wb_bucket')
 
-        """
-        exporter = DBFExporterToDict()
-        dbf_file = DbfFile.objects.get(name=self.config.config_type)
-        exporter.export_esf_configurations(self.config.data_set, "don't care",
-            dbf_file, "don't care")
-        return exporter.out
+def create_wb_structure_comparer():
+    return create_comparer('wb_structure')
 
-class WaterbalanceFromDatabaseRetriever(object):
-    """Implements a wrapper around the database to retrieve configurations.
+def create_wb_bucket_merge_comparer(presorted=PRESORTED_DBFS):
+    """Return the comparer that streams through the buckets of both sides.
 
-    This wrapper is implemented to retrieve water balance configurations.
+    When presorted is set, the buckets of the DBF are not sorted.
 
     """
+    return create_comparer('wb_bucket', MergeComparer, new_presorted=presorted)
 
-    def __init__(self, export_method_name, config):
-        """Specifies which configuration records should be retrieved."""
-        self.export_method_name = export_method_name
-        self.config = config
+def create_wb_structure_merge_comparer(presorted=PRESORTED_DBFS):
+    """Return the comparer that streams through the structures of both sides.
 
-    def close(self):
-        pass
+    When presorted is set, the structures of the DBF are not sorted.
 
-    def get_records(self):
-        """Return the records from the given configuration.
+    """
+    return create_comparer('wb_structure', MergeComparer,
+                           new_presorted=presorted)
 
-        This method returns each record as a dict that maps attribute name to
-        attribute value.
+def create_upload_comparer(comparison, previous_config):
+    """Return the comparer of the records of two uploaded DBFs.
 
-        Although the configuration also specifies the area, this method
-        disregards that information and returns all records with the specified
-        (configuration) data set and type. The reason for this is that the code
-        used to retrieve the records, and which is used 'as is', only considers
-        the data set and type.
+    The new records are retrieved from the DBF of the configuration passed to
+    the comparer, the current records are retrieved from the same DBF of the
+    given previous configuration. Neither of them is retrieved from the
+    database.
 
-        """
-        exporter = WbExporterToDict()
-        export = getattr(exporter, self.export_method_name)
-        export(self.config.data_set, "don't care", "don't care")
-        return exporter.out
+    """
+    record_type, new_source, current_source = COMPARISONS[comparison]
+    previous_source = DbfSource(registry.get(new_source).attr_name,
+                                previous_config)
+    kwargs = {}
+    if record_type != 'area':
+        kwargs['current_presorted'] = PRESORTED_DBFS
+    return create_comparer(comparison, current_source=previous_source,
+                           **kwargs)
+
+def create_snapshot_comparer(comparison, label='latest', directory=None):
+    """Return the comparer of a DBF and a snapshot of the database.
+
+    The new records are retrieved from the DBF as usual, the current records
+    are retrieved from the snapshot with the given label of the export of the
+    comparison instead of from the database.
 
+    """
+    record_type, new_source, current_source = COMPARISONS[comparison]
+    snapshot_source = SnapshotSource(current_source, label, directory)
+    return create_comparer(comparison, current_source=snapshot_source)
 
-def create_wb_area_comparer():
-    comparer = ConfigComparer()
-    tmp = AreaConfig()
-    tmp.open_database = lambda config: WaterbalanceFromDatabaseRetriever('export_areaconfiguration', config)
-    comparer.get_current_attrs = tmp.as_dict
-    return comparer
+def create_upload_area_comparer(previous_config):
+    return create_upload_comparer('wb_area', previous_config)
 
-def create_wb_bucket_comparer():
-    comparer = ConfigComparer()
-    tmp = BucketConfig()
-    tmp.open_database = lambda config: DbfWrapper(config.grondwatergebieden_dbf)
-    comparer.get_new_attrs = tmp.as_dict
-    tmp = BucketConfig()
-    tmp.open_database = lambda config: WaterbalanceFromDatabaseRetriever('export_bucketconfiguration', config)
-    comparer.get_current_attrs = tmp.as_dict
-    return comparer
+def create_upload_bucket_comparer(previous_config):
+    return create_upload_comparer('wb_bucket', previous_config)
 
-def create_wb_structure_comparer():
-    comparer = ConfigComparer()
-    tmp = BucketConfig(area_field_name='GEBIED', id_field_name='ID')
-    tmp.open_database = lambda config: DbfWrapper(config.pumpingstations_dbf)
-    comparer.get_new_attrs = tmp.as_dict
-    tmp = BucketConfig(area_field_name='GEBIED', id_field_name='ID')
-    tmp.open_database = lambda config: WaterbalanceFromDatabaseRetriever('export_structureconfiguration', config)
-    comparer.get_current_attrs = tmp.as_dict
-    return comparer
+def create_upload_structure_comparer(previous_config):
+    return create_upload_comparer('wb_structure', previous_config)
@@ -14,12 +14,20 @@ from unittest import TestCase
 from django.utils.translation import ugettext as _
 
 from mock import Mock
+from mock import patch
 
 from lizard_area.models import Area
 from lizard_portal.configurations_retriever import ConfigurationToValidate
 from lizard_validation.config_comparer import AreaConfig
 from lizard_validation.config_comparer import BucketConfig
 from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.config_comparer import MergeComparer
+from lizard_validation.config_comparer import MissingFieldsError
+from lizard_validation.config_comparer import create_comparer
+from lizard_validation.config_comparer import create_upload_area_comparer
+from lizard_validation.config_comparer import create_upload_bucket_comparer
+from lizard_validation.config_comparer import create_wb_bucket_merge_comparer
+from lizard_validation.sources import dbf_pool
 
 logger = logging.getLogger(__name__)
 
@@ -83,6 +91,7 @@ class AreaConfigTestSuite(TestCase):
         self.attrs_retriever = AreaConfig()
         record = {'GAFIDENT': '3201', 'DIEPTE': ' 1.17'}
         dbf = Mock()
+        dbf.get_field_names = lambda: ['GAFIDENT', 'DIEPTE']
         dbf.get_records = lambda: [record]
         self.attrs_retriever.open_database = Mock(return_value=dbf)
 
@@ -101,10 +110,11 @@ class AreaConfigTestSuite(TestCase):
         """Test the retrieval of records without a GAFIDENT field."""
         record = {'DIEPTE': ' 1.17'}
         dbf = Mock()
+        dbf.get_field_names = lambda: ['DIEPTE']
         dbf.get_records = lambda: [record]
         self.attrs_retriever.open_database = Mock(return_value=dbf)
-        attrs = self.attrs_retriever.as_dict(self.config)
-        self.assertEqual({}, attrs)
+        self.assertRaises(MissingFieldsError,
+                          self.attrs_retriever.as_dict, self.config)
 
     def test_d(self):
         """Test the records are retrieved from the right file."""
@@ -119,6 +129,19 @@ class AreaConfigTestSuite(TestCase):
         name, args, kwargs = mock_calls[-1]
         self.assertTrue('close' == name and () == args and {} == kwargs)
 
+    def test_f(self):
+        """Test the records are not retrieved when GAFIDENT is missing."""
+        dbf = Mock()
+        dbf.get_field_names = lambda: ['DIEPTE']
+        self.attrs_retriever.open_database = Mock(return_value=dbf)
+        try:
+            self.attrs_retriever.as_dict(self.config)
+            self.fail('MissingFieldsError not raised')
+        except MissingFieldsError as e:
+            self.assertEqual(['GAFIDENT'], e.field_names)
+        self.assertFalse(dbf.get_records.called)
+        self.assertTrue(dbf.close.called)
+
 
 class BucketConfigTestSuite(TestCase):
 
@@ -132,6 +155,7 @@ class BucketConfigTestSuite(TestCase):
         """Test the retrieval of a single bucket record."""
         record = {'ID_GW': '3201-DGW-1', 'GEBIED_GW': '3201', 'OPPERVL': '2171871'}
         dbf = Mock()
+        dbf.get_field_names = lambda: ['ID_GW', 'GEBIED_GW', 'OPPERVL']
         dbf.get_records = lambda: [record]
         self.attrs_retriever.open_database = Mock(return_value=dbf)
         attrs = self.attrs_retriever.as_dict(self.config)
@@ -142,12 +166,155 @@ class BucketConfigTestSuite(TestCase):
         records = [{'ID_GW': '3201-DGW-1', 'GEBIED_GW': '3201', 'OPPERVL': '2171871'},
                    {'ID_GW': '3201-DGW-2', 'GEBIED_GW': '3201', 'OPPERVL': '844617'}]
         dbf = Mock()
+        dbf.get_field_names = lambda: ['ID_GW', 'GEBIED_GW', 'OPPERVL']
         dbf.get_records = lambda: records
         self.attrs_retriever.open_database = Mock(return_value=dbf)
         attrs = self.attrs_retriever.as_dict(self.config)
         self.assertEqual({'3201-DGW-1': {'ID_GW': '3201-DGW-1', 'GEBIED_GW': '3201', 'OPPERVL': '2171871'},
                           '3201-DGW-2': {'ID_GW': '3201-DGW-2', 'GEBIED_GW': '3201', 'OPPERVL': '844617'}}, attrs)
 
+    def test_c(self):
+        """Test the retrieval of bucket records without an ID_GW field."""
+        dbf = Mock()
+        dbf.get_field_names = lambda: ['GEBIED_GW', 'OPPERVL']
+        self.attrs_retriever.open_database = Mock(return_value=dbf)
+        self.assertRaises(MissingFieldsError,
+                          self.attrs_retriever.as_dict, self.config)
+        self.assertFalse(dbf.get_records.called)
+
+
+class MergeComparerTestSuite(TestCase):
+
+    def create_comparer(self, new_records, current_records, **kwargs):
+        comparer = MergeComparer(**kwargs)
+        comparer.get_new_records = lambda c: new_records
+        comparer.get_current_records = lambda c: current_records
+        return comparer
+
+    def test_a(self):
+        """Test the detection of added, removed and changed records."""
+        new_records = [('3201-DGW-3', {'OPPERVL': 3.0}),
+                       ('3201-DGW-1', {'OPPERVL': 1.0})]
+        current_records = [('3201-DGW-2', {'OPPERVL': 2.0}),
+                           ('3201-DGW-1', {'OPPERVL': 1.5})]
+        comparer = self.create_comparer(new_records, current_records)
+        changes = list(comparer.iter_changes(ConfigurationToValidate()))
+        self.assertEqual(
+            [('changed', '3201-DGW-1', {'OPPERVL': (1.0, 1.5)}),
+             ('removed', '3201-DGW-2', {'OPPERVL': (_('not present'), 2.0)}),
+             ('added', '3201-DGW-3', {'OPPERVL': (3.0, _('not present'))})],
+            changes)
+
+    def test_b(self):
+        """Test equal records are not reported."""
+        records = [('3201-DGW-1', {'OPPERVL': 1.0})]
+        comparer = self.create_comparer(records, list(records))
+        self.assertEqual({}, comparer.compare(ConfigurationToValidate()))
+
+    def test_c(self):
+        """Test the check on the order of presorted records."""
+        new_records = [('3201-DGW-2', {}), ('3201-DGW-1', {})]
+        comparer = self.create_comparer(new_records, [], new_presorted=True)
+        self.assertRaises(ValueError, comparer.compare,
+                          ConfigurationToValidate())
+
+    def test_d(self):
+        """Test the result has the format of ConfigComparer.compare."""
+        new_records = [('3201-DGW-1', {'SURFTYPE': 0.0})]
+        current_records = [('3201-DGW-1', {'SURFTYPE': 0.1})]
+        comparer = self.create_comparer(new_records, current_records)
+        diff = comparer.compare(ConfigurationToValidate())
+        self.assertEqual({'3201-DGW-1': {'SURFTYPE': (0.0, 0.1)}}, diff)
+
+    def test_e(self):
+        """Test added and removed records are reported as ConfigComparer
+        reports them."""
+        new_records = [('3201-DGW-1', {'SURFTYPE': 0.0})]
+        current_records = [('3201-DGW-2', {'SURFTYPE': 0.1})]
+        comparer = self.create_comparer(new_records, current_records)
+        self.assertEqual(
+            ConfigComparer().dict_compare(dict(new_records),
+                                          dict(current_records)),
+            comparer.compare(ConfigurationToValidate()))
+
+    def test_f(self):
+        """Test the buckets are compared by a MergeComparer by default."""
+        self.assertTrue(isinstance(create_comparer('wb_bucket'),
+                                   MergeComparer))
+        self.assertFalse(isinstance(create_comparer('wb_area'),
+                                    MergeComparer))
+
+    def test_g(self):
+        """Test the merge comparer can be told the DBF is sorted."""
+        comparer = create_wb_bucket_merge_comparer(presorted=True)
+        self.assertEqual((True, False), (comparer.new_presorted,
+                                         comparer.current_presorted))
+
+    def test_h(self):
+        """Test only the last record with the same key is compared, as
+        ConfigComparer does."""
+        new_records = [('A', {'X': 1}), ('A', {'X': 2})]
+        current_records = [('A', {'X': 2})]
+        for presorted in (False, True):
+            comparer = self.create_comparer(new_records, current_records,
+                                            new_presorted=presorted)
+            self.assertEqual(
+                ConfigComparer().dict_compare(dict(new_records),
+                                              dict(current_records)),
+                comparer.compare(ConfigurationToValidate()))
+            self.assertEqual({}, comparer.compare(ConfigurationToValidate()))
+
+
+class UploadComparerTestSuite(TestCase):
+
+    def setUp(self):
+        self.config = ConfigurationToValidate()
+        self.config.area = Area()
+        self.config.area.ident = '3201'
+        self.config.area_dbf = 'new_aanafvoer.dbf'
+        self.config.grondwatergebieden_dbf = 'new_grondwatergebieden.dbf'
+        self.previous_config = ConfigurationToValidate()
+        self.previous_config.area_dbf = 'old_aanafvoer.dbf'
+        self.previous_config.grondwatergebieden_dbf = 'old_grondwatergebieden.dbf'
+        self.records = {
+            'new_aanafvoer.dbf': [{'GAFIDENT': '3201', 'DIEPTE': 1.17}],
+            'old_aanafvoer.dbf': [{'GAFIDENT': '3201', 'DIEPTE': 1.18}],
+            'new_grondwatergebieden.dbf':
+                [{'ID_GW': '3201-DGW-1', 'GEBIED_GW': '3201', 'OPPERVL': 2.0}],
+            'old_grondwatergebieden.dbf':
+                [{'ID_GW': '3201-DGW-1', 'GEBIED_GW': '3201', 'OPPERVL': 3.0}],
+            }
+        dbf_pool.clear()
+
+    def tearDown(self):
+        dbf_pool.clear()
+
+    def open_dbf(self, file_name):
+        dbf = Mock()
+        records = self.records[file_name]
+        dbf.get_field_names = lambda: records[0].keys()
+        dbf.get_record_count = lambda: len(records)
+        dbf.get_record = lambda index: records[index]
+        dbf.get_field_types = lambda: []
+        dbf.get_language_driver_id = lambda: 0x57
+        return dbf
+
+    def test_a(self):
+        """Test the area records of both uploads are compared."""
+        with patch('lizard_validation.sources.DbfWrapper',
+                   self.open_dbf):
+            comparer = create_upload_area_comparer(self.previous_config)
+            diff = comparer.compare(self.config)
+        self.assertEqual({'DIEPTE': (1.17, 1.18)}, diff)
+
+    def test_b(self):
+        """Test the bucket records of both uploads are compared."""
+        with patch('lizard_validation.sources.DbfWrapper',
+                   self.open_dbf):
+            comparer = create_upload_bucket_comparer(self.previous_config)
+            diff = comparer.compare(self.config)
+        self.assertEqual({'3201-DGW-1': {'OPPERVL': (2.0, 3.0)}}, diff)
+
 
 class dict_compare_TestSuite(TestCase):
 
@@ -201,6 +368,18 @@ class dict_compare_TestSuite(TestCase):
         self.assertEqual({'3201-DGW-1': {'SURFTYPE': (0.0, _('not present'))},
                           '3201-DGW-2': {'SURFTYPE': (0.0, _('not present'))}}, diff)
 
+    def test_e(self):
+        """Test the comparison of a simple dict of dict.
+
+        The bucket is only present in the current configuration.
+
+        """
+        comparer = ConfigComparer()
+        d = {}
+        e = {'3201-DGW-1': {'SURFTYPE': 0.0}}
+        diff = comparer.dict_compare(d, e)
+        self.assertEqual({'3201-DGW-1': {'SURFTYPE': (_('not present'), 0.0)}}, diff)
+
 def test_a():
     """Test that a float differs from a decimal.Decimal."""
     f = 3.14
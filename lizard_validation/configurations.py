@@ -0,0 +1,78 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+from lizard_validation import backends
+from lizard_validation import versions
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds a resolved ConfigurationToValidate remains cached.
+CACHE_TIMEOUT = getattr(settings, 'LIZARD_VALIDATION_CONFIG_CACHE_TIMEOUT', 60)
+
+# Application label and name of each model whose changes make the cached
+# configurations obsolete.
+WATCHED_MODELS = (('lizard_area', 'Area'),
+                  ('lizard_portal', 'ConfigurationToValidate'))
+
+
+def get_configuration(area_name, config_type):
+    """Return the ConfigurationToValidate for the given area and type.
+
+    This function retrieves the configuration together with its area in a
+    single query and caches the result for CACHE_TIMEOUT seconds. It raises
+    Http404 when the configuration does not exist.
+
+    """
+    key = cache_key(area_name, config_type)
+    config = cache.get(key)
+    if config is None:
+        ConfigurationToValidate = backends.get('configuration_to_validate')
+        logger.debug("retrieve ConfigurationToValidate of type '%s' for Area "
+                     "with name '%s'", config_type, area_name)
+        try:
+            config = ConfigurationToValidate.objects.select_related(
+                'area', 'data_set').get(area__name=area_name,
+                                        config_type=config_type)
+        except ConfigurationToValidate.DoesNotExist:
+            raise Http404
+        cache.set(key, config, CACHE_TIMEOUT)
+    return config
+
+
+def cache_key(area_name, config_type):
+    """Return the cache key of the given area and type.
+
+    The key contains the current generation of the cache so each
+    invalidation, which bumps the generation, makes all existing keys
+    obsolete. The generation is a version counter, see versions, so it does
+    not return to an earlier value when it is evicted from the cache.
+
+    """
+    generation = versions.get('configurations')
+    digest = hashlib.md5(('%s|%s' % (area_name, config_type)).encode('utf-8'))
+    return 'lizard_validation.configurations.%s.%s' % (generation,
+                                                      digest.hexdigest())
+
+
+def invalidate(sender=None, **kwargs):
+    """Make all cached configurations obsolete."""
+    versions.bump('configurations')
+
+
+def record_change(sender, **kwargs):
+    """Make all cached configurations obsolete when one of the WATCHED_MODELS
+    is changed.
+
+    This function can be connected to the signals that are sent when any model
+    is saved or deleted. It ignores the models that are not watched, so the
+    models it watches do not have to be imported to connect it.
+
+    """
+    if (sender._meta.app_label, sender._meta.object_name) in WATCHED_MODELS:
+        invalidate()
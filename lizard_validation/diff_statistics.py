@@ -0,0 +1,107 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the statistics of the differences of many configurations.
+
+The statistics are computed in a single pass over the configurations: the
+differences of each configuration are added to a DiffStatistics and then
+discarded.
+
+"""
+
+import logging
+
+from django.utils.translation import ugettext as _
+
+from lizard_validation import backends
+from lizard_validation.revalidation import get_result
+
+logger = logging.getLogger(__name__)
+
+
+class DiffStatistics(object):
+    """Implements the counts of the differences of configurations."""
+
+    def __init__(self):
+        self.configurations = 0
+        self.differing = 0
+        self.failed = []
+        self.areas = {}
+        self.fields = {}
+        self.records = {}
+
+    def add(self, area_name, config_type, result):
+        """Add the given result of validation.validate to the counts."""
+        self.configurations += 1
+        differences = 0
+        for part, diff in result.items():
+            if part == 'area':
+                differences += self.add_record_diff(diff)
+            else:
+                counts = self.records.setdefault(
+                    part, {'added': 0, 'removed': 0, 'changed': 0})
+                for record_diff in diff.values():
+                    counts[classify(record_diff)] += 1
+                    differences += self.add_record_diff(record_diff)
+        if differences:
+            self.differing += 1
+            self.areas['%s/%s' % (area_name, config_type)] = differences
+
+    def add_record_diff(self, record_diff):
+        for field_name in record_diff.keys():
+            self.fields[field_name] = self.fields.get(field_name, 0) + 1
+        return len(record_diff)
+
+    def add_failure(self, area_name, config_type, error):
+        self.configurations += 1
+        self.failed.append({'area': area_name, 'type': config_type,
+                            'error': u'%s' % (error,)})
+
+    def as_dict(self):
+        return {'configurations': self.configurations,
+                'differing': self.differing,
+                'failed': self.failed,
+                'areas': self.areas,
+                'fields': self.fields,
+                'records': self.records}
+
+
+def classify(record_diff):
+    """Return the kind of change of a record from its differences.
+
+    A record is 'added' when none of its fields is present in the current
+    configuration, 'removed' when none of its fields is present in the new
+    configuration and 'changed' otherwise.
+
+    """
+    not_present = _('not present')
+    values = record_diff.values()
+    if values and all(current == not_present for new, current in values):
+        return 'added'
+    if values and all(new == not_present for new, current in values):
+        return 'removed'
+    return 'changed'
+
+
+def compute_statistics(config_type=None):
+    """Return the DiffStatistics of all configurations to validate.
+
+    When a configuration type is given, only the configurations of that type
+    are taken into account.
+
+    """
+    ConfigurationToValidate = backends.get('configuration_to_validate')
+    configs = ConfigurationToValidate.objects.select_related('area', 'data_set')
+    if config_type is not None:
+        configs = configs.filter(config_type=config_type)
+    statistics = DiffStatistics()
+    # Order the configurations by data set so the cached exports of a data
+    # set are reused by all its areas.
+    for config in configs.order_by('data_set', 'area__name').iterator():
+        try:
+            statistics.add(config.area.name, config.config_type,
+                           get_result(config))
+        except Exception as e:
+            logger.exception("unable to validate '%s' configuration of '%s'",
+                             config.config_type, config.area.name)
+            statistics.add_failure(config.area.name, config.config_type, e)
+    return statistics
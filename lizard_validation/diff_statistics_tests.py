@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from unittest import TestCase
+
+from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.diff_statistics import DiffStatistics
+
+
+class DiffStatisticsTestSuite(TestCase):
+
+    def setUp(self):
+        comparer = ConfigComparer()
+        self.statistics = DiffStatistics()
+        self.statistics.add('Aetsveldse polder Oost', 'waterbalans', {
+            'area': comparer.dict_compare({'DIEPTE': 1.17}, {'DIEPTE': 1.18}),
+            'buckets': comparer.dict_compare(
+                {'3201-DGW-1': {'OPPERVL': 2.0},
+                 '3201-DGW-2': {'OPPERVL': 2.0, 'SURFTYPE': 0}},
+                {'3201-DGW-1': {'OPPERVL': 3.0}}),
+            'structures': comparer.dict_compare(
+                {}, {'3201-PS-1': {'CAPACITEIT': 0.5}})})
+        self.statistics.add('Horstermeer', 'waterbalans',
+                            {'area': {}, 'buckets': {}, 'structures': {}})
+
+    def test_a(self):
+        """Test the number of configurations that differ."""
+        self.assertEqual((2, 1), (self.statistics.configurations,
+                                  self.statistics.differing))
+
+    def test_b(self):
+        """Test the number of differences per area."""
+        self.assertEqual({'Aetsveldse polder Oost/waterbalans': 5},
+                         self.statistics.areas)
+
+    def test_c(self):
+        """Test the number of differences per field."""
+        self.assertEqual({'DIEPTE': 1, 'OPPERVL': 2, 'SURFTYPE': 1,
+                          'CAPACITEIT': 1}, self.statistics.fields)
+
+    def test_d(self):
+        """Test the number of added, removed and changed records."""
+        self.assertEqual(
+            {'buckets': {'added': 1, 'removed': 0, 'changed': 1},
+             'structures': {'added': 0, 'removed': 1, 'changed': 0}},
+            self.statistics.records)
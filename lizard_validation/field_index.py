@@ -0,0 +1,104 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the index of the records whose value of a field differs.
+
+To answer which areas have a changed value of a field, for example DIEPTE,
+one would have to compute the differences of all configurations. Instead,
+revalidation.get_result caches the changed fields of each part it computes:
+a dict that maps each changed field to the keys of the records that differ
+in that field. Together these entries form an inverted index from field name
+to records.
+
+An entry belongs to the differences it was computed from: it holds the cache
+key of those differences. When the differences become obsolete, for example
+because the configuration has been changed in the database, the entry is
+obsolete too. A query skips obsolete and missing entries and reports their
+configurations as not indexed. The next computation of their differences
+brings the index up to date.
+
+A query takes a single database query to retrieve the configurations and two
+cache requests to retrieve the version counters and the entries.
+
+"""
+
+from django.core.cache import cache
+
+from lizard_validation import backends
+from lizard_validation import versions
+from lizard_validation.revalidation import fields_key
+from lizard_validation.revalidation import get_version_names
+from lizard_validation.revalidation import result_key
+from lizard_validation.validation import get_parts
+
+
+class FieldDifferences(object):
+    """Implements the answer to a query of the field index.
+
+    Attribute records is the sorted list of (area name, configuration type,
+    part, record key) of the records that differ in the field. Attribute
+    unindexed is the sorted list of (area name, configuration type) of the
+    configurations whose differences are not in the index.
+
+    """
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.records = []
+        self.unindexed = []
+
+    def as_dict(self):
+        return {'field': self.field_name,
+                'records': [{'area': area_name, 'type': config_type,
+                             'part': part, 'key': key}
+                            for area_name, config_type, part, key
+                            in self.records],
+                'unindexed': [{'area': area_name, 'type': config_type}
+                              for area_name, config_type in self.unindexed]}
+
+
+def find_differences(field_name, config_type=None, data_set=None):
+    """Return the FieldDifferences of the given field.
+
+    When a configuration type or the name of a data set is given, only the
+    configurations of that type or data set are taken into account.
+
+    """
+    ConfigurationToValidate = backends.get('configuration_to_validate')
+    configs = ConfigurationToValidate.objects.select_related('area', 'data_set')
+    if config_type is not None:
+        configs = configs.filter(config_type=config_type)
+    if data_set is not None:
+        configs = configs.filter(data_set__name=data_set)
+    config_parts = [(config, part) for config in configs
+                    for part in get_parts(config)]
+    return search(field_name, config_parts)
+
+
+def search(field_name, config_parts):
+    """Return the FieldDifferences of the given field in the given parts.
+
+    The parts are given as a list of (ConfigurationToValidate, part).
+
+    """
+    version_names = [get_version_names(config, part)
+                     for config, part in config_parts]
+    counters = versions.get_many([names for part_names in version_names
+                                  for names in part_names])
+    entries = cache.get_many([fields_key(config, part)
+                              for config, part in config_parts])
+    differences = FieldDifferences(field_name)
+    unindexed = set()
+    offset = 0
+    for (config, part), part_names in zip(config_parts, version_names):
+        part_counters = counters[offset:offset + len(part_names)]
+        offset += len(part_names)
+        entry = entries.get(fields_key(config, part))
+        if entry is None or None in part_counters or \
+                entry[0] != result_key(config, part, part_counters):
+            unindexed.add((config.area.name, config.config_type))
+            continue
+        for key in entry[1].get(field_name, []):
+            differences.records.append(
+                (config.area.name, config.config_type, part, key))
+    differences.records.sort()
+    differences.unindexed = sorted(unindexed)
+    return differences
@@ -0,0 +1,125 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the measurement of the stages of a validation.
+
+A validation, for example the computation of a diff page, is divided into
+stages such as the retrieval of the configuration and the comparison of the
+bucket records. The functions in this module record the wall time of each
+stage, the number of times an expensive operation, such as the opening of
+a DBF file, is performed and the plans chosen to retrieve the records.
+
+The measurements are kept per thread. When no measurement has been started,
+the functions in this module do not record anything.
+
+"""
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Instrumentation(object):
+    """Implements the record of the measurements of a single validation."""
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = {}
+        self.counters = {}
+        self.plans = []
+
+    def add_timing(self, stage_name, seconds):
+        self.timings[stage_name] = self.timings.get(stage_name, 0.0) + seconds
+
+    def add_count(self, counter_name, count):
+        self.counters[counter_name] = \
+            self.counters.get(counter_name, 0) + count
+
+    def add_maximum(self, counter_name, value):
+        self.counters[counter_name] = \
+            max(self.counters.get(counter_name, value), value)
+
+    def add_plan(self, description):
+        self.plans.append(description)
+
+    def summary(self):
+        """Return the single-line, human-readable summary of the measurements."""
+        timings = ', '.join('%s %.3fs' % (stage_name, seconds)
+                            for stage_name, seconds
+                            in sorted(self.timings.items()))
+        counters = ', '.join('%s %d' % (counter_name, count)
+                             for counter_name, count
+                             in sorted(self.counters.items()))
+        summary = '%s: %s; %s' % (self.name, timings, counters)
+        if self.plans:
+            summary += '; plans: %s' % ', '.join(self.plans)
+        return summary
+
+
+def begin(name):
+    """Start and return the measurement of the validation with the given name."""
+    _local.current = Instrumentation(name)
+    return _local.current
+
+
+def end():
+    """Stop and return the current measurement.
+
+    This function logs the summary of the measurement and keeps it available
+    through last() until the next measurement is started.
+
+    """
+    instrumentation = current()
+    if instrumentation is not None:
+        logger.debug(instrumentation.summary())
+    _local.current = None
+    _local.last = instrumentation
+    return instrumentation
+
+
+def current():
+    """Return the current measurement or None when there is none."""
+    return getattr(_local, 'current', None)
+
+
+def last():
+    """Return the most recently stopped measurement or None when there is none."""
+    return getattr(_local, 'last', None)
+
+
+@contextmanager
+def stage(stage_name):
+    """Record the wall time of the with-block as the given stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        instrumentation = current()
+        if instrumentation is not None:
+            instrumentation.add_timing(stage_name, time.time() - start)
+
+
+def count(counter_name, count=1):
+    """Add the given count to the counter with the given name."""
+    instrumentation = current()
+    if instrumentation is not None:
+        instrumentation.add_count(counter_name, count)
+
+
+def maximum(counter_name, value):
+    """Set the counter with the given name to the given value if it is larger."""
+    instrumentation = current()
+    if instrumentation is not None:
+        instrumentation.add_maximum(counter_name, value)
+
+
+def plan(description):
+    """Record the given description of a chosen retrieval plan."""
+    instrumentation = current()
+    if instrumentation is not None:
+        instrumentation.add_plan(description)
@@ -0,0 +1,215 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Computes the differences of configurations in the background.
+
+A diff page reads DBF files, runs the exporters and queries the database,
+which can take long enough to tie up the web server process that serves it.
+The asynchronous diff view submits the computation as a job to a small, fixed
+pool of worker threads and returns immediately with the id of the job. The
+client polls the job until it is done.
+
+The state of each job is stored in the Django cache, so the process that
+reports the state of a job does not have to be the process that runs it. This
+requires a cache backend that is shared by all processes of the web server,
+such as memcached: the local-memory cache is private to each process, so with
+more than one process the poll of a job can end up in a process that has
+never heard of it. At most one job per area and configuration type is pending
+at a time: a second submission returns the id of the pending job.
+
+A cache silently drops a value it cannot store, for example a value larger
+than the maximum item size of memcached. The state of a job that is larger
+than MAX_STATE_SIZE, or that cannot be read back after it has been stored, is
+replaced by the state FAILED, so the client does not poll the job until it
+times out.
+
+"""
+
+import hashlib
+import logging
+import threading
+import uuid
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue_module
+except ImportError:
+    import queue as queue_module
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+from lizard_validation import instrumentation
+from lizard_validation.config_comparer import MissingFieldsError
+from lizard_validation.configurations import get_configuration
+from lizard_validation.revalidation import get_result
+
+logger = logging.getLogger(__name__)
+
+# Number of worker threads that compute the differences in the background.
+WORKERS = getattr(settings, 'LIZARD_VALIDATION_ASYNC_WORKERS', 2)
+
+# Maximum number of jobs that wait for a worker thread.
+QUEUE_SIZE = getattr(settings, 'LIZARD_VALIDATION_ASYNC_QUEUE_SIZE', 32)
+
+# Number of seconds the state of a job remains cached.
+JOB_TIMEOUT = getattr(settings, 'LIZARD_VALIDATION_JOB_TIMEOUT', 60 * 60)
+
+# Maximum number of bytes of the pickled state of a job, which should not
+# exceed the maximum item size of the cache backend. The default leaves room
+# below the 1 MB limit of memcached for the key and the overhead of an item.
+MAX_STATE_SIZE = getattr(settings, 'LIZARD_VALIDATION_MAX_JOB_STATE_SIZE',
+                         1000 * 1000)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue of jobs is full."""
+
+
+def job_key(job_id):
+    """Return the cache key of the state of the given job."""
+    return 'lizard_validation.jobs.%s' % job_id
+
+
+def pending_key(area_name, config_type):
+    """Return the cache key of the pending job of the given configuration."""
+    digest = hashlib.md5(('%s|%s' % (area_name, config_type)).encode('utf-8'))
+    return 'lizard_validation.jobs.pending.%s' % digest.hexdigest()
+
+
+def get_job(job_id):
+    """Return the state of the given job or None when it is unknown.
+
+    The state is a dict with at least the keys 'status', 'name' and 'type'.
+    When the status is DONE, the dict contains either the key 'result', the
+    differences as returned by revalidation.get_result, or the key
+    'missing_fields'. When the status is FAILED, it contains the key 'error'.
+
+    """
+    return cache.get(job_key(job_id))
+
+
+class JobQueue(object):
+    """Implements a fixed pool of worker threads that run diff jobs.
+
+    The worker threads are started when the first job is submitted.
+
+    """
+    def __init__(self, workers=None, size=None):
+        self.workers = WORKERS if workers is None else workers
+        self.queue = queue_module.Queue(QUEUE_SIZE if size is None else size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, area_name, config_type):
+        """Return the id of the job that computes the given differences.
+
+        This method raises QueueFull when the job cannot be queued.
+
+        """
+        job_id = uuid.uuid4().hex
+        key = pending_key(area_name, config_type)
+        if not cache.add(key, job_id, JOB_TIMEOUT):
+            pending_id = cache.get(key)
+            job = get_job(pending_id)
+            if job is not None and job['status'] == PENDING:
+                return pending_id
+            cache.set(key, job_id, JOB_TIMEOUT)
+        self.set_state(job_id, area_name, config_type, status=PENDING)
+        self.start()
+        try:
+            self.queue.put((job_id, area_name, config_type), block=False)
+        except queue_module.Full:
+            cache.delete(key)
+            cache.delete(job_key(job_id))
+            raise QueueFull()
+        return job_id
+
+    def start(self):
+        """Start the worker threads if they have not been started yet."""
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work,
+                                          name='lizard_validation.jobs')
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        """Run the jobs from the queue, one at a time."""
+        while True:
+            job_id, area_name, config_type = self.queue.get()
+            try:
+                self.run(job_id, area_name, config_type)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job_id, area_name, config_type):
+        """Compute the differences of the given job and store them."""
+        from django.db import connection
+        instrumentation.begin('job %s %s' % (area_name, config_type))
+        try:
+            config = get_configuration(area_name, config_type)
+            result = get_result(config)
+        except Http404:
+            self.set_state(job_id, area_name, config_type, status=FAILED,
+                           error='configuration not found')
+        except MissingFieldsError as e:
+            self.set_state(job_id, area_name, config_type, status=DONE,
+                           missing_fields=e.field_names)
+        except Exception as e:
+            logger.exception("job %s for '%s' (%s) failed", job_id,
+                             area_name, config_type)
+            self.set_state(job_id, area_name, config_type, status=FAILED,
+                           error=unicode(e))
+        else:
+            self.set_state(job_id, area_name, config_type, status=DONE,
+                           result=result)
+        finally:
+            cache.delete(pending_key(area_name, config_type))
+            instrumentation.end()
+            # Each worker thread has its own database connection, which it
+            # should close when it is done with it.
+            connection.close()
+
+    def set_state(self, job_id, area_name, config_type, **state):
+        """Store the given state of the given job.
+
+        A state that is too large to store or that the cache drops is
+        replaced by the state FAILED.
+
+        """
+        key = job_key(job_id)
+        state.update(name=area_name, type=config_type)
+        size = len(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        if size > MAX_STATE_SIZE:
+            logger.error("state of job %s for '%s' (%s) takes %d bytes, "
+                         "which exceeds the limit of %d bytes", job_id,
+                         area_name, config_type, size, MAX_STATE_SIZE)
+            state = dict(status=FAILED, name=area_name, type=config_type,
+                         error='the differences are too large to store')
+        cache.set(key, state, JOB_TIMEOUT)
+        # The cache may keep the previous state when it drops the new one.
+        stored = cache.get(key)
+        if stored is None or stored['status'] != state['status']:
+            logger.error("unable to store the state of job %s for '%s' (%s)",
+                         job_id, area_name, config_type)
+            cache.set(key, dict(status=FAILED, name=area_name,
+                                type=config_type,
+                                error='unable to store the state of the job'),
+                      JOB_TIMEOUT)
+
+    def join(self):
+        """Block until all queued jobs have been run."""
+        self.queue.join()
+
+
+queue = JobQueue()
@@ -0,0 +1,284 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the load test of the diff pages.
+
+The console script load_test_diff_views replays a sequence of requests of diff
+pages against a running server, for example the development server with the
+fixture DBFs and a local database, and issues several requests at the same
+time to simulate concurrent reviewers. It writes the latency percentiles, the
+throughput and the mean number of queries of each configuration type to
+standard output.
+
+The sequence of requests is either recorded, for example in the access log of
+the web server, or generated from the given areas and configuration types.
+When neither is given, the script generates the requests from the
+configurations in the database, for which it needs the Django settings.
+
+The server reports the number of queries of a diff page in the response
+header X-Query-Count, but only when its setting DEBUG is True.
+
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+from optparse import OptionParser
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib2 import HTTPError
+    from urllib2 import urlopen
+    from urllib import quote
+    from urllib import unquote
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    from urllib.parse import quote
+    from urllib.parse import unquote
+
+PERCENTILES = (50, 95, 99)
+
+# Matches the path of a diff page in a line of an access log.
+DIFF_PATH = re.compile(r'(/diff/[^\s"?]+)')
+
+
+def main(argv=None):
+    """Run the load test as specified by the given command-line arguments.
+
+    This function returns 0 when all requests succeeded and 1 otherwise.
+
+    """
+    options, args = parse_args(argv)
+    if options.settings:
+        os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+
+    if options.requests:
+        with open(options.requests) as recording:
+            paths = read_paths(recording)
+    else:
+        if options.area_names and options.config_types:
+            pairs = [(area_name, config_type)
+                     for area_name in options.area_names
+                     for config_type in options.config_types]
+        else:
+            from lizard_validation.scripts import get_configurations
+            pairs = [(config.area.name, config.config_type) for config in
+                     get_configurations(options.area_names,
+                                        options.config_types)]
+        paths = generate_paths(pairs, options.number, options.seed)
+    if not paths:
+        sys.stderr.write('no requests to replay\n')
+        return 1
+
+    samples, duration = replay(paths, options.base_url, options.concurrency,
+                               options.timeout)
+    write_report(samples, duration, sys.stdout)
+    if [sample for sample in samples if sample.failed]:
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = OptionParser(
+        usage='%prog [options]',
+        description='Replay requests of diff pages against a running server '
+        'and report their latency, throughput and number of queries.')
+    parser.add_option('--settings', dest='settings',
+                      help='the Django settings module to use to generate '
+                      'the requests from the configurations in the database')
+    parser.add_option('-u', '--base-url', dest='base_url',
+                      default='http://localhost:8000/',
+                      help='the URL the paths of the diff pages are relative '
+                      'to, by default %default')
+    parser.add_option('-r', '--requests', dest='requests', metavar='FILE',
+                      help='replay the paths of the diff pages in the given '
+                      'file, for example an access log, in the order they '
+                      'appear')
+    parser.add_option('-a', '--area', dest='area_names', action='append',
+                      default=[], metavar='NAME',
+                      help='generate requests for the area with the given '
+                      'name, which can be repeated')
+    parser.add_option('-t', '--type', dest='config_types', action='append',
+                      default=[], metavar='TYPE',
+                      help='generate requests for the given configuration '
+                      'type, which can be repeated')
+    parser.add_option('-n', '--number', dest='number', type='int',
+                      default=100,
+                      help='the number of requests to generate, by default '
+                      '%default')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=10,
+                      help='the number of requests to issue at the same time, '
+                      'by default %default')
+    parser.add_option('--seed', dest='seed', type='int',
+                      help='the seed of the generated sequence of requests')
+    parser.add_option('--timeout', dest='timeout', type='float', default=60.0,
+                      help='the number of seconds to wait for a response, by '
+                      'default %default')
+    options, args = parser.parse_args(argv)
+    if options.concurrency < 1:
+        parser.error('the concurrency should be at least 1')
+    if options.number < 1:
+        parser.error('the number of requests should be at least 1')
+    return options, args
+
+
+def read_paths(lines):
+    """Return the paths of the diff pages in the given lines."""
+    paths = []
+    for line in lines:
+        match = DIFF_PATH.search(line)
+        if match:
+            paths.append(match.group(1))
+    return paths
+
+
+def generate_paths(pairs, number, seed=None):
+    """Return the given number of paths of diff pages in random order.
+
+    Each path is the path of the diff page of one of the given pairs of area
+    name and configuration type.
+
+    """
+    if not pairs:
+        return []
+    chooser = random.Random(seed)
+    paths = []
+    for index in range(number):
+        area_name, config_type = chooser.choice(pairs)
+        paths.append(diff_path(area_name, config_type))
+    return paths
+
+
+def diff_path(area_name, config_type):
+    if isinstance(area_name, unicode):
+        area_name = area_name.encode('utf-8')
+    return '/diff/%s/%s' % (quote(area_name), quote(config_type))
+
+
+def get_config_type(path):
+    """Return the configuration type of the given path of a diff page."""
+    return unquote(path.rstrip('/').rsplit('/', 1)[-1])
+
+
+class Sample(object):
+    """Implements the measurement of a single request."""
+
+    def __init__(self, path, status, seconds, query_count=None):
+        self.path = path
+        self.config_type = get_config_type(path)
+        self.status = status
+        self.seconds = seconds
+        self.query_count = query_count
+
+    @property
+    def failed(self):
+        return self.status is None or self.status >= 400
+
+
+def fetch(url, path, timeout=60.0, opener=urlopen):
+    """Return the Sample of the request of the given path."""
+    start = time.time()
+    try:
+        response = opener(url.rstrip('/') + path, timeout=timeout)
+        try:
+            response.read()
+        finally:
+            response.close()
+        status = response.getcode()
+        headers = response.info()
+    except HTTPError as e:
+        status = e.code
+        headers = e.info()
+    except Exception as e:
+        sys.stderr.write('request of %s failed: %s\n' % (path, e))
+        return Sample(path, None, time.time() - start)
+    seconds = time.time() - start
+    query_count = headers.get('X-Query-Count')
+    if query_count is not None:
+        query_count = int(query_count)
+    return Sample(path, status, seconds, query_count)
+
+
+def replay(paths, url, concurrency=10, timeout=60.0, opener=urlopen):
+    """Return the Samples of the given paths and the total duration.
+
+    This function issues the given number of requests at the same time.
+
+    """
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    try:
+        samples = pool.map(
+            lambda path: fetch(url, path, timeout, opener), paths)
+    finally:
+        pool.close()
+        pool.join()
+    return samples, time.time() - start
+
+
+def percentile(values, percent):
+    """Return the given percentile of the given values.
+
+    This function uses the nearest-rank method and returns None when there
+    are no values.
+
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(-(-percent * len(ordered) // 100))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(samples, duration):
+    """Return the statistics of the given samples as a dict.
+
+    The dict contains the number of requests, the number of failed requests,
+    the latency percentiles in seconds, the number of requests per second and
+    the mean number of queries, which is None when the server did not report
+    it.
+
+    """
+    seconds = [sample.seconds for sample in samples if not sample.failed]
+    query_counts = [sample.query_count for sample in samples
+                    if sample.query_count is not None]
+    summary = {
+        'requests': len(samples),
+        'failed': len(samples) - len(seconds),
+        'throughput': len(samples) / duration if duration > 0 else 0.0,
+        'queries': None,
+        }
+    if query_counts:
+        summary['queries'] = float(sum(query_counts)) / len(query_counts)
+    for percent in PERCENTILES:
+        summary['p%d' % percent] = percentile(seconds, percent)
+    return summary
+
+
+def format_summary(name, summary):
+    parts = ['%s: %d request(s), %d failed' %
+             (name, summary['requests'], summary['failed'])]
+    for percent in PERCENTILES:
+        value = summary['p%d' % percent]
+        if value is not None:
+            parts.append('p%d %.3fs' % (percent, value))
+    parts.append('%.1f per second' % summary['throughput'])
+    if summary['queries'] is not None:
+        parts.append('%.1f queries' % summary['queries'])
+    return ', '.join(parts)
+
+
+def write_report(samples, duration, stream):
+    """Write the statistics of each configuration type and of all samples."""
+    config_types = sorted(set(sample.config_type for sample in samples))
+    for config_type in config_types:
+        selection = [sample for sample in samples
+                     if sample.config_type == config_type]
+        stream.write(format_summary(config_type,
+                                    summarize(selection, duration)) + '\n')
+    stream.write(format_summary('total', summarize(samples, duration)) + '\n')
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from mock import Mock
+
+from lizard_validation.loadtest import Sample
+from lizard_validation.loadtest import generate_paths
+from lizard_validation.loadtest import percentile
+from lizard_validation.loadtest import read_paths
+from lizard_validation.loadtest import replay
+from lizard_validation.loadtest import summarize
+from lizard_validation.loadtest import write_report
+
+
+def create_opener(query_count):
+    def opener(url, timeout):
+        response = Mock()
+        response.getcode.return_value = 200
+        response.info.return_value = {'X-Query-Count': str(query_count)}
+        opener.urls.append(url)
+        return response
+    opener.urls = []
+    return opener
+
+
+class PathsTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the paths of the diff pages are read from an access log."""
+        lines = ['127.0.0.1 - - [09/May/2012] "GET /diff/3201/esf1 HTTP/1.1" 200',
+                 '127.0.0.1 - - [09/May/2012] "GET /static/x.css HTTP/1.1" 200',
+                 '/diff/Aetsveldse%20polder/waterbalans']
+        self.assertEqual(['/diff/3201/esf1',
+                          '/diff/Aetsveldse%20polder/waterbalans'],
+                         read_paths(lines))
+
+    def test_b(self):
+        """Test the generated paths are quoted and reproducible."""
+        pairs = [(u'Aetsveldse polder', 'esf1'), ('3202', 'waterbalans')]
+        paths = generate_paths(pairs, 20, seed=1)
+        self.assertEqual(20, len(paths))
+        self.assertEqual(set(['/diff/Aetsveldse%20polder/esf1',
+                              '/diff/3202/waterbalans']), set(paths))
+        self.assertEqual(paths, generate_paths(pairs, 20, seed=1))
+
+    def test_c(self):
+        """Test no paths are generated without pairs."""
+        self.assertEqual([], generate_paths([], 20))
+
+
+class PercentileTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the nearest-rank percentiles."""
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(95, percentile(values, 95))
+        self.assertEqual(100, percentile(values, 100))
+
+    def test_b(self):
+        """Test the percentile of a single value."""
+        self.assertEqual(0.5, percentile([0.5], 99))
+
+    def test_c(self):
+        """Test the percentile of no values."""
+        self.assertEqual(None, percentile([], 50))
+
+
+class ReplayTestSuite(TestCase):
+
+    def test_a(self):
+        """Test each path is requested relative to the base URL."""
+        opener = create_opener(2)
+        samples, duration = replay(['/diff/3201/esf1', '/diff/3201/esf2'],
+                                   'http://localhost:8000/', 2,
+                                   opener=opener)
+        self.assertEqual(['http://localhost:8000/diff/3201/esf1',
+                          'http://localhost:8000/diff/3201/esf2'],
+                         sorted(opener.urls))
+        self.assertEqual([2, 2], [sample.query_count for sample in samples])
+
+    def test_b(self):
+        """Test a request that raises is a failed sample."""
+        opener = Mock(side_effect=IOError('connection refused'))
+        samples, duration = replay(['/diff/3201/esf1'], 'http://localhost/',
+                                   opener=opener)
+        self.assertTrue(samples[0].failed)
+
+
+class ReportTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the statistics of the samples."""
+        samples = [Sample('/diff/3201/esf1', 200, 0.1 * i, 2)
+                   for i in range(1, 11)]
+        samples.append(Sample('/diff/3201/esf1', 500, 5.0))
+        summary = summarize(samples, 2.0)
+        self.assertEqual(11, summary['requests'])
+        self.assertEqual(1, summary['failed'])
+        self.assertAlmostEqual(0.5, summary['p50'])
+        self.assertAlmostEqual(1.0, summary['p99'])
+        self.assertAlmostEqual(5.5, summary['throughput'])
+        self.assertEqual(2.0, summary['queries'])
+
+    def test_b(self):
+        """Test the report has a line per configuration type and a total."""
+        samples = [Sample('/diff/3201/esf1', 200, 0.25),
+                   Sample('/diff/3201/waterbalans', 200, 0.5, 0)]
+        stream = StringIO()
+        write_report(samples, 1.0, stream)
+        self.assertEqual(
+            'esf1: 1 request(s), 0 failed, p50 0.250s, p95 0.250s, '
+            'p99 0.250s, 1.0 per second\n'
+            'waterbalans: 1 request(s), 0 failed, p50 0.500s, p95 0.500s, '
+            'p99 0.500s, 1.0 per second, 0.0 queries\n'
+            'total: 2 request(s), 0 failed, p50 0.250s, p95 0.500s, '
+            'p99 0.500s, 2.0 per second, 0.0 queries\n',
+            stream.getvalue())
@@ -0,0 +1,323 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the validation of many configurations in bounded memory.
+
+The regular validation retrieves all records of both sides of a comparison
+and keeps them in memory. For the largest data sets that does not fit. The
+low-memory validation reads the records of each side once and partitions them
+by area into temporary files. It keeps at most memory_limit bytes of records
+in memory: when the records buffered for all sides and parts of a group of
+configurations exceed that limit, they are spilled to their partition files. Then it validates the configurations one area at a
+time, loading only the partitions of that area, and yields the differences of
+each configuration as soon as they are known.
+
+The database exporters build the list of all records of a data set, which
+cannot be avoided. The low-memory validation partitions that list and
+releases it before the next export starts, and it does not cache it.
+
+"""
+
+import logging
+import os
+import resource
+import shutil
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+
+from lizard_validation import instrumentation
+from lizard_validation.config_comparer import COMPARISONS
+from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.config_comparer import RECORD_TYPES
+from lizard_validation.config_comparer import check_fields
+from lizard_validation.sources import data_set_key
+from lizard_validation.sources import registry
+from lizard_validation.validation import get_comparisons
+from lizard_validation.validation import get_parts
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of bytes of records the low-memory validation keeps in
+# memory.
+MEMORY_LIMIT = getattr(settings, 'LIZARD_VALIDATION_MEMORY_LIMIT',
+                       64 * 1024 * 1024)
+
+
+class MemoryLimitExceeded(Exception):
+    """Raised when the records of a single area exceed the memory limit."""
+    pass
+
+
+class MemoryBudget(object):
+    """Implements the memory limit shared by partitioners.
+
+    When the buffers of all partitioners of the budget hold more than
+    memory_limit bytes, each partitioner spills its buffers.
+
+    """
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.buffered_bytes = 0
+        self.partitioners = []
+
+    def add(self, byte_count):
+        self.buffered_bytes += byte_count
+        instrumentation.maximum('peak_buffer_bytes', self.buffered_bytes)
+        if self.buffered_bytes > self.memory_limit:
+            for partitioner in self.partitioners:
+                partitioner.spill()
+
+
+class Partitioner(object):
+    """Implements the partitioning of records by area into temporary files.
+
+    The partitioner keeps the pickled records of each area in a buffer. When
+    the buffers of all partitioners of the given MemoryBudget hold more than
+    its limit, it appends them to the partition files of their areas. The
+    partition files are created in a subdirectory of the given directory of
+    their own, so partitioners that share a directory do not append to each
+    other's files.
+
+    """
+    def __init__(self, directory, budget):
+        self.directory = tempfile.mkdtemp(prefix='partitions-', dir=directory)
+        self.budget = budget
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.file_names = {}
+        budget.partitioners.append(self)
+
+    def add(self, area_ident, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.buffers.setdefault(area_ident, []).append(data)
+        self.buffered_bytes += len(data)
+        self.budget.add(len(data))
+
+    def spill(self):
+        """Append the buffered records to the partition files."""
+        if not self.buffers:
+            return
+        instrumentation.count('spills')
+        instrumentation.count('spilled_bytes', self.buffered_bytes)
+        for area_ident, buffer in self.buffers.items():
+            partition_file = open(self.get_file_name(area_ident), 'ab')
+            try:
+                for data in buffer:
+                    partition_file.write(data)
+            finally:
+                partition_file.close()
+        self.budget.buffered_bytes -= self.buffered_bytes
+        self.buffers = {}
+        self.buffered_bytes = 0
+
+    def get_file_name(self, area_ident):
+        if area_ident not in self.file_names:
+            self.file_names[area_ident] = os.path.join(
+                self.directory, 'partition-%d' % len(self.file_names))
+        return self.file_names[area_ident]
+
+    def get_size(self, area_ident):
+        """Return the number of bytes of the records of the given area."""
+        size = sum(len(data) for data in self.buffers.get(area_ident, []))
+        file_name = self.file_names.get(area_ident)
+        if file_name is not None:
+            size += os.path.getsize(file_name)
+        return size
+
+    def iter_records(self, area_ident):
+        """Yield the records of the given area."""
+        file_name = self.file_names.get(area_ident)
+        if file_name is not None:
+            partition_file = open(file_name, 'rb')
+            try:
+                while True:
+                    try:
+                        yield pickle.load(partition_file)
+                    except EOFError:
+                        break
+            finally:
+                partition_file.close()
+        for data in self.buffers.get(area_ident, []):
+            yield pickle.loads(data)
+
+
+def iter_validate(configs, memory_limit=None, directory=None):
+    """Yield the differences of the given configurations in bounded memory.
+
+    This function yields a tuple of each configuration and its differences in
+    the format of validation.validate, or of each configuration and the
+    exception that prevented its validation. The configurations are grouped
+    by data set and configuration type, so the records of each group are
+    read only once.
+
+    The memory limit is the maximum number of bytes of records in memory. The
+    partition files are created in a temporary directory in the given
+    directory, which is removed afterwards.
+
+    """
+    if memory_limit is None:
+        memory_limit = MEMORY_LIMIT
+    groups = {}
+    for config in configs:
+        key = (data_set_key(config.data_set), config.config_type)
+        groups.setdefault(key, []).append(config)
+    for key in sorted(groups.keys()):
+        for item in iter_validate_group(groups[key], memory_limit, directory):
+            yield item
+    instrumentation.maximum('max_rss_kb',
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def iter_validate_group(configs, memory_limit, directory):
+    """Yield the differences of configurations of a single data set and type."""
+    temp_dir = tempfile.mkdtemp(prefix='lizard_validation-', dir=directory)
+    try:
+        area_idents = set(config.area.ident for config in configs)
+        errors = {}
+        partitioners = {}
+        budget = MemoryBudget(memory_limit)
+        try:
+            for part in get_parts(configs[0]):
+                comparison = get_comparisons(configs[0])[part]
+                with instrumentation.stage('partition %s' % part):
+                    partitioners[part] = partition(
+                        configs, comparison, area_idents, temp_dir, budget,
+                        errors)
+        except Exception as e:
+            # Without the records of the database none of the configurations
+            # of the group can be validated, but the other groups can.
+            logger.exception("unable to partition the records of '%s'",
+                             configs[0].config_type)
+            for config in configs:
+                yield config, e
+            return
+        for config in configs:
+            if config.area.ident in errors:
+                yield config, errors[config.area.ident]
+                continue
+            try:
+                with instrumentation.stage('compare'):
+                    result = dict(
+                        (part, compare_partitions(
+                            config, get_comparisons(config)[part],
+                            partitioners[part], memory_limit))
+                        for part in get_parts(config))
+            except MemoryLimitExceeded as e:
+                yield config, e
+            except Exception as e:
+                logger.exception("unable to validate '%s' configuration of "
+                                 "'%s'", config.config_type, config.area.ident)
+                yield config, e
+            else:
+                yield config, result
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def partition(configs, comparison, area_idents, temp_dir, budget, errors):
+    """Return the (new, current) Partitioners of the records of a comparison.
+
+    The partitioners share the given MemoryBudget with the partitioners of
+    the other comparisons of the configurations.
+
+    The new records are read from the DBF of each configuration; when the
+    configurations share a DBF, it is read only once. The current records are
+    exported once for all configurations. A MissingFieldsError of a DBF is
+    stored in the given dict of errors for each area of that DBF.
+
+    """
+    record_type, new_source_name, current_source_name = COMPARISONS[comparison]
+    record_class, kwargs = RECORD_TYPES[record_type]
+    record_retriever = record_class(**kwargs)
+    fields = [record_retriever.area_field_name]
+    id_field_name = getattr(record_retriever, 'id_field_name', None)
+    if id_field_name is not None:
+        fields.append(id_field_name)
+
+    new_partitioner = Partitioner(temp_dir, budget)
+    new_source = registry.get(new_source_name)
+    configs_by_file = {}
+    for config in configs:
+        file_name = getattr(config, new_source.attr_name)
+        configs_by_file.setdefault(file_name, []).append(config)
+    for file_name, file_configs in configs_by_file.items():
+        open_dbf = new_source.open(file_configs[0])
+        try:
+            check_fields(open_dbf, file_configs[0], fields)
+            file_idents = set(config.area.ident for config in file_configs)
+            add_records(new_partitioner, open_dbf.get_records(),
+                        record_retriever.area_field_name, file_idents)
+        except Exception as e:
+            for config in file_configs:
+                errors[config.area.ident] = e
+        finally:
+            open_dbf.close()
+
+    current_partitioner = Partitioner(temp_dir, budget)
+    current_source = registry.get(current_source_name)
+    open_database = current_source.create_database(configs[0])
+    try:
+        add_records(current_partitioner, open_database.get_records(),
+                    record_retriever.area_field_name, area_idents)
+    finally:
+        open_database.close()
+    return new_partitioner, current_partitioner
+
+
+def add_records(partitioner, records, area_field_name, area_idents):
+    for record in records:
+        area_ident = record.get(area_field_name)
+        if area_ident in area_idents:
+            partitioner.add(area_ident, record)
+
+
+def compare_partitions(config, comparison, partitioners, memory_limit):
+    """Return the differences of the partitions of the given configuration."""
+    record_type, new_source_name, current_source_name = COMPARISONS[comparison]
+    area_ident = config.area.ident
+    new_partitioner, current_partitioner = partitioners
+    size = new_partitioner.get_size(area_ident) + \
+        current_partitioner.get_size(area_ident)
+    instrumentation.maximum('peak_partition_bytes', size)
+    if size > memory_limit:
+        raise MemoryLimitExceeded(
+            "the records of area '%s' take %d bytes, which exceeds the limit "
+            "of %d bytes" % (area_ident, size, memory_limit))
+
+    comparer = ConfigComparer(new_source=new_source_name,
+                              current_source=current_source_name,
+                              record_type=record_type)
+    new_attrs = to_attrs(comparer.new_records,
+                         new_partitioner.iter_records(area_ident))
+    current_attrs = to_attrs(comparer.current_records,
+                             current_partitioner.iter_records(area_ident))
+    normalizer = get_normalizer(config, new_source_name)
+    if normalizer is not None:
+        new_attrs = comparer.new_records.normalize(new_attrs, normalizer)
+        current_attrs = \
+            comparer.current_records.normalize(current_attrs, normalizer)
+    return comparer.dict_compare(new_attrs, current_attrs)
+
+
+def to_attrs(record_retriever, records):
+    """Return the records in the format of the as_dict method of the given
+    AreaConfig or BucketConfig."""
+    id_field_name = getattr(record_retriever, 'id_field_name', None)
+    if id_field_name is None:
+        for record in records:
+            return record
+        return {}
+    return dict((record[id_field_name], record) for record in records)
+
+
+def get_normalizer(config, source_name):
+    open_dbf = registry.get(source_name).open(config)
+    try:
+        return open_dbf.get_normalizer()
+    finally:
+        open_dbf.close()
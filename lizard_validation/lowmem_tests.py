@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from lizard_validation import backends
+from lizard_validation import instrumentation
+from lizard_validation import lowmem
+from lizard_validation.lowmem import MemoryBudget
+from lizard_validation.lowmem import MemoryLimitExceeded
+from lizard_validation.lowmem import Partitioner
+from lizard_validation.lowmem import iter_validate
+from lizard_validation.sources import WaterbalanceFromDatabaseRetriever
+from lizard_validation.sources import registry
+from lizard_validation.validation import validate
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def write_buckets_dbf(file_name, area_idents, bucket_count):
+    """Write the DBF of the given number of buckets of each given area."""
+    dbf = backends.get('dbf')(file_name, new=True)
+    try:
+        dbf.addField(('ID_GW', 'C', 20), ('GEBIED_GW', 'C', 10),
+                     ('OPPERVL', 'N', 12, 0))
+        for area_ident in area_idents:
+            for i in range(1, bucket_count + 1):
+                record = dbf.newRecord()
+                record['ID_GW'] = '%s-DGW-%d' % (area_ident, i)
+                record['GEBIED_GW'] = area_ident
+                record['OPPERVL'] = 1000.0 * i
+                record.store()
+    finally:
+        dbf.close()
+
+
+class PartitionerTestSuite(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a(self):
+        """Test the records of an area are retrieved in order after a spill."""
+        partitioner = Partitioner(self.directory, MemoryBudget(100))
+        records = [{'ID_GW': '3201-DGW-%d' % i} for i in range(10)]
+        for record in records:
+            partitioner.add('3201', record)
+        self.assertTrue(partitioner.buffered_bytes <= 100)
+        self.assertEqual(records, list(partitioner.iter_records('3201')))
+
+    def test_b(self):
+        """Test the records of different areas are kept apart."""
+        partitioner = Partitioner(self.directory, MemoryBudget(100))
+        for i in range(10):
+            partitioner.add(str(3201 + i % 2), {'ID_GW': i})
+        self.assertEqual([{'ID_GW': i} for i in range(1, 10, 2)],
+                         list(partitioner.iter_records('3202')))
+
+    def test_c(self):
+        """Test partitioners that share a directory keep their records apart."""
+        budget = MemoryBudget(100)
+        partitioners = [Partitioner(self.directory, budget) for i in range(2)]
+        for i in range(10):
+            for index, partitioner in enumerate(partitioners):
+                partitioner.add('3201', {'ID_GW': i, 'SIDE': index})
+        for index, partitioner in enumerate(partitioners):
+            self.assertEqual([{'ID_GW': i, 'SIDE': index} for i in range(10)],
+                             list(partitioner.iter_records('3201')))
+
+    def test_d(self):
+        """Test partitioners that share a budget spill together."""
+        budget = MemoryBudget(100)
+        partitioners = [Partitioner(self.directory, budget) for i in range(2)]
+        for i in range(10):
+            for partitioner in partitioners:
+                partitioner.add('3201', {'ID_GW': i})
+                self.assertTrue(budget.buffered_bytes <= 100)
+                self.assertEqual(
+                    sum(partitioner.buffered_bytes
+                        for partitioner in partitioners),
+                    budget.buffered_bytes)
+
+
+class IterValidateTestSuite(TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.config = Mock()
+        self.config.config_type = 'waterbalans'
+        self.config.area.ident = '3201'
+        self.config.data_set = 'Waternet'
+        self.config.area_dbf = \
+            os.path.join(FIXTURES_DIR, 'aanafvoer_waterbalans.dbf')
+        self.config.grondwatergebieden_dbf = \
+            os.path.join(FIXTURES_DIR, 'grondwatergebieden.dbf')
+        self.config.pumpingstations_dbf = \
+            os.path.join(FIXTURES_DIR, 'pumpingstations.dbf')
+        current_records = {
+            'export_areaconfiguration':
+                [{'GAFIDENT': '3201', 'GAFNAAM': 'Aetsveldse polder Oost',
+                  'DIEPTE': 1.18}],
+            'export_bucketconfiguration':
+                [{'ID_GW': '3201-DGW-%d' % i, 'GEBIED_GW': '3201',
+                  'OPPERVL': 1000.0 * i} for i in range(1, 10)],
+            'export_structureconfiguration':
+                [{'ID': '3201-PS-%d' % i, 'GEBIED': '3201',
+                  'CAPACITEIT': 0.5 * i} for i in range(1, 6)],
+            }
+        self.patcher = patch.object(
+            WaterbalanceFromDatabaseRetriever, 'get_records',
+            lambda retriever: current_records[retriever.export_method_name])
+        self.patcher.start()
+
+        self.current_records = current_records
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_a(self):
+        """Test the differences of a configuration in low-memory mode."""
+        [(config, result)] = list(iter_validate([self.config], 4096))
+        self.assertEqual({'DIEPTE': (1.17, 1.18)}, result['area'])
+        self.assertEqual(['3201-DGW-10'], result['buckets'].keys())
+        self.assertEqual({}, result['structures'])
+
+    def test_b(self):
+        """Test the validation fails when an area exceeds the memory limit."""
+        [(config, result)] = list(iter_validate([self.config], 100))
+        self.assertTrue(isinstance(result, MemoryLimitExceeded))
+
+    def test_c(self):
+        """Test the differences after a spill are those of the regular
+        validation."""
+        area_idents = [str(3201 + i) for i in range(6)]
+        directory = tempfile.mkdtemp()
+        try:
+            buckets_dbf = os.path.join(directory, 'grondwatergebieden.dbf')
+            write_buckets_dbf(buckets_dbf, area_idents, 5)
+            self.current_records['export_bucketconfiguration'] = [
+                {'ID_GW': '%s-DGW-%d' % (area_ident, i),
+                 'GEBIED_GW': area_ident, 'OPPERVL': 1000.0 * i + i % 2}
+                for area_ident in area_idents for i in range(1, 6)]
+            configs = []
+            for area_ident in area_idents:
+                config = Mock()
+                config.config_type = 'waterbalans'
+                config.area.ident = area_ident
+                config.data_set = 'Waternet'
+                config.area_dbf = self.config.area_dbf
+                config.grondwatergebieden_dbf = buckets_dbf
+                config.pumpingstations_dbf = self.config.pumpingstations_dbf
+                configs.append(config)
+            instrumentation.begin('test')
+            try:
+                results = list(iter_validate(configs, 1024))
+            finally:
+                measurement = instrumentation.end()
+            self.assertTrue(measurement.counters['spills'] >= 2)
+            for config, result in results:
+                self.assertFalse(isinstance(result, Exception))
+                registry.reset()
+                self.assertEqual(validate(config), result)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_d(self):
+        """Test a failed export fails only the configurations of its group."""
+        broken = Mock()
+        broken.config_type = 'waterbalans'
+        broken.area.ident = '3202'
+        broken.data_set = 'Broken'
+        broken.area_dbf = self.config.area_dbf
+        broken.grondwatergebieden_dbf = self.config.grondwatergebieden_dbf
+        broken.pumpingstations_dbf = self.config.pumpingstations_dbf
+
+        def get_records(retriever):
+            if retriever.config.data_set == 'Broken':
+                raise IOError('export failed')
+            return self.current_records[retriever.export_method_name]
+
+        with patch.object(WaterbalanceFromDatabaseRetriever, 'get_records',
+                          get_records):
+            results = dict((config.data_set, result) for config, result in
+                           iter_validate([broken, self.config], 4096))
+        self.assertTrue(isinstance(results['Broken'], IOError))
+        self.assertEqual({'DIEPTE': (1.17, 1.18)},
+                         results['Waternet']['area'])
+
+    def test_e(self):
+        """Test the records buffered for all parts stay within the limit."""
+        partitioners, totals = [], []
+
+        class RecordingPartitioner(Partitioner):
+            def __init__(self, *args):
+                Partitioner.__init__(self, *args)
+                partitioners.append(self)
+
+            def add(self, area_ident, record):
+                Partitioner.add(self, area_ident, record)
+                totals.append(sum(partitioner.buffered_bytes
+                                  for partitioner in partitioners))
+
+        with patch.object(lowmem, 'Partitioner', RecordingPartitioner):
+            list(iter_validate([self.config], 900))
+        self.assertTrue(totals)
+        self.assertTrue(max(totals) <= 900)
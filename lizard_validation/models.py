@@ -1,4 +1,21 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 # from django.db import models
 
-# Create your models here.
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from lizard_validation import configurations
+from lizard_validation import revalidation
+
+# The receivers are connected to the signals of all models and ignore the
+# models they do not watch. In this way this module does not import the
+# models of lizard_area and lizard_portal.
+post_save.connect(configurations.record_change,
+                  dispatch_uid='lizard_validation.configurations')
+post_delete.connect(configurations.record_change,
+                    dispatch_uid='lizard_validation.configurations')
+
+post_save.connect(revalidation.record_change,
+                  dispatch_uid='lizard_validation.revalidation')
+post_delete.connect(revalidation.record_change,
+                    dispatch_uid='lizard_validation.revalidation')
@@ -0,0 +1,167 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the normalization of the values of DBF and database records.
+
+Values from a DBF and values from the database often differ in type or
+representation while they specify the same thing: a DBF string is an
+encoded, space-padded byte string and a database string is unicode; a DBF
+number is a float and a database number can be a Decimal or a string. A
+Normalizer converts the values of both sides to the same canonical values, so
+only real differences remain.
+
+The conversion of each field is determined once from the DBF header, by the
+type of the field and the code page of the DBF, and is applied to all values
+of that field.
+
+"""
+
+import datetime
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Encoding of the strings of a DBF that does not specify its code page.
+DEFAULT_ENCODING = getattr(settings, 'LIZARD_VALIDATION_DBF_ENCODING', 'cp1252')
+
+# Maps the language driver id in the DBF header to the encoding of the DBF.
+CODEPAGES = {
+    0x01: 'cp437',
+    0x02: 'cp850',
+    0x03: 'cp1252',
+    0x57: 'cp1252',
+    0x58: 'cp1252',
+    0x59: 'cp1252',
+    0x64: 'cp852',
+    0x65: 'cp866',
+    0x13: 'cp932',
+    0x4d: 'cp936',
+    0x4f: 'cp950',
+    0x7d: 'cp1255',
+    0x7e: 'cp1256',
+    0xc8: 'cp1250',
+    0xc9: 'cp1251',
+    0xca: 'cp1254',
+    0xcb: 'cp1253',
+    }
+
+
+class Normalizer(object):
+    """Implements the normalization of records field by field.
+
+    A Normalizer holds a conversion function for each field. Fields without a
+    conversion function are left as is.
+
+    """
+    def __init__(self, converters):
+        self.converters = converters
+
+    def normalize_records(self, records):
+        """Return normalized copies of the given records.
+
+        This method converts the values of one field of all records before it
+        converts the values of the next field.
+
+        """
+        records = [dict(record) for record in records]
+        for field_name, convert in self.converters.items():
+            for record in records:
+                if field_name in record:
+                    record[field_name] = convert(record[field_name])
+        return records
+
+    def normalize_record(self, record):
+        """Return a normalized copy of the given record."""
+        return self.normalize_records([record])[0]
+
+
+def create_normalizer(field_types, language_driver_id=None):
+    """Return the Normalizer for the fields of a DBF.
+
+    The field types is a list of tuples of the name, the type code and the
+    decimal count of each field. The language driver id is the byte in the
+    DBF header that specifies the code page.
+
+    """
+    encoding = CODEPAGES.get(language_driver_id, DEFAULT_ENCODING)
+    converters = {}
+    for field_name, type_code, decimal_count in field_types:
+        if type_code == 'C':
+            converters[field_name] = character_converter(encoding)
+        elif type_code in ('N', 'F'):
+            converters[field_name] = numeric_converter(decimal_count)
+        elif type_code == 'D':
+            converters[field_name] = to_date
+        elif type_code == 'L':
+            converters[field_name] = to_bool
+    return Normalizer(converters)
+
+
+def character_converter(encoding):
+    """Return the function that converts a value to a stripped unicode string.
+
+    Byte strings are decoded using the given encoding.
+
+    """
+    def convert(value):
+        if isinstance(value, str):
+            value = value.decode(encoding, 'replace')
+        elif isinstance(value, (int, long)) and not isinstance(value, bool):
+            value = unicode(value)
+        if isinstance(value, unicode):
+            value = value.strip()
+        return value
+    return convert
+
+
+def numeric_converter(decimal_count):
+    """Return the function that converts a value to a float.
+
+    The float is rounded to the given number of decimals. An empty string is
+    converted to None. Values that cannot be converted are returned as is.
+
+    """
+    def convert(value):
+        if isinstance(value, basestring):
+            value = value.strip()
+            if not value:
+                return None
+        if value is None or isinstance(value, bool):
+            return value
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return value
+        if decimal_count:
+            value = round(value, decimal_count)
+        return value
+    return convert
+
+
+def to_date(value):
+    """Convert a datetime or a string in the format YYYYMMDD to a date."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, basestring):
+        value = value.strip()
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y%m%d').date()
+        except ValueError:
+            return value
+    return value
+
+
+def to_bool(value):
+    """Convert a DBF logical value such as 'T', 'N' or '?' to a bool."""
+    if isinstance(value, basestring):
+        value = value.strip().upper()
+        if value in ('T', 'Y'):
+            return True
+        if value in ('F', 'N'):
+            return False
+        if value in ('', '?'):
+            return None
+    return value
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import datetime
+
+from decimal import Decimal
+from unittest import TestCase
+
+from mock import Mock
+
+from lizard_area.models import Area
+from lizard_portal.configurations_retriever import ConfigurationToValidate
+from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.normalization import create_normalizer
+
+
+class NormalizerTestSuite(TestCase):
+
+    def setUp(self):
+        self.normalizer = create_normalizer(
+            [('GAFNAAM', 'C', 0), ('DIEPTE', 'N', 2), ('DATUM', 'D', 0),
+             ('ACTIEF', 'L', 0)], 0x57)
+
+    def test_a(self):
+        """Test a padded, encoded string equals its unicode version."""
+        record = self.normalizer.normalize_record(
+            {'GAFNAAM': 'Polder Zuid\xe9  '})
+        self.assertEqual({'GAFNAAM': u'Polder Zuid\xe9'}, record)
+
+    def test_b(self):
+        """Test numbers of different types are converted to the same float."""
+        records = self.normalizer.normalize_records(
+            [{'DIEPTE': 1.17}, {'DIEPTE': Decimal('1.170')},
+             {'DIEPTE': ' 1.17'}])
+        self.assertEqual([{'DIEPTE': 1.17}] * 3, records)
+
+    def test_c(self):
+        """Test a date string is converted to a date."""
+        record = self.normalizer.normalize_record({'DATUM': '20120509'})
+        self.assertEqual({'DATUM': datetime.date(2012, 5, 9)}, record)
+
+    def test_d(self):
+        """Test a logical value is converted to a bool."""
+        records = self.normalizer.normalize_records(
+            [{'ACTIEF': 'T'}, {'ACTIEF': 'n'}, {'ACTIEF': '?'}])
+        self.assertEqual([{'ACTIEF': True}, {'ACTIEF': False},
+                          {'ACTIEF': None}], records)
+
+    def test_e(self):
+        """Test the given records are not modified."""
+        record = {'DIEPTE': ' 1.17'}
+        self.normalizer.normalize_record(record)
+        self.assertEqual({'DIEPTE': ' 1.17'}, record)
+
+    def test_f(self):
+        """Test the code page specified by the DBF header is used."""
+        normalizer = create_normalizer([('GAFNAAM', 'C', 0)], 0x65)
+        record = normalizer.normalize_record({'GAFNAAM': '\x8f'})
+        self.assertEqual({'GAFNAAM': u'П'}, record)
+
+
+class NormalizedCompareTestSuite(TestCase):
+
+    def test_a(self):
+        """Test a comparison only reports differences after normalization."""
+        config = ConfigurationToValidate()
+        config.area = Area()
+        config.area.ident = '3201'
+        comparer = ConfigComparer()
+        dbf = Mock()
+        dbf.get_field_names = lambda: ['GAFIDENT', 'DIEPTE', 'GAFNAAM']
+        dbf.get_records = lambda: [{'GAFIDENT': '3201', 'DIEPTE': 1.17,
+                                    'GAFNAAM': 'Polder Zuid\xe9'}]
+        dbf.get_normalizer = lambda: create_normalizer(
+            [('GAFIDENT', 'C', 0), ('DIEPTE', 'N', 2), ('GAFNAAM', 'C', 0)],
+            0x57)
+        comparer.new_records.open_database = Mock(return_value=dbf)
+        database = Mock()
+        database.get_field_names = lambda: ['GAFIDENT', 'DIEPTE', 'GAFNAAM']
+        database.get_records = lambda: [{'GAFIDENT': u'3201',
+                                         'DIEPTE': Decimal('1.18'),
+                                         'GAFNAAM': u'Polder Zuid\xe9'}]
+        comparer.current_records.open_database = Mock(return_value=database)
+        self.assertEqual({'DIEPTE': (1.17, 1.18)}, comparer.compare(config))
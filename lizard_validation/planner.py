@@ -0,0 +1,199 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the choice of the plan to retrieve the records of an area.
+
+The retrievers of the comparers need the records of a single area from an
+open database that holds the records of many areas. There are three ways to
+retrieve them:
+
+- 'scan' reads all records and keeps the records of the area. This is what
+  the retrievers have always done and it is the cheapest plan for a small
+  DBF that is read once.
+- 'index' reads only the records of the area, whose positions it looks up in
+  an index of the area field. The index is built by a scan and kept with the
+  open DBF or the cached export, so it only pays off when the records are
+  retrieved again, for example for the next area.
+- 'columnar' reads the area column of a snapshot to find the positions of
+  the records of the area and then builds only those records. As each
+  record needs the value of each of its fields, the other columns are still
+  decompressed and decoded in full, once per snapshot.
+
+choose_plan estimates the cost of each plan that the open database supports,
+in records read or, for a snapshot, in values decoded and copied, from the
+number of records, the size of the file and the number of times the records
+have been opened, and chooses the cheapest one.
+The exporters of the database cannot retrieve the records of a single area,
+so the first retrieval of an export is always a scan of all its records.
+
+Each chosen plan is logged and recorded with the stage timings, see
+instrumentation.plan.
+
+"""
+
+import logging
+
+from django.conf import settings
+
+from lizard_validation import instrumentation
+
+logger = logging.getLogger(__name__)
+
+SCAN = 'scan'
+INDEX = 'index'
+COLUMNAR = 'columnar'
+
+# Minimum size in bytes of a DBF for which an index is considered.
+MIN_INDEX_FILE_SIZE = \
+    getattr(settings, 'LIZARD_VALIDATION_MIN_INDEX_FILE_SIZE', 256 * 1024)
+
+# Minimum number of records in memory for which an index is considered.
+MIN_INDEX_RECORDS = \
+    getattr(settings, 'LIZARD_VALIDATION_MIN_INDEX_RECORDS', 1000)
+
+# Cost of adding a record to an index relative to the cost of reading it.
+INDEX_BUILD_COST = 0.2
+
+
+class IndexedRecords(object):
+    """Implements the interface of an open database that supports an index.
+
+    The open databases that do not derive from this class, or from
+    ColumnarRecords, are always scanned.
+
+    """
+    def get_record_count(self):
+        raise NotImplementedError
+
+    def get_file_size(self):
+        """Return the size of the file of the records or None."""
+        return None
+
+    def get_use_count(self):
+        """Return the number of times the records have been opened."""
+        raise NotImplementedError
+
+    def has_index(self, field_name):
+        raise NotImplementedError
+
+    def get_index(self, field_name):
+        """Return the dict that maps each value of the given field to the
+        positions of the records with that value."""
+        raise NotImplementedError
+
+    def get_record(self, index):
+        raise NotImplementedError
+
+
+class ColumnarRecords(object):
+    """Implements the interface of an open database that stores its records
+    by column."""
+
+    def get_record_count(self):
+        raise NotImplementedError
+
+    def get_field_names(self):
+        raise NotImplementedError
+
+    def get_column_index(self, field_name):
+        """Return the index of the given field, see IndexedRecords.get_index.
+
+        Only the column of the field is read to build the index.
+
+        """
+        raise NotImplementedError
+
+    def get_record(self, index):
+        raise NotImplementedError
+
+
+class Plan(object):
+    """Implements the chosen plan and the estimated costs of each plan."""
+
+    def __init__(self, strategy, costs, reason):
+        self.strategy = strategy
+        self.costs = costs
+        self.reason = reason
+
+    def describe(self, field_name):
+        costs = ', '.join('%s %d' % (strategy, cost) for strategy, cost
+                          in sorted(self.costs.items()))
+        return '%s on %s (%s; %s)' % (self.strategy, field_name, self.reason,
+                                      costs)
+
+
+def build_index(values):
+    """Return the dict that maps each of the given values to its positions."""
+    index = {}
+    for position, value in enumerate(values):
+        index.setdefault(value, []).append(position)
+    return index
+
+
+def choose_plan(open_database, field_name):
+    """Return the cheapest Plan to retrieve records by the given field.
+
+    The costs are estimated in records read or, for a snapshot, in values
+    decoded and copied. A database that does not support an index or a
+    columnar read is always scanned.
+
+    """
+    if not isinstance(open_database, (IndexedRecords, ColumnarRecords)):
+        return Plan(SCAN, {}, 'no index')
+    record_count = open_database.get_record_count()
+    scan_cost = float(record_count)
+
+    if isinstance(open_database, ColumnarRecords):
+        # Both plans decode every value of the snapshot: a column can only
+        # be decompressed as a whole and a record needs each of its fields. A
+        # scan then copies every value into the dict of its record, whereas a
+        # columnar read indexes the area column and copies the values of the
+        # records of the area only, which this estimate leaves out.
+        field_count = max(len(open_database.get_field_names()), 1)
+        decode_cost = float(record_count * field_count)
+        scan_cost = decode_cost + record_count * field_count
+        columnar_cost = decode_cost + record_count
+        if columnar_cost < scan_cost:
+            return Plan(COLUMNAR, {SCAN: scan_cost, COLUMNAR: columnar_cost},
+                        'snapshot')
+        return Plan(SCAN, {SCAN: scan_cost, COLUMNAR: columnar_cost},
+                    'snapshot')
+
+    if open_database.has_index(field_name):
+        return Plan(INDEX, {SCAN: scan_cost, INDEX: 0.0}, 'index cached')
+    file_size = open_database.get_file_size()
+    if file_size is not None and file_size < MIN_INDEX_FILE_SIZE:
+        return Plan(SCAN, {SCAN: scan_cost}, 'small file')
+    if file_size is None and record_count < MIN_INDEX_RECORDS:
+        return Plan(SCAN, {SCAN: scan_cost}, 'few records')
+    # The cost of building the index is shared by the retrievals to come,
+    # which are estimated from the number of retrievals so far.
+    use_count = max(open_database.get_use_count(), 1)
+    index_cost = record_count * (1 + INDEX_BUILD_COST) / use_count
+    costs = {SCAN: scan_cost, INDEX: index_cost}
+    if index_cost < scan_cost:
+        return Plan(INDEX, costs, 'opened %d times' % use_count)
+    return Plan(SCAN, costs, 'opened %d times' % use_count)
+
+
+def iter_area_records(open_database, field_name, value):
+    """Yield the records of the given open database with the given value.
+
+    This function yields the records in the order in which they are stored,
+    regardless of the chosen plan.
+
+    """
+    plan = choose_plan(open_database, field_name)
+    description = plan.describe(field_name)
+    logger.debug('retrieve records with plan %s', description)
+    instrumentation.plan(description)
+    if plan.strategy == INDEX:
+        index = open_database.get_index(field_name)
+    elif plan.strategy == COLUMNAR:
+        index = open_database.get_column_index(field_name)
+    else:
+        for record in open_database.get_records():
+            if record[field_name] == value:
+                yield record
+        return
+    for position in index.get(value, []):
+        yield open_database.get_record(position)
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import Mock
+
+from lizard_validation import instrumentation
+from lizard_validation.planner import ColumnarRecords
+from lizard_validation.planner import IndexedRecords
+from lizard_validation.planner import build_index
+from lizard_validation.planner import choose_plan
+from lizard_validation.planner import iter_area_records
+from lizard_validation.snapshots import Snapshot
+from lizard_validation.snapshots import write_snapshot
+from lizard_validation.sources import CachedRecords
+from lizard_validation.sources import RecordsWrapper
+
+
+def create_records(count):
+    return [{'GEBIED': str(3201 + index % 10), 'ID': index}
+            for index in range(count)]
+
+
+def create_dbf(record_count, file_size, use_count, indexes=()):
+    open_dbf = Mock(spec=IndexedRecords)
+    open_dbf.get_record_count.return_value = record_count
+    open_dbf.get_file_size.return_value = file_size
+    open_dbf.get_use_count.return_value = use_count
+    open_dbf.has_index.side_effect = lambda field_name: field_name in indexes
+    return open_dbf
+
+
+class ChoosePlanTestSuite(TestCase):
+
+    def test_a(self):
+        """Test a database that does not support an index is scanned."""
+        open_database = Mock()
+        self.assertEqual('scan', choose_plan(open_database, 'GEBIED').strategy)
+
+    def test_b(self):
+        """Test a small DBF is scanned."""
+        open_dbf = create_dbf(100, 10 * 1024, 5)
+        self.assertEqual('scan', choose_plan(open_dbf, 'GEBIED').strategy)
+
+    def test_c(self):
+        """Test a large DBF that is opened for the first time is scanned."""
+        open_dbf = create_dbf(100000, 10 * 1024 * 1024, 1)
+        self.assertEqual('scan', choose_plan(open_dbf, 'GEBIED').strategy)
+
+    def test_d(self):
+        """Test a large DBF that is opened again is indexed."""
+        open_dbf = create_dbf(100000, 10 * 1024 * 1024, 2)
+        self.assertEqual('index', choose_plan(open_dbf, 'GEBIED').strategy)
+
+    def test_e(self):
+        """Test an existing index is used."""
+        open_dbf = create_dbf(100, 10 * 1024, 1, indexes=['GEBIED'])
+        self.assertEqual('index', choose_plan(open_dbf, 'GEBIED').strategy)
+
+    def test_f(self):
+        """Test many cached records that are opened again are indexed."""
+        open_database = RecordsWrapper(
+            CachedRecords(create_records(5000), use_count=2))
+        self.assertEqual('index',
+                         choose_plan(open_database, 'GEBIED').strategy)
+
+    def test_g(self):
+        """Test few cached records are scanned."""
+        open_database = RecordsWrapper(
+            CachedRecords(create_records(10), use_count=2))
+        self.assertEqual('scan', choose_plan(open_database, 'GEBIED').strategy)
+
+    def test_h(self):
+        """Test both plans of a snapshot pay the decode of every column."""
+        snapshot = Mock(spec=ColumnarRecords)
+        snapshot.get_record_count.return_value = 100
+        snapshot.get_field_names.return_value = ['GEBIED', 'ID', 'NAAM']
+        plan = choose_plan(snapshot, 'GEBIED')
+        self.assertEqual('columnar', plan.strategy)
+        self.assertEqual({'scan': 600.0, 'columnar': 400.0}, plan.costs)
+
+
+class IterAreaRecordsTestSuite(TestCase):
+
+    def setUp(self):
+        self.records = create_records(5000)
+        self.expected = [record for record in self.records
+                         if record['GEBIED'] == '3202']
+
+    def test_a(self):
+        """Test the records retrieved with a scan."""
+        open_database = RecordsWrapper(self.records)
+        self.assertEqual(self.expected, list(
+            iter_area_records(open_database, 'GEBIED', '3202')))
+
+    def test_b(self):
+        """Test the records retrieved with an index are in stored order."""
+        cached = CachedRecords(self.records, use_count=2)
+        self.assertEqual(self.expected, list(
+            iter_area_records(RecordsWrapper(cached), 'GEBIED', '3202')))
+        self.assertTrue('GEBIED' in cached.indexes)
+
+    def test_c(self):
+        """Test the records retrieved with a columnar read of a snapshot."""
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, 'test.snapshot')
+            write_snapshot(file_name, [
+                {'GEBIED': u'3201', 'ID': 1}, {'GEBIED': u'3202', 'ID': 2},
+                {'GEBIED': u'3202', 'ID': 3}])
+            snapshot = Snapshot(file_name)
+            try:
+                self.assertEqual('columnar',
+                                 choose_plan(snapshot, 'GEBIED').strategy)
+                self.assertEqual([2, 3], [record['ID'] for record in
+                    iter_area_records(snapshot, 'GEBIED', u'3202')])
+            finally:
+                snapshot.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_d(self):
+        """Test the chosen plan is recorded with the stage timings."""
+        instrumentation.begin('test')
+        try:
+            list(iter_area_records(RecordsWrapper(self.records), 'GEBIED',
+                                   '3202'))
+        finally:
+            measurement = instrumentation.end()
+        self.assertTrue('plans: scan on GEBIED' in measurement.summary())
+
+
+class BuildIndexTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the positions of each value."""
+        self.assertEqual({'a': [0, 2], 'b': [1]}, build_index('aba'))
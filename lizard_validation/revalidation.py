@@ -0,0 +1,337 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the incremental revalidation of configurations.
+
+The differences of each part of a configuration, for example the buckets of
+a water balance configuration, are cached. The key of a cached part contains
+the version of that part of the area and the modification time of the DBF of
+that part. When a model of the ESF or water balance configuration
+applications is saved or deleted, record_change bumps the versions of the
+parts of the area that are affected, which makes their cached differences
+obsolete. Only those parts are computed again.
+
+A periodic job can revalidate only the configurations that have been touched
+since its last run, which are the configurations whose versions have been
+bumped since then, see revalidate_touched.
+
+The versions are only seen by all processes when the cache backend is shared
+by all processes, such as memcached, see versions. With a cache that is
+private to each process, such as the default local-memory cache, a change
+saved in one process does not make the cached differences of another process
+obsolete. The differences are then cached for LOCAL_DIFF_CACHE_TIMEOUT
+seconds at most, and the touched configurations cannot be tracked at all.
+
+Together with the differences of a part, the names of its changed fields are
+cached, which the field index uses, see field_index.
+
+"""
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ObjectDoesNotExist
+
+from lizard_validation import backends
+from lizard_validation import versions
+from lizard_validation.config_comparer import COMPARISONS
+from lizard_validation.sources import data_set_key
+from lizard_validation.sources import get_file_stat
+from lizard_validation.sources import registry
+from lizard_validation.validation import WB_PARTS
+from lizard_validation.validation import get_comparisons
+from lizard_validation.validation import get_parts
+from lizard_validation.validation import validate
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds the differences of a part of a configuration remain
+# cached.
+DIFF_CACHE_TIMEOUT = \
+    getattr(settings, 'LIZARD_VALIDATION_DIFF_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# Maximum number of seconds the differences of a part of a configuration
+# remain cached when the cache is not shared by all processes.
+LOCAL_DIFF_CACHE_TIMEOUT = \
+    getattr(settings, 'LIZARD_VALIDATION_LOCAL_DIFF_CACHE_TIMEOUT', 60)
+
+# Number of seconds the versions of a configuration at the last run of
+# revalidate_touched remain cached.
+SEEN_TIMEOUT = versions.VERSION_TIMEOUT
+
+# Maps the name of each application whose changes affect the validation to
+# the family of configuration types it affects.
+WATCHED_APPS = {'lizard_esf': 'esf',
+                'lizard_wbconfiguration': 'waterbalans'}
+
+# Maps the (lower case) name of each model of lizard_wbconfiguration to the
+# parts of a water balance configuration it affects. A change of any other
+# model of that application affects all parts.
+WB_MODEL_PARTS = {'areaconfiguration': ('area',),
+                  'bucket': ('buckets',),
+                  'structure': ('structures',)}
+
+
+def get_family(config):
+    """Return the family of the type of the given configuration."""
+    if config.config_type == 'waterbalans':
+        return 'waterbalans'
+    return 'esf'
+
+
+def get_result(config):
+    """Return the differences of the given ConfigurationToValidate.
+
+    This function returns the same dict as validation.validate but only
+    computes the parts whose cached differences are obsolete.
+
+    """
+    parts = get_parts(config)
+    keys = dict((part, result_key(config, part)) for part in parts)
+    cached = cache.get_many(keys.values())
+    result = {}
+    for part in parts:
+        if keys[part] in cached:
+            result[part] = cached[keys[part]]
+    stale_parts = [part for part in parts if part not in result]
+    if stale_parts:
+        logger.debug("revalidate part(s) %s of '%s' configuration of '%s'",
+                     ', '.join(stale_parts), config.config_type,
+                     config.area.ident)
+        computed = validate(config, stale_parts)
+        values = {}
+        for part in stale_parts:
+            values[keys[part]] = computed[part]
+            values[fields_key(config, part)] = \
+                (keys[part], get_changed_fields(part, computed[part]))
+        cache.set_many(values, get_diff_cache_timeout())
+        result.update(computed)
+    return result
+
+
+def get_diff_cache_timeout():
+    """Return the number of seconds the differences of a part remain cached.
+
+    When the cache is not shared by all processes, the changes made in other
+    processes go unnoticed, so the differences are cached only briefly.
+
+    """
+    if versions.is_shared():
+        return DIFF_CACHE_TIMEOUT
+    return min(DIFF_CACHE_TIMEOUT, LOCAL_DIFF_CACHE_TIMEOUT)
+
+
+def result_key(config, part, counters=None):
+    """Return the cache key of the differences of the given part.
+
+    The key contains the values of the version counters of the part, see
+    get_version_names. When the values are not given, this function retrieves
+    them.
+
+    """
+    if counters is None:
+        counters = [versions.get(*names)
+                    for names in get_version_names(config, part)]
+    family = get_family(config)
+    new_source = COMPARISONS[get_comparisons(config)[part]][1]
+    file_name = getattr(config, registry.get(new_source).attr_name)
+    names = (('diff', family, config.area.ident, config.config_type, part) +
+             tuple(counters) + (file_name, get_file_stat(file_name)))
+    return 'lizard_validation.diff.%s' % versions.version_key(names)
+
+
+def get_version_names(config, part):
+    """Return the names of the version counters of the given part."""
+    family = get_family(config)
+    return [('diff', family),
+            ('diff', family, config.area.ident, part),
+            ('data_set', data_set_key(config.data_set))]
+
+
+def fields_key(config, part):
+    """Return the cache key of the changed fields of the given part.
+
+    Unlike the key of the differences, this key does not depend on the
+    versions, so it always refers to the changed fields that have been
+    computed last.
+
+    """
+    text = u'%s|%s|%s' % (config.area.ident, config.config_type, part)
+    return 'lizard_validation.fields.%s' % \
+        hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def get_changed_fields(part, diff):
+    """Return the dict that maps each changed field to its records.
+
+    The given diff is the diff of the given part as returned by
+    validation.validate. Each field name is mapped to the sorted list of the
+    keys of the records that differ in that field. The key of the record of
+    the area part is the empty string.
+
+    """
+    if part == 'area':
+        records = [('', diff)]
+    else:
+        records = diff.items()
+    fields = {}
+    for key, record_diff in records:
+        for field_name in record_diff.keys():
+            fields.setdefault(field_name, []).append(key)
+    for keys in fields.values():
+        keys.sort()
+    return fields
+
+
+def record_change(sender, instance, **kwargs):
+    """Record the change of the given model instance.
+
+    This function can be connected to the signals that are sent when a model
+    is saved or deleted. It ignores the models of applications that do not
+    affect the validation.
+
+    """
+    family = WATCHED_APPS.get(sender._meta.app_label)
+    if family is None:
+        return
+    if family == 'waterbalans':
+        parts = WB_MODEL_PARTS.get(sender._meta.object_name.lower(),
+                                   get_parts_of_family(family))
+    else:
+        parts = get_parts_of_family(family)
+    area = get_area(instance)
+    area_ident = get_attr(area, 'ident')
+    data_set = get_attr(instance, 'data_set') or get_attr(area, 'data_set')
+    touch(family, area_ident, data_set, parts)
+
+
+def touch(family, area_ident, data_set, parts):
+    """Make the cached differences of the given parts obsolete.
+
+    When no area is given, this function makes the cached differences of all
+    areas obsolete. When a data set is given, this function also removes the
+    cached exports of that data set.
+
+    """
+    logger.debug("%s configuration of area '%s' has changed, part(s) %s",
+                 family, area_ident, ', '.join(parts))
+    if area_ident is None:
+        versions.bump('diff', family)
+    else:
+        for part in parts:
+            versions.bump('diff', family, area_ident, part)
+    if data_set is None:
+        versions.bump('data_set')
+        registry.reset()
+    else:
+        versions.bump('data_set', data_set_key(data_set))
+        registry.reset(data_set=data_set)
+
+
+def get_area(instance):
+    """Return the area or area configuration of the given model instance.
+
+    The models of the configuration applications refer to their area either
+    directly or through an area configuration. This function returns the first
+    object on that path that has an ident, or None.
+
+    """
+    area = instance
+    for level in range(2):
+        area = get_attr(area, 'area')
+        if area is None or get_attr(area, 'ident') is not None:
+            return area
+    return None
+
+
+def get_attr(instance, attr_name):
+    """Return the given attribute of the given model instance or None.
+
+    This function also returns None when the attribute refers to an object
+    that no longer exists, which can happen when the instance is deleted.
+
+    """
+    try:
+        return getattr(instance, attr_name, None)
+    except ObjectDoesNotExist:
+        return None
+
+
+def get_parts_of_family(family):
+    if family == 'waterbalans':
+        return WB_PARTS
+    return ('area',)
+
+
+def get_touch_names(config):
+    """Return the names of the version counters that touch bumps for the
+    given configuration."""
+    family = get_family(config)
+    return [('diff', family)] + [('diff', family, config.area.ident, part)
+                                 for part in get_parts(config)]
+
+
+def seen_key(config):
+    """Return the cache key of the versions of the given configuration at
+    the last run of pop_touched_configurations."""
+    text = u'%s|%s' % (config.area.ident, config.config_type)
+    return 'lizard_validation.seen.%s' % \
+        hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def pop_touched_configurations():
+    """Return the configurations that have been touched since the last call.
+
+    A configuration has been touched when the value of one of its version
+    counters, see get_touch_names, differs from its value at the last call.
+    Those values are cached per configuration. Each change bumps the
+    counters, which the cache does atomically, so concurrent changes are not
+    lost. When the values of the last call are no longer cached, for example
+    at the first call, the configuration is considered touched.
+
+    This function raises ImproperlyConfigured when the cache is not shared by
+    all processes: the counters and values of the last call would then be
+    lost with the process, so every configuration would be touched.
+
+    """
+    if not versions.is_shared():
+        raise ImproperlyConfigured(
+            'the touched configurations can only be tracked with a cache '
+            'backend that is shared by all processes, such as memcached')
+    ConfigurationToValidate = backends.get('configuration_to_validate')
+    configs = list(
+        ConfigurationToValidate.objects.select_related('area', 'data_set'))
+    names_list = [get_touch_names(config) for config in configs]
+    values = iter(versions.get_many([names for config_names in names_list
+                                     for names in config_names]))
+    keys = [seen_key(config) for config in configs]
+    seen = cache.get_many(keys)
+    touched, stamps = [], {}
+    for config, key, config_names in zip(configs, keys, names_list):
+        stamp = [next(values) for names in config_names]
+        if seen.get(key) != stamp:
+            touched.append(config)
+            stamps[key] = stamp
+    if stamps:
+        cache.set_many(stamps, SEEN_TIMEOUT)
+    return sorted(touched,
+                  key=lambda config: (config.area.name, config.config_type))
+
+
+def revalidate_touched():
+    """Compute the obsolete differences of the touched configurations.
+
+    This function returns the number of configurations that have been
+    revalidated.
+
+    """
+    configs = pop_touched_configurations()
+    for config in configs:
+        try:
+            get_result(config)
+        except Exception:
+            logger.exception("unable to revalidate '%s' configuration of '%s'",
+                             config.config_type, config.area.name)
+    return len(configs)
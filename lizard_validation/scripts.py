@@ -0,0 +1,340 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the command-line validation of configurations.
+
+The console script validate_configurations compares the configurations to
+validate of one or more areas and configuration types to the configurations in
+the database and writes the differences to standard output. It writes a
+summary of the timings to standard error.
+
+The script can also write snapshots of the database of the data sets of the
+configurations and compare the configurations to such a snapshot instead of to
+the database, see lizard_validation.snapshots. And it can compare the
+configurations to a previous upload of their DBFs, which does not access the
+database at all.
+
+The script needs the Django settings, which it takes from the environment
+variable DJANGO_SETTINGS_MODULE or from its --settings option.
+
+"""
+
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('text', 'json', 'csv')
+
+
+def main(argv=None):
+    """Run the validation as specified by the given command-line arguments.
+
+    This function returns 0 when all configurations could be validated and 1
+    when the validation of one or more configurations failed or when the
+    touched configurations cannot be tracked.
+
+    """
+    options, args = parse_args(argv)
+    if options.settings:
+        os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+
+    start = time.time()
+    if options.touched:
+        from django.core.exceptions import ImproperlyConfigured
+        from lizard_validation.revalidation import pop_touched_configurations
+        try:
+            configs = pop_touched_configurations()
+        except ImproperlyConfigured as e:
+            sys.stderr.write('%s\n' % e)
+            return 1
+    else:
+        configs = get_configurations(options.area_names, options.config_types)
+    if options.write_snapshots:
+        from lizard_validation.validation import write_snapshots
+        for file_name in write_snapshots(configs, options.snapshot or 'latest',
+                                         options.snapshot_dir):
+            sys.stdout.write(file_name + '\n')
+        return 0
+    if options.low_memory:
+        from lizard_validation import instrumentation
+        measurement = instrumentation.begin('low memory validation')
+        written = []
+        try:
+            WRITERS[options.format](
+                forget_results(iter_low_memory_outcomes(configs, options),
+                               written),
+                sys.stdout)
+        finally:
+            instrumentation.end()
+        outcomes = written + [Outcome(None, None, None, measurement)]
+    else:
+        def validate(config):
+            return validate_configuration(config, options.snapshot,
+                                          options.snapshot_dir,
+                                          options.previous_dir)
+        if options.jobs > 1:
+            pool = ThreadPool(options.jobs)
+            try:
+                outcomes = pool.map(validate, configs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            outcomes = [validate(config) for config in configs]
+        WRITERS[options.format](outcomes, sys.stdout)
+    duration = time.time() - start
+
+    write_summary(outcomes, duration, sys.stderr)
+    if [outcome for outcome in outcomes if outcome.error is not None]:
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = OptionParser(
+        usage='%prog [options]',
+        description='Compare the configurations to validate with the '
+        'configurations in the database.')
+    parser.add_option('--settings', dest='settings',
+                      help='the Django settings module to use')
+    parser.add_option('-a', '--area', dest='area_names', action='append',
+                      default=[], metavar='NAME',
+                      help='validate the area with the given name, which can '
+                      'be repeated; by default all areas are validated')
+    parser.add_option('-t', '--type', dest='config_types', action='append',
+                      default=[], metavar='TYPE',
+                      help='validate the configurations of the given type, '
+                      'which can be repeated; by default all types are '
+                      'validated')
+    parser.add_option('--touched', dest='touched', action='store_true',
+                      default=False,
+                      help='only validate the configurations that have been '
+                      'changed in the database since the last run with this '
+                      'option, ignoring the area and type options, which '
+                      'requires a shared cache backend such as memcached')
+    parser.add_option('-f', '--format', dest='format', choices=FORMATS,
+                      default='text',
+                      help='the output format, one of %s' % ', '.join(FORMATS))
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='the number of configurations to validate in '
+                      'parallel')
+    parser.add_option('--low-memory', dest='low_memory', action='store_true',
+                      default=False,
+                      help='validate the configurations one area at a time '
+                      'and spill the records to temporary files, which '
+                      'ignores the jobs option')
+    parser.add_option('--memory-limit', dest='memory_limit', type='int',
+                      metavar='MB',
+                      help='the maximum number of megabytes of records to '
+                      'keep in memory in low-memory mode')
+    parser.add_option('--temp-dir', dest='temp_dir', metavar='DIR',
+                      help='the directory of the temporary files in '
+                      'low-memory mode')
+    parser.add_option('--snapshot', dest='snapshot', metavar='LABEL',
+                      help='compare the configurations with the snapshot of '
+                      'the database with the given label, for example '
+                      '"latest", instead of with the database')
+    parser.add_option('--write-snapshots', dest='write_snapshots',
+                      action='store_true', default=False,
+                      help='write the snapshots of the database of the data '
+                      'sets of the configurations instead of validating '
+                      'them, with the label of the snapshot option or '
+                      '"latest"')
+    parser.add_option('--snapshot-dir', dest='snapshot_dir', metavar='DIR',
+                      help='the directory of the snapshots')
+    parser.add_option('--previous', dest='previous_dir', metavar='DIR',
+                      help='compare the configurations with the DBFs with the '
+                      'same names in the given directory, the previous '
+                      'upload, instead of with the database')
+    options, args = parser.parse_args(argv)
+    if options.jobs < 1:
+        parser.error('the number of jobs should be at least 1')
+    if options.low_memory and options.snapshot and \
+            not options.write_snapshots:
+        parser.error('the low-memory mode cannot compare with a snapshot')
+    if options.previous_dir and (options.low_memory or options.snapshot or
+                                 options.write_snapshots):
+        parser.error('the previous upload cannot be combined with the '
+                     'low-memory mode or a snapshot')
+    return options, args
+
+
+def get_configurations(area_names, config_types):
+    """Return the ConfigurationToValidate instances to validate.
+
+    When no area names or no configuration types are given, this function
+    does not filter on them.
+
+    """
+    from lizard_validation import backends
+    ConfigurationToValidate = backends.get('configuration_to_validate')
+    configs = ConfigurationToValidate.objects.select_related('area', 'data_set')
+    if area_names:
+        configs = configs.filter(area__name__in=area_names)
+    if config_types:
+        configs = configs.filter(config_type__in=config_types)
+    return list(configs.order_by('area__name', 'config_type'))
+
+
+class Outcome(object):
+    """Implements the outcome of the validation of a single configuration.
+
+    The outcome without configuration holds the measurement of a run that
+    validates several configurations at once.
+
+    """
+    def __init__(self, config, result, error, measurement):
+        if config is None:
+            self.area_name, self.config_type = None, None
+        else:
+            self.area_name = config.area.name
+            self.config_type = config.config_type
+        self.result = result
+        self.error = error
+        self.measurement = measurement
+
+
+def validate_configuration(config, snapshot=None, snapshot_dir=None,
+                           previous_dir=None):
+    """Return the Outcome of the validation of the given configuration.
+
+    When the label of a snapshot is given, the configuration is compared with
+    that snapshot of the database. When the directory of a previous upload is
+    given, the configuration is compared with the DBFs in that directory.
+
+    """
+    from django.db import connection
+    from lizard_validation import instrumentation
+    from lizard_validation.revalidation import get_result
+    from lizard_validation.validation import get_previous_configuration
+    from lizard_validation.validation import validate
+
+    instrumentation.begin('%s %s' % (config.area.name, config.config_type))
+    result, error = None, None
+    try:
+        if previous_dir is not None:
+            previous_config = get_previous_configuration(config, previous_dir)
+            result = validate(config, previous_config=previous_config)
+        elif snapshot is not None:
+            result = validate(config, snapshot=snapshot,
+                              snapshot_dir=snapshot_dir)
+        else:
+            result = get_result(config)
+    except Exception as e:
+        logger.exception("unable to validate '%s' configuration of '%s'",
+                         config.config_type, config.area.name)
+        error = e
+    finally:
+        measurement = instrumentation.end()
+        # Each thread has its own database connection, which it should close
+        # itself.
+        connection.close()
+    return Outcome(config, result, error, measurement)
+
+
+def iter_low_memory_outcomes(configs, options):
+    """Yield the Outcome of each configuration validated in low-memory mode."""
+    from lizard_validation.lowmem import iter_validate
+
+    memory_limit = None
+    if options.memory_limit is not None:
+        memory_limit = options.memory_limit * 1024 * 1024
+    for config, result in iter_validate(configs, memory_limit,
+                                        options.temp_dir):
+        if isinstance(result, Exception):
+            yield Outcome(config, None, result, None)
+        else:
+            yield Outcome(config, result, None, None)
+
+
+def forget_results(outcomes, written):
+    """Yield the given outcomes and forget their results once written.
+
+    Each outcome is appended, without its result, to the given list.
+
+    """
+    for outcome in outcomes:
+        yield outcome
+        outcome.result = None
+        written.append(outcome)
+
+
+def iter_rows(outcomes):
+    """Yield the row of each difference and each error of the given outcomes.
+
+    Each row is a tuple of the area name, the configuration type, the part,
+    the record key, the field name, the new value and the current value. The
+    row of an error has the error message as field name.
+
+    """
+    from lizard_validation.validation import iter_differences
+
+    for outcome in outcomes:
+        if outcome.area_name is None:
+            continue
+        prefix = (outcome.area_name, outcome.config_type)
+        if outcome.error is not None:
+            yield prefix + ('', '', 'error: %s' % outcome.error, '', '')
+        else:
+            for difference in iter_differences(outcome.result):
+                yield prefix + difference
+
+
+def to_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_text(outcomes, stream):
+    for row in iter_rows(outcomes):
+        stream.write('\t'.join(to_text(value) for value in row) + '\n')
+
+
+def write_csv(outcomes, stream):
+    writer = csv.writer(stream)
+    writer.writerow(['area', 'type', 'part', 'key', 'field', 'new', 'current'])
+    for row in iter_rows(outcomes):
+        writer.writerow([to_text(value) for value in row])
+
+
+def write_json(outcomes, stream):
+    """Write the given outcomes as a JSON list, one outcome at a time."""
+    separator = '[\n'
+    for outcome in outcomes:
+        document = {'area': outcome.area_name, 'type': outcome.config_type}
+        if outcome.error is not None:
+            document['error'] = str(outcome.error)
+        else:
+            document['diff'] = outcome.result
+        stream.write(separator)
+        stream.write(json.dumps(document, default=unicode, sort_keys=True))
+        separator = ',\n'
+    if separator == '[\n':
+        stream.write('[')
+    stream.write('\n]\n')
+
+
+WRITERS = {'text': write_text, 'json': write_json, 'csv': write_csv}
+
+
+def write_summary(outcomes, duration, stream):
+    """Write the timings of the validation of the given outcomes."""
+    for outcome in outcomes:
+        if outcome.measurement is not None:
+            stream.write(to_text(outcome.measurement.summary()) + '\n')
+    validated = [outcome for outcome in outcomes
+                 if outcome.area_name is not None]
+    failures = len([outcome for outcome in validated
+                    if outcome.error is not None])
+    rate = len(validated) / duration if duration > 0 else 0.0
+    stream.write('validated %d configuration(s) in %.3fs (%.1f per second), '
+                 '%d failed\n' % (len(validated), duration, rate, failures))
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import json
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from mock import Mock
+
+from lizard_validation.scripts import Outcome
+from lizard_validation.scripts import parse_args
+from lizard_validation.scripts import write_json
+from lizard_validation.scripts import write_text
+
+
+def create_outcome(result, error=None):
+    config = Mock()
+    config.area.name = 'Aetsveldse polder Oost'
+    config.config_type = 'waterbalans'
+    return Outcome(config, result, error, None)
+
+
+class WriteTextTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the output of the differences of each part."""
+        result = {'area': {'DIEPTE': (1.17, 1.18)},
+                  'buckets': {'3201-DGW-1': {'OPPERVL': (2.0, 3.0)}},
+                  'structures': {}}
+        stream = StringIO()
+        write_text([create_outcome(result)], stream)
+        self.assertEqual(
+            'Aetsveldse polder Oost\twaterbalans\tarea\t\tDIEPTE\t1.17\t1.18\n'
+            'Aetsveldse polder Oost\twaterbalans\tbuckets\t3201-DGW-1\tOPPERVL\t2.0\t3.0\n',
+            stream.getvalue())
+
+    def test_b(self):
+        """Test the output of a failed validation."""
+        stream = StringIO()
+        write_text([create_outcome(None, IOError('no such file'))], stream)
+        self.assertEqual(
+            'Aetsveldse polder Oost\twaterbalans\t\t\terror: no such file\t\t\n',
+            stream.getvalue())
+
+
+class WriteJsonTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the output of the differences as JSON."""
+        stream = StringIO()
+        write_json([create_outcome({'area': {'DIEPTE': (1.17, 1.18)}})],
+                   stream)
+        self.assertEqual([{'area': 'Aetsveldse polder Oost',
+                           'type': 'waterbalans',
+                           'diff': {'area': {'DIEPTE': [1.17, 1.18]}}}],
+                         json.loads(stream.getvalue()))
+
+
+class ParseArgsTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the default options."""
+        options, args = parse_args([])
+        self.assertEqual(([], [], 'text', 1),
+                         (options.area_names, options.config_types,
+                          options.format, options.jobs))
+
+    def test_b(self):
+        """Test the repeated area and type options."""
+        options, args = parse_args(['-a', 'Oost', '-a', 'West', '-t', 'esf1',
+                                    '--jobs', '4', '--format', 'csv'])
+        self.assertEqual((['Oost', 'West'], ['esf1'], 'csv', 4),
+                         (options.area_names, options.config_types,
+                          options.format, options.jobs))
+
+    def test_c(self):
+        """Test the previous upload cannot be combined with a snapshot."""
+        self.assertRaises(SystemExit, parse_args,
+                          ['--previous', 'var/previous', '--snapshot', 'latest'])
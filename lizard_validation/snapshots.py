@@ -0,0 +1,326 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the snapshots of the records exported from the database.
+
+A snapshot stores the records of an export, for example all ESF records of a
+data set, in a compact binary file. A validation can then compare a
+configuration to the snapshot instead of to the database, which avoids the
+export, and it can compare to the database as it was when the snapshot was
+taken.
+
+The file is columnar and versioned. It starts with a fixed header: the magic
+bytes MAGIC, the format version and the length of the JSON index that
+follows. The index specifies the number of records, the metadata of the
+snapshot and, for each field, its type and the offset and length of its
+column in the rest of the file. Each column is compressed with zlib and
+consists of a status byte per record, which tells whether the record has a
+value, None or no value for the field, followed by the values themselves.
+
+The types of column are 'int', 'float' and 'bool', which store their values as
+fixed-size little-endian numbers, 'text', which stores the lengths of the
+UTF-8 encoded values followed by the values themselves, and 'pickle', which
+stores the pickled list of values. The last one is used for the columns whose
+values are of any other type or of mixed types.
+
+A Snapshot maps the file into memory and decompresses only the columns that
+are requested, each column once. To retrieve the records of a single area, it
+reads the area column to find them and builds only their dicts, see planner.
+Building a record still decodes every column, as a column can only be
+decompressed as a whole.
+
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+
+from lizard_validation.planner import ColumnarRecords
+from lizard_validation.planner import build_index
+
+# Directory of the snapshots.
+SNAPSHOT_DIR = getattr(
+    settings, 'LIZARD_VALIDATION_SNAPSHOT_DIR',
+    os.path.join(getattr(settings, 'BUILDOUT_DIR', '.'), 'var', 'snapshots'))
+
+MAGIC = 'LVSNAP'.encode('ascii')
+VERSION = 1
+
+# Structure of the fixed header: magic bytes, format version and the length
+# of the index.
+HEADER = struct.Struct('<6sHI')
+
+# Status of the value of a field of a record.
+ABSENT, NONE, PRESENT = 0, 1, 2
+
+# Value of a field of a record that has no value for that field.
+MISSING = object()
+
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class SnapshotError(Exception):
+    """Raised when a file is not a snapshot of a supported version."""
+
+
+def snapshot_path(directory, data_set, export_name, label='latest'):
+    """Return the path of the snapshot with the given label.
+
+    The snapshot contains the records of the given data set exported by the
+    export with the given name.
+
+    """
+    data_set = getattr(data_set, 'pk', data_set)
+    name = '%s-%s-%s.snapshot' % (data_set, export_name, label)
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', name))
+
+
+def write_snapshot(file_name, records, **metadata):
+    """Write the given records to the snapshot with the given name.
+
+    The records are dicts that map field name to value. The given metadata,
+    for example the data set, is stored in the index of the snapshot and
+    should be serializable to JSON. This function writes the snapshot to a
+    temporary file first and then renames it, so a reader never sees a
+    partial snapshot.
+
+    """
+    field_names = sorted(set(field_name for record in records
+                             for field_name in record.keys()))
+    columns, blocks, offset = [], [], 0
+    for field_name in field_names:
+        column_type, data = encode_column(
+            [record.get(field_name) for record in records],
+            [field_name in record for record in records])
+        block = zlib.compress(data)
+        columns.append({'name': field_name, 'type': column_type,
+                        'offset': offset, 'length': len(block)})
+        blocks.append(block)
+        offset += len(block)
+    metadata.setdefault('created', time.time())
+    index = json.dumps({'records': len(records), 'columns': columns,
+                        'metadata': metadata},
+                       default=unicode, sort_keys=True).encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    descriptor, temp_name = tempfile.mkstemp(dir=directory,
+                                             suffix='.snapshot.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, VERSION, len(index)))
+            snapshot.write(index)
+            for block in blocks:
+                snapshot.write(block)
+        os.rename(temp_name, file_name)
+    except:
+        os.remove(temp_name)
+        raise
+
+
+def encode_column(values, present):
+    """Return the type and the encoded data of the given column.
+
+    The given list present specifies for each value whether the record has a
+    value for the field at all.
+
+    """
+    statuses = bytearray(
+        PRESENT if has_value and value is not None else
+        (NONE if has_value else ABSENT)
+        for value, has_value in zip(values, present))
+    values = [value for value, status in zip(values, statuses)
+              if status == PRESENT]
+    column_type = get_column_type(values)
+    if column_type == 'int':
+        payload = struct.pack('<%dq' % len(values), *values)
+    elif column_type == 'float':
+        payload = struct.pack('<%dd' % len(values), *values)
+    elif column_type == 'bool':
+        payload = bytes(bytearray(values))
+    elif column_type == 'text':
+        encoded = [value.encode('utf-8') for value in values]
+        payload = struct.pack('<%dI' % len(encoded),
+                              *[len(value) for value in encoded]) + \
+            ''.encode('ascii').join(encoded)
+    else:
+        payload = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+    return column_type, bytes(statuses) + payload
+
+
+def get_column_type(values):
+    """Return the type of the column with the given values."""
+    types = set(type(value) for value in values)
+    if types == set([bool]):
+        return 'bool'
+    if types and types <= set([int, long]) and \
+            all(INT_MIN <= value <= INT_MAX for value in values):
+        return 'int'
+    if types == set([float]):
+        return 'float'
+    if types == set([unicode]):
+        return 'text'
+    return 'pickle'
+
+
+def decode_column(column_type, data, record_count):
+    """Return the values of the column with the given type and data.
+
+    This function returns a list with a value for each record. The value of a
+    record that has no value for the field is MISSING.
+
+    """
+    statuses = bytearray(data[:record_count])
+    payload = data[record_count:]
+    count = len([status for status in statuses if status == PRESENT])
+    if column_type == 'int':
+        values = struct.unpack('<%dq' % count, payload)
+    elif column_type == 'float':
+        values = struct.unpack('<%dd' % count, payload)
+    elif column_type == 'bool':
+        values = [bool(value) for value in bytearray(payload)]
+    elif column_type == 'text':
+        lengths = struct.unpack_from('<%dI' % count, payload)
+        values, offset = [], 4 * count
+        for length in lengths:
+            values.append(payload[offset:offset + length].decode('utf-8'))
+            offset += length
+    elif column_type == 'pickle':
+        values = pickle.loads(payload)
+    else:
+        raise SnapshotError("unknown column type '%s'" % column_type)
+    values = iter(values)
+    column = []
+    for status in statuses:
+        if status == PRESENT:
+            column.append(next(values))
+        elif status == NONE:
+            column.append(None)
+        else:
+            column.append(MISSING)
+    return column
+
+
+class Snapshot(ColumnarRecords):
+    """Implements the read access to a snapshot.
+
+    A Snapshot has the same interface as the other wrappers of records: the
+    methods get_field_names, get_records and close.
+
+    """
+    def __init__(self, file_name):
+        """Open the snapshot with the given name.
+
+        This method raises an IOError when the file cannot be opened and a
+        SnapshotError when it is not a snapshot of a supported version.
+
+        """
+        self.file_name = file_name
+        with open(file_name, 'rb') as snapshot:
+            try:
+                self.map = mmap.mmap(snapshot.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError("snapshot '%s' is empty" % file_name)
+        try:
+            self.read_index()
+        except:
+            self.map.close()
+            raise
+        self.records = None
+        self.decoded = {}
+
+    def read_index(self):
+        if len(self.map) < HEADER.size:
+            raise SnapshotError("'%s' is not a snapshot" % self.file_name)
+        magic, version, index_length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise SnapshotError("'%s' is not a snapshot" % self.file_name)
+        if version != VERSION:
+            raise SnapshotError("snapshot '%s' has unsupported version %d" %
+                                (self.file_name, version))
+        start = HEADER.size + index_length
+        index = json.loads(self.map[HEADER.size:start].decode('utf-8'))
+        self.record_count = index['records']
+        self.metadata = index['metadata']
+        self.columns = dict((column['name'], column)
+                            for column in index['columns'])
+        self.data_start = start
+
+    def close(self):
+        self.map.close()
+
+    def get_field_names(self):
+        """Return the names of the fields of the records.
+
+        Unlike the exporters, a snapshot knows its fields in advance, even
+        when it has no records.
+
+        """
+        return sorted(self.columns.keys())
+
+    def get_record_count(self):
+        return self.record_count
+
+    def get_column(self, field_name):
+        """Return the list of the values of the given field of each record.
+
+        The value of a record that has no value for the field is MISSING. The
+        snapshot decodes each column once.
+
+        """
+        values = self.decoded.get(field_name)
+        if values is None:
+            column = self.columns[field_name]
+            start = self.data_start + column['offset']
+            data = zlib.decompress(self.map[start:start + column['length']])
+            values = decode_column(column['type'], data, self.record_count)
+            self.decoded[field_name] = values
+        return values
+
+    def get_column_index(self, field_name):
+        """Return the index of the records by the given field.
+
+        The index is a dict that maps each value of the field to the indexes
+        of the records with that value. Only the column of the field is read
+        to build it.
+
+        """
+        if field_name not in self.columns:
+            return {}
+        return build_index(self.get_column(field_name))
+
+    def get_record(self, index):
+        """Return the record with the given index as a dict.
+
+        The first call decodes every column.
+
+        """
+        record = {}
+        for field_name in self.columns.keys():
+            value = self.get_column(field_name)[index]
+            if value is not MISSING:
+                record[field_name] = value
+        return record
+
+    def get_records(self):
+        """Return the records as a list of dicts."""
+        if self.records is None:
+            records = [{} for index in range(self.record_count)]
+            for field_name in self.columns.keys():
+                for record, value in zip(records,
+                                         self.get_column(field_name)):
+                    if value is not MISSING:
+                        record[field_name] = value
+            self.records = records
+        return self.records
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import os
+import shutil
+import tempfile
+
+from decimal import Decimal
+from unittest import TestCase
+
+from lizard_validation.snapshots import Snapshot
+from lizard_validation.snapshots import SnapshotError
+from lizard_validation.snapshots import get_column_type
+from lizard_validation.snapshots import snapshot_path
+from lizard_validation.snapshots import write_snapshot
+
+
+class SnapshotTestSuite(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'test.snapshot')
+        self.records = [
+            {'GAFIDENT': u'3201', 'DIEPTE': 1.17, 'ID': 1, 'ACTIEF': True,
+             'MAX': Decimal('2.5'), 'OPMERKING': None},
+            {'GAFIDENT': u'3202', 'DIEPTE': 0.0, 'ID': 0, 'ACTIEF': False,
+             'MAX': None, 'OPMERKING': u'één'},
+            {'GAFIDENT': u'3203'},
+            ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        snapshot = Snapshot(self.file_name)
+        try:
+            return snapshot.get_records()
+        finally:
+            snapshot.close()
+
+    def test_a(self):
+        """Test the records read are the records written."""
+        write_snapshot(self.file_name, self.records)
+        self.assertEqual(self.records, self.load())
+
+    def test_b(self):
+        """Test the field names are known without records."""
+        write_snapshot(self.file_name, [])
+        snapshot = Snapshot(self.file_name)
+        self.assertEqual([], snapshot.get_field_names())
+        self.assertEqual([], snapshot.get_records())
+        snapshot.close()
+
+    def test_c(self):
+        """Test a single column is read."""
+        write_snapshot(self.file_name, self.records, data_set=u'Waternet')
+        snapshot = Snapshot(self.file_name)
+        self.assertEqual([1.17, 0.0], snapshot.get_column('DIEPTE')[:2])
+        self.assertEqual(u'Waternet', snapshot.metadata['data_set'])
+        snapshot.close()
+
+    def test_d(self):
+        """Test a file that is not a snapshot is refused."""
+        with open(self.file_name, 'wb') as snapshot:
+            snapshot.write('GAFIDENT,DIEPTE\n'.encode('ascii'))
+        self.assertRaises(SnapshotError, Snapshot, self.file_name)
+
+    def test_e(self):
+        """Test a snapshot is smaller than its pickled records."""
+        records = [{'ID_GW': u'3201-DGW-%d' % i, 'GEBIED_GW': u'3201',
+                    'OPPERVL': 1000.0 * i} for i in range(1000)]
+        write_snapshot(self.file_name, records)
+        self.assertTrue(os.path.getsize(self.file_name) < 40000)
+
+
+class ColumnTypeTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the types of the columns of a single type."""
+        self.assertEqual(['int', 'float', 'bool', 'text'],
+                         [get_column_type([1, 2]), get_column_type([1.0]),
+                          get_column_type([True]), get_column_type([u'a'])])
+
+    def test_b(self):
+        """Test the columns of mixed or other types are pickled."""
+        self.assertEqual(['pickle', 'pickle', 'pickle'],
+                         [get_column_type([1, 1.0]),
+                          get_column_type([Decimal('1')]),
+                          get_column_type([2 ** 64])])
+
+
+class SnapshotPathTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the path does not contain unsafe characters."""
+        self.assertEqual(os.path.join('var', 'Water_net-esf1-2012-05-01.snapshot'),
+                         snapshot_path('var', 'Water net', 'esf1', '2012-05-01'))
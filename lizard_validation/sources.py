@@ -0,0 +1,801 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements the sources from which configurations are retrieved.
+
+A source opens the records of a configuration, for example the records of a
+DBF file or the records exported from the database. Each source is registered
+by name in a SourceRegistry. The comparers refer to their sources by name so
+the sources, and the handles and caches they hold, are shared by all the
+comparers and requests of a process.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from lizard_validation import backends
+from lizard_validation import instrumentation
+from lizard_validation import versions
+from lizard_validation.normalization import create_normalizer
+from lizard_validation.planner import IndexedRecords
+from lizard_validation.planner import build_index
+from lizard_validation.snapshots import SNAPSHOT_DIR
+from lizard_validation.snapshots import Snapshot
+from lizard_validation.snapshots import snapshot_path
+from lizard_validation.snapshots import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds the records exported from the database remain cached.
+EXPORT_CACHE_TIMEOUT = \
+    getattr(settings, 'LIZARD_VALIDATION_EXPORT_CACHE_TIMEOUT', 60)
+
+# Maximum number of DBF files the DbfPool keeps open.
+MAX_OPEN_DBFS = getattr(settings, 'LIZARD_VALIDATION_MAX_OPEN_DBFS', 16)
+
+
+class DbfWrapper(object):
+    """Implements a wrapper around a single DBF file.
+
+    This class uses dbfpy to implement access to the DBF, which it loads on
+    first use."""
+
+    def __init__(self, file_name):
+        """Open the DBF with the given name.
+
+        This method uses dbfpy.dbf.Dbf to open the DBF. That method raises an
+        IOError when the DBGF cannot be opened, which this method reraises.
+
+        """
+        instrumentation.count('dbf_open')
+        self.file_name = file_name
+        try:
+            self.dbf = backends.get('dbf')(file_name, readOnly=True)
+        except IOError:
+            logger.warning("configuration file '%s' cannot be opened", file_name)
+            raise
+
+    def close(self):
+        """Close the DBF."""
+        self.dbf.close()
+
+    def get_field_names(self):
+        """Return the names of the fields as specified by the DBF header."""
+        return self.dbf.fieldNames
+
+    def get_record_count(self):
+        """Return the number of records as specified by the DBF header."""
+        return len(self.dbf)
+
+    def get_field_types(self):
+        """Return the name, type code and decimal count of each field."""
+        return [(field.name, field.typeCode, field.decimalCount)
+                for field in self.dbf.header.fields]
+
+    def get_language_driver_id(self):
+        """Return the byte of the DBF header that specifies the code page.
+
+        dbfpy does not read this byte, so this method reads it from the file.
+
+        """
+        dbf_file = open(self.file_name, 'rb')
+        try:
+            dbf_file.seek(29)
+            byte = dbf_file.read(1)
+        finally:
+            dbf_file.close()
+        if byte:
+            return ord(byte)
+        return None
+
+    def get_record(self, index):
+        """Return the record with the given index as a dict."""
+        return self.dbf[index].asDict()
+
+    def get_records(self):
+        """Return the records of the open DBF.
+
+        This method returns each record as a dict that maps attribute name to
+        attribute value.
+
+        """
+        for record in self.dbf:
+            yield record.asDict()
+
+
+class DbfHandle(object):
+    """Implements a DBF that is shared by the users of a DbfPool.
+
+    The handle reads the header of the DBF once. As the users of a handle can
+    be in different threads, the handle reads each record under a lock.
+
+    """
+    def __init__(self, file_name, file_stat):
+        self.file_name = file_name
+        self.file_stat = file_stat
+        self.dbf = DbfWrapper(file_name)
+        self.field_names = self.dbf.get_field_names()
+        self.record_count = self.dbf.get_record_count()
+        self.lock = threading.Lock()
+        self.ref_count = 0
+        self.use_count = 0
+        self.stale = False
+        self.last_used = time.time()
+        self.normalizer = None
+        self.indexes = {}
+        self.index_lock = threading.Lock()
+
+    def get_normalizer(self):
+        """Return the Normalizer of the fields of the DBF.
+
+        The handle creates the Normalizer when it is first requested.
+
+        """
+        if self.normalizer is None:
+            self.normalizer = create_normalizer(
+                self.dbf.get_field_types(), self.dbf.get_language_driver_id())
+        return self.normalizer
+
+    def get_record(self, index):
+        self.lock.acquire()
+        try:
+            return self.dbf.get_record(index)
+        finally:
+            self.lock.release()
+
+    def get_index(self, field_name):
+        """Return the index of the records by the given field.
+
+        The index is a dict that maps each value of the field to the indexes
+        of the records with that value. The handle builds the index when it
+        is first requested.
+
+        """
+        self.index_lock.acquire()
+        try:
+            index = self.indexes.get(field_name)
+            if index is None:
+                instrumentation.count('index_build')
+                index = build_index(self.get_record(record_index)[field_name]
+                                    for record_index
+                                    in range(self.record_count))
+                self.indexes[field_name] = index
+            return index
+        finally:
+            self.index_lock.release()
+
+    def close(self):
+        self.dbf.close()
+
+
+class PooledDbfWrapper(IndexedRecords):
+    """Implements the interface of a DbfWrapper around a DbfHandle.
+
+    Closing the wrapper returns the handle to its pool, which keeps the DBF
+    open for the next user.
+
+    """
+    def __init__(self, pool, handle):
+        self.pool = pool
+        self.handle = handle
+
+    def close(self):
+        if self.handle is not None:
+            self.pool.release(self.handle)
+            self.handle = None
+
+    def get_field_names(self):
+        return self.handle.field_names
+
+    def get_normalizer(self):
+        return self.handle.get_normalizer()
+
+    def get_record_count(self):
+        return self.handle.record_count
+
+    def get_file_size(self):
+        if self.handle.file_stat is None:
+            return None
+        return self.handle.file_stat[1]
+
+    def get_use_count(self):
+        return self.handle.use_count
+
+    def has_index(self, field_name):
+        return field_name in self.handle.indexes
+
+    def get_index(self, field_name):
+        return self.handle.get_index(field_name)
+
+    def get_record(self, index):
+        return self.handle.get_record(index)
+
+    def get_records(self):
+        handle = self.handle
+        for index in range(handle.record_count):
+            yield handle.get_record(index)
+
+
+class DbfPool(object):
+    """Implements a pool of reference-counted, open DBF files.
+
+    The pool shares a single handle between the users of the same DBF. When a
+    DBF is no longer used, the pool keeps it open but closes the least
+    recently used unused DBFs when more than max_open DBFs are open. When the
+    DBF has been modified since it was opened, the pool opens it again.
+
+    """
+    def __init__(self, max_open=None):
+        self.max_open = max_open
+        self.handles = {}
+        self.lock = threading.Lock()
+
+    def open(self, file_name):
+        """Return the PooledDbfWrapper of the DBF with the given name."""
+        return PooledDbfWrapper(self, self.acquire(file_name))
+
+    def acquire(self, file_name):
+        file_stat = get_file_stat(file_name)
+        self.lock.acquire()
+        try:
+            handle = self.handles.get(file_name)
+            if handle is not None and handle.file_stat != file_stat:
+                self.discard(handle)
+                handle = None
+            if handle is None:
+                handle = DbfHandle(file_name, file_stat)
+                self.handles[file_name] = handle
+            else:
+                instrumentation.count('dbf_reuse')
+            handle.ref_count += 1
+            handle.use_count += 1
+            handle.last_used = time.time()
+            self.shrink()
+            return handle
+        finally:
+            self.lock.release()
+
+    def release(self, handle):
+        self.lock.acquire()
+        try:
+            handle.ref_count -= 1
+            if handle.ref_count == 0 and handle.stale:
+                handle.close()
+            else:
+                self.shrink()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Close all DBFs that are not in use."""
+        self.lock.acquire()
+        try:
+            for handle in list(self.handles.values()):
+                self.discard(handle)
+        finally:
+            self.lock.release()
+
+    def discard(self, handle):
+        """Remove the given handle from the pool and close it when unused.
+
+        A handle that is still in use is closed when it is released.
+
+        """
+        del self.handles[handle.file_name]
+        handle.stale = True
+        if handle.ref_count == 0:
+            handle.close()
+
+    def shrink(self):
+        """Close the least recently used DBFs that are not in use until the
+        pool holds at most max_open DBFs."""
+        max_open = self.max_open
+        if max_open is None:
+            max_open = MAX_OPEN_DBFS
+        unused = sorted([handle for handle in self.handles.values()
+                         if handle.ref_count == 0],
+                        key=lambda handle: handle.last_used)
+        while len(self.handles) > max_open and unused:
+            self.discard(unused.pop(0))
+
+
+def data_set_key(data_set):
+    """Return the value that identifies the given data set."""
+    return getattr(data_set, 'pk', data_set)
+
+
+def get_file_stat(file_name):
+    """Return the modification time and size of the given file.
+
+    When the file does not exist, this function returns None.
+
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+dbf_pool = DbfPool()
+
+
+class DatabaseWrapper(object):
+    """Implements a wrapper around the database to retrieve configurations.
+
+    This wrapper is implemented to retrieve ESF configurations.
+
+    """
+    def __init__(self, config):
+        """Set the configuration to specify the records to retrieve.
+
+        The given config is a ConfigurationToValidate.
+
+        """
+        self.config = config
+        self.records = None
+
+    def close(self):
+        pass
+
+    def get_field_names(self):
+        """Return the names of the fields of the exported records.
+
+        The exporter does not specify its fields in advance so this method
+        returns the field names of the first record. If there are no records,
+        this method returns None.
+
+        """
+        records = self.get_records()
+        if records:
+            return records[0].keys()
+        return None
+
+    def get_records(self):
+        """Return the records from the given configuration.
+
+        This method returns each record as a dict that maps attribute name to
+        attribute value.
+
+        Although the configuration also specifies the area, this method
+        disregards that information and returns all records with the specified
+        (configuration) data set and type. The reason for this is that the code
+        used to retrieve the records, and which is used 'as is', only considers
+        the data set and type.
+
+        """
+        if self.records is None:
+            exporter = backends.get('esf_exporter')()
+            dbf_file = backends.get('esf_dbf_file').objects.get(
+                name=self.config.config_type)
+            exporter.export_esf_configurations(self.config.data_set,
+                "don't care", dbf_file, "don't care")
+            self.records = exporter.out
+        return self.records
+
+
+class WaterbalanceFromDatabaseRetriever(object):
+    """Implements a wrapper around the database to retrieve configurations.
+
+    This wrapper is implemented to retrieve water balance configurations.
+
+    """
+
+    def __init__(self, export_method_name, config):
+        """Specifies which configuration records should be retrieved."""
+        self.export_method_name = export_method_name
+        self.config = config
+        self.records = None
+
+    def close(self):
+        pass
+
+    def get_field_names(self):
+        """Return the names of the fields of the exported records.
+
+        The exporter does not specify its fields in advance so this method
+        returns the field names of the first record. If there are no records,
+        this method returns None.
+
+        """
+        records = self.get_records()
+        if records:
+            return records[0].keys()
+        return None
+
+    def get_records(self):
+        """Return the records from the given configuration.
+
+        This method returns each record as a dict that maps attribute name to
+        attribute value.
+
+        Although the configuration also specifies the area, this method
+        disregards that information and returns all records with the specified
+        (configuration) data set and type. The reason for this is that the code
+        used to retrieve the records, and which is used 'as is', only considers
+        the data set and type.
+
+        """
+        if self.records is None:
+            exporter = backends.get('wb_exporter')()
+            export = getattr(exporter, self.export_method_name)
+            export(self.config.data_set, "don't care", "don't care")
+            self.records = exporter.out
+        return self.records
+
+
+class RecordsWrapper(IndexedRecords):
+    """Implements a wrapper around records that have already been retrieved.
+
+    The records can be shared with other wrappers through a CachedRecords, in
+    which case the wrappers also share the indexes of the records.
+
+    """
+    def __init__(self, records):
+        if not isinstance(records, CachedRecords):
+            records = CachedRecords(records)
+        self.cached = records
+        self.records = records.records
+
+    def close(self):
+        pass
+
+    def get_field_names(self):
+        if self.records:
+            return self.records[0].keys()
+        return None
+
+    def get_record_count(self):
+        return len(self.records)
+
+    def get_use_count(self):
+        return self.cached.use_count
+
+    def has_index(self, field_name):
+        return field_name in self.cached.indexes
+
+    def get_index(self, field_name):
+        """Return the index of the records by the given field, see
+        DbfHandle.get_index."""
+        index = self.cached.indexes.get(field_name)
+        if index is None:
+            instrumentation.count('index_build')
+            index = build_index(record.get(field_name)
+                                for record in self.records)
+            self.cached.indexes[field_name] = index
+        return index
+
+    def get_record(self, index):
+        return self.records[index]
+
+    def get_records(self):
+        return self.records
+
+
+class CachedRecords(object):
+    """Implements the records kept by a source for later retrievals.
+
+    Apart from the records, it holds the time they were retrieved, the number
+    of times they have been opened and their indexes.
+
+    """
+    def __init__(self, records, use_count=1):
+        self.created = time.time()
+        self.records = records
+        self.use_count = use_count
+        self.indexes = {}
+
+
+class Source(object):
+    """Implements the interface of a source of configuration records."""
+
+    def open(self, config):
+        """Return the open database of the records of the given configuration.
+
+        The open database has the methods get_field_names, get_records and
+        close, such as a DbfWrapper.
+
+        """
+        raise NotImplementedError
+
+    def reset(self, data_set=None):
+        """Release the handles and caches of this source.
+
+        When a data set is given, only the caches of that data set are
+        released.
+
+        """
+        pass
+
+
+class DbfSource(Source):
+    """Implements the source of the records of a DBF of a configuration.
+
+    The DBF is specified by the name of the attribute of the configuration
+    that holds its path, for example 'area_dbf'. When a configuration is given
+    on construction, the DBF is always taken from that configuration. The DBF
+    is opened through a DbfPool, by default the pool shared by all sources.
+
+    """
+    def __init__(self, attr_name, config=None, pool=None):
+        self.attr_name = attr_name
+        self.config = config
+        self.pool = pool or dbf_pool
+
+    def open(self, config):
+        return self.pool.open(getattr(self.config or config, self.attr_name))
+
+    def reset(self, data_set=None):
+        if data_set is None:
+            self.pool.clear()
+
+
+class ExportSource(Source):
+    """Implements the source of the records exported from the database.
+
+    An exporter retrieves all records of a data set, regardless of the area.
+    This class caches the exported records for EXPORT_CACHE_TIMEOUT seconds
+    so the comparisons of the other areas of the data set can reuse them.
+    When it caches new records, it removes the records that have expired and
+    the records that the new records supersede.
+
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def open(self, config):
+        key = self.cache_key(config)
+        timeout = self.timeout
+        if timeout is None:
+            timeout = EXPORT_CACHE_TIMEOUT
+        self.lock.acquire()
+        try:
+            cached = self.cache.get(key)
+        finally:
+            self.lock.release()
+        if cached is not None and time.time() - cached.created < timeout:
+            instrumentation.count('export_cache_hit')
+            cached.use_count += 1
+            return RecordsWrapper(cached)
+        instrumentation.count('export')
+        open_database = self.create_database(config)
+        records = open_database.get_records()
+        self.lock.acquire()
+        try:
+            self.evict(key, timeout)
+            self.cache[key] = CachedRecords(records)
+        finally:
+            self.lock.release()
+        return open_database
+
+    def evict(self, key, timeout):
+        """Remove the cached records that have expired or that have the same
+        data set and export as the records with the given key.
+
+        The records of an older version of a data set are never retrieved
+        again once a version has been bumped, possibly by another process, so
+        they are removed as soon as the records of the new version are
+        cached. The caller should hold the lock.
+
+        """
+        now = time.time()
+        for cached_key, cached in list(self.cache.items()):
+            if cached_key[:2] == key[:2] or now - cached.created >= timeout:
+                del self.cache[cached_key]
+
+    def reset(self, data_set=None):
+        """Remove the cached records of the given data set.
+
+        When no data set is given, this method removes all cached records.
+
+        """
+        self.lock.acquire()
+        try:
+            for key in list(self.cache.keys()):
+                if data_set is None or key[0] == data_set:
+                    del self.cache[key]
+        finally:
+            self.lock.release()
+
+    def cache_key(self, config):
+        """Return the key of the cached records of the given configuration.
+
+        The first element of the key is the data set of the configuration. The
+        key also contains the versions of the data set, which are bumped when
+        a configuration of the data set is changed by any process.
+
+        """
+        return (config.data_set, config.config_type,
+                versions.get('data_set'),
+                versions.get('data_set', data_set_key(config.data_set)))
+
+    def create_database(self, config):
+        raise NotImplementedError
+
+    def get_export_name(self, config):
+        """Return the name of the export of the given configuration.
+
+        All configurations of a data set with the same export name share
+        their exported records.
+
+        """
+        raise NotImplementedError
+
+
+class EsfExportSource(ExportSource):
+    """Implements the source of the ESF records exported from the database."""
+
+    def create_database(self, config):
+        return DatabaseWrapper(config)
+
+    def get_export_name(self, config):
+        return config.config_type
+
+
+class WbExportSource(ExportSource):
+    """Implements the source of the water balance records exported from the
+    database by the given export method of a WbExporterToDict."""
+
+    def __init__(self, export_method_name, timeout=None):
+        ExportSource.__init__(self, timeout)
+        self.export_method_name = export_method_name
+
+    def create_database(self, config):
+        return WaterbalanceFromDatabaseRetriever(self.export_method_name,
+                                                 config)
+
+    def get_export_name(self, config):
+        return self.export_method_name
+
+
+class SnapshotSource(Source):
+    """Implements the source of the records of a snapshot of an export.
+
+    The snapshot holds the records that the export source with the given name
+    exported from the database when the snapshot was written. Each snapshot
+    has a label, for example the date it was written, and the snapshot with
+    label 'latest' is the one written last.
+
+    The first time a snapshot is opened, this source returns the Snapshot
+    itself, which supports the columnar read of the records of a single area.
+    When it is opened again, this source loads all its records and keeps them
+    until the snapshot file changes.
+
+    """
+    def __init__(self, export_source_name, label='latest', directory=None,
+                 sources=None):
+        self.export_source_name = export_source_name
+        self.label = label
+        self.directory = directory
+        self.sources = sources or registry
+        self.cache = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def open(self, config):
+        file_name = self.get_file_name(config)
+        stat = get_file_stat(file_name)
+        self.lock.acquire()
+        try:
+            cached = self.cache.get(file_name)
+            first_open = self.opened.get(file_name) != stat
+            self.opened[file_name] = stat
+        finally:
+            self.lock.release()
+        if cached is not None and cached[0] == stat:
+            instrumentation.count('snapshot_cache_hit')
+            cached[1].use_count += 1
+            return RecordsWrapper(cached[1])
+        instrumentation.count('snapshot_load')
+        try:
+            snapshot = Snapshot(file_name)
+        except IOError:
+            logger.warning("snapshot '%s' cannot be opened", file_name)
+            raise
+        if first_open:
+            return snapshot
+        try:
+            records = CachedRecords(snapshot.get_records(), use_count=2)
+        finally:
+            snapshot.close()
+        self.lock.acquire()
+        try:
+            self.cache[file_name] = (stat, records)
+        finally:
+            self.lock.release()
+        return RecordsWrapper(records)
+
+    def reset(self, data_set=None):
+        """Remove the loaded records.
+
+        The snapshots do not change with the database, so this method ignores
+        the data set and only removes the loaded records when no data set is
+        given.
+
+        """
+        if data_set is None:
+            self.lock.acquire()
+            try:
+                self.cache.clear()
+                self.opened.clear()
+            finally:
+                self.lock.release()
+
+    def get_file_name(self, config):
+        """Return the path of the snapshot of the given configuration."""
+        export_source = self.sources.get(self.export_source_name)
+        return snapshot_path(self.directory or SNAPSHOT_DIR, config.data_set,
+                             export_source.get_export_name(config),
+                             self.label)
+
+    def write(self, config):
+        """Write the snapshot of the records of the given configuration.
+
+        This method exports the records from the database and returns the
+        path of the snapshot.
+
+        """
+        export_source = self.sources.get(self.export_source_name)
+        open_database = export_source.create_database(config)
+        try:
+            records = open_database.get_records()
+        finally:
+            open_database.close()
+        file_name = self.get_file_name(config)
+        directory = os.path.dirname(file_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_snapshot(file_name, records,
+                       data_set=u'%s' % (config.data_set,),
+                       export=export_source.get_export_name(config),
+                       label=self.label)
+        return file_name
+
+
+class SourceRegistry(object):
+    """Implements the registry of named sources."""
+
+    def __init__(self):
+        self.sources = {}
+
+    def register(self, name, source):
+        self.sources[name] = source
+
+    def get(self, name):
+        """Return the source with the given name.
+
+        When the given name is a Source instead of a name, this method returns
+        that Source.
+
+        """
+        if isinstance(name, Source):
+            return name
+        return self.sources[name]
+
+    def reset(self, **kwargs):
+        """Release the handles and caches of all the registered sources."""
+        for source in self.sources.values():
+            source.reset(**kwargs)
+
+
+registry = SourceRegistry()
+registry.register('area_dbf', DbfSource('area_dbf'))
+registry.register('grondwatergebieden_dbf', DbfSource('grondwatergebieden_dbf'))
+registry.register('pumpingstations_dbf', DbfSource('pumpingstations_dbf'))
+registry.register('esf_export', EsfExportSource())
+registry.register('wb_area_export', WbExportSource('export_areaconfiguration'))
+registry.register('wb_bucket_export',
+                  WbExportSource('export_bucketconfiguration'))
+registry.register('wb_structure_export',
+                  WbExportSource('export_structureconfiguration'))
+registry.register('esf_snapshot', SnapshotSource('esf_export'))
+registry.register('wb_area_snapshot', SnapshotSource('wb_area_export'))
+registry.register('wb_bucket_snapshot', SnapshotSource('wb_bucket_export'))
+registry.register('wb_structure_snapshot',
+                  SnapshotSource('wb_structure_export'))
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from lizard_validation import versions
+from lizard_validation.sources import DbfPool
+from lizard_validation.sources import DbfSource
+from lizard_validation.sources import ExportSource
+from lizard_validation.sources import SnapshotSource
+from lizard_validation.sources import SourceRegistry
+
+
+class ExportSourceTestSuite(TestCase):
+
+    def setUp(self):
+        self.source = ExportSource(timeout=60)
+        self.database = Mock()
+        self.database.get_records.return_value = [{'GAFIDENT': '3201'}]
+        self.source.create_database = Mock(return_value=self.database)
+        self.config = Mock()
+        self.config.data_set = 'Waternet'
+        self.config.config_type = 'waterbalans'
+
+    def test_a(self):
+        """Test the records of a data set are exported only once."""
+        self.source.open(self.config)
+        open_database = self.source.open(self.config)
+        self.assertEqual(1, self.source.create_database.call_count)
+        self.assertEqual([{'GAFIDENT': '3201'}], open_database.get_records())
+
+    def test_b(self):
+        """Test the records are exported again after a reset of the data set."""
+        self.source.open(self.config)
+        self.source.reset(data_set='Waternet')
+        self.source.open(self.config)
+        self.assertEqual(2, self.source.create_database.call_count)
+
+    def test_c(self):
+        """Test the records are not exported again after a reset of another
+        data set."""
+        self.source.open(self.config)
+        self.source.reset(data_set='HHNK')
+        self.source.open(self.config)
+        self.assertEqual(1, self.source.create_database.call_count)
+
+    def test_d(self):
+        """Test the records are exported again when the cache has expired."""
+        self.source.timeout = 0
+        self.source.open(self.config)
+        self.source.open(self.config)
+        self.assertEqual(2, self.source.create_database.call_count)
+
+    def test_e(self):
+        """Test the records of an older version of a data set are removed."""
+        self.source.open(self.config)
+        versions.bump('data_set', 'Waternet')
+        self.source.open(self.config)
+        self.assertEqual(2, self.source.create_database.call_count)
+        self.assertEqual(1, len(self.source.cache))
+
+    def test_f(self):
+        """Test the expired records of another data set are removed."""
+        self.source.open(self.config)
+        self.source.timeout = 0
+        other_config = Mock()
+        other_config.data_set = 'HHNK'
+        other_config.config_type = 'waterbalans'
+        self.source.open(other_config)
+        self.assertEqual(['HHNK'], [key[0] for key in self.source.cache])
+
+
+class SourceRegistryTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the retrieval of a source by name."""
+        registry = SourceRegistry()
+        source = DbfSource('area_dbf')
+        registry.register('area_dbf', source)
+        self.assertTrue(registry.get('area_dbf') is source)
+
+    def test_b(self):
+        """Test the retrieval of a source by the source itself."""
+        source = DbfSource('area_dbf')
+        self.assertTrue(SourceRegistry().get(source) is source)
+
+
+class SnapshotSourceTestSuite(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.export_source = ExportSource()
+        self.database = Mock()
+        self.database.get_records.return_value = [{'GAFIDENT': u'3201',
+                                                   'DIEPTE': 1.17}]
+        self.export_source.create_database = \
+            Mock(return_value=self.database)
+        self.export_source.get_export_name = Mock(return_value='esf1')
+        self.sources = SourceRegistry()
+        self.sources.register('esf_export', self.export_source)
+        self.source = SnapshotSource('esf_export', directory=self.directory,
+                                     sources=self.sources)
+        self.config = Mock()
+        self.config.data_set = 'Waternet'
+        self.config.config_type = 'esf1'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a(self):
+        """Test the records of a snapshot are the exported records."""
+        self.source.write(self.config)
+        open_database = self.source.open(self.config)
+        self.assertEqual([{'GAFIDENT': u'3201', 'DIEPTE': 1.17}],
+                         open_database.get_records())
+
+    def test_b(self):
+        """Test a snapshot does not export the records."""
+        self.source.write(self.config)
+        self.source.open(self.config)
+        self.assertEqual(1, self.export_source.create_database.call_count)
+
+    def test_c(self):
+        """Test the snapshot with another label is another file."""
+        self.source.write(self.config)
+        other_source = SnapshotSource('esf_export', '2012-05-01',
+                                      self.directory, self.sources)
+        self.assertNotEqual(self.source.get_file_name(self.config),
+                            other_source.get_file_name(self.config))
+        self.assertRaises(IOError, other_source.open, self.config)
+
+    def test_d(self):
+        """Test a snapshot is loaded again when it has been rewritten."""
+        self.source.write(self.config)
+        self.source.open(self.config)
+        self.database.get_records.return_value = []
+        self.source.write(self.config)
+        self.assertEqual([], self.source.open(self.config).get_records())
+
+
+class DbfPoolTestSuite(TestCase):
+
+    def setUp(self):
+        self.pool = DbfPool(max_open=2)
+        self.opened = []
+        self.patcher = patch('lizard_validation.sources.DbfWrapper',
+                             self.open_dbf)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def open_dbf(self, file_name):
+        records = [{'GAFIDENT': '3201'}, {'GAFIDENT': '3202'}]
+        dbf = Mock()
+        dbf.get_field_names = lambda: ['GAFIDENT']
+        dbf.get_record_count = lambda: len(records)
+        dbf.get_record = lambda index: records[index]
+        self.opened.append(file_name)
+        return dbf
+
+    def test_a(self):
+        """Test consecutive users of a DBF share a single open DBF."""
+        self.pool.open('aanafvoer.dbf').close()
+        open_dbf = self.pool.open('aanafvoer.dbf')
+        self.assertEqual(['aanafvoer.dbf'], self.opened)
+        self.assertEqual([{'GAFIDENT': '3201'}, {'GAFIDENT': '3202'}],
+                         list(open_dbf.get_records()))
+
+    def test_b(self):
+        """Test simultaneous users of a DBF share a single open DBF."""
+        first = self.pool.open('aanafvoer.dbf')
+        second = self.pool.open('aanafvoer.dbf')
+        self.assertTrue(first.handle is second.handle)
+        self.assertEqual(2, first.handle.ref_count)
+
+    def test_c(self):
+        """Test the least recently used DBF is closed when too many are open."""
+        for file_name in ['a.dbf', 'b.dbf', 'c.dbf']:
+            self.pool.open(file_name).close()
+        self.assertEqual(['b.dbf', 'c.dbf'], sorted(self.pool.handles.keys()))
+
+    def test_d(self):
+        """Test a DBF that is in use is not closed."""
+        open_dbf = self.pool.open('a.dbf')
+        for file_name in ['b.dbf', 'c.dbf']:
+            self.pool.open(file_name).close()
+        self.assertTrue('a.dbf' in self.pool.handles)
+        self.assertFalse(open_dbf.handle.dbf.close.called)
+
+    def test_e(self):
+        """Test a modified DBF is opened again."""
+        with patch('lizard_validation.sources.get_file_stat',
+                   Mock(return_value=(1.0, 100))):
+            self.pool.open('aanafvoer.dbf').close()
+        with patch('lizard_validation.sources.get_file_stat',
+                   Mock(return_value=(2.0, 100))):
+            self.pool.open('aanafvoer.dbf').close()
+        self.assertEqual(['aanafvoer.dbf', 'aanafvoer.dbf'], self.opened)
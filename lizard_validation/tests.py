@@ -1,9 +1,565 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+import json
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save
+from django.http import Http404
 from django.test import TestCase
 
+from mock import Mock
+from mock import patch
+
+from lizard_area.models import Area
+from lizard_portal.models import ConfigurationToValidate
+from lizard_validation import configurations
+from lizard_validation import field_index
+from lizard_validation import instrumentation
+from lizard_validation import jobs
+from lizard_validation import revalidation
+from lizard_validation import versions
+from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.config_comparer import MissingFieldsError
+from lizard_validation.sources import DatabaseWrapper
+from lizard_validation.sources import WaterbalanceFromDatabaseRetriever
+from lizard_validation.sources import registry
+from lizard_validation.views import esf_field_translator
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Maximum number of seconds each stage of a diff page may take for the
+# fixture data.
+STAGE_BUDGET = 1.0
+
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEquals(1, 1)
+
+
+class ConfigurationsTestSuite(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.config = ConfigurationToValidate(config_type='waterbalans')
+        self.config.area = Area(name='Aetsveldse polder Oost')
+
+    def test_a(self):
+        """Test a configuration is retrieved from the database only once."""
+        with patch.object(ConfigurationToValidate, 'objects') as objects:
+            objects.select_related().get.return_value = self.config
+            configurations.get_configuration('Aetsveldse polder Oost',
+                                             'waterbalans')
+            config = configurations.get_configuration('Aetsveldse polder Oost',
+                                                      'waterbalans')
+        self.assertEqual(1, objects.select_related().get.call_count)
+        self.assertEqual('waterbalans', config.config_type)
+
+    def test_b(self):
+        """Test a configuration is retrieved again after an invalidation."""
+        with patch.object(ConfigurationToValidate, 'objects') as objects:
+            objects.select_related().get.return_value = self.config
+            configurations.get_configuration('Aetsveldse polder Oost',
+                                             'waterbalans')
+            configurations.invalidate()
+            configurations.get_configuration('Aetsveldse polder Oost',
+                                             'waterbalans')
+        self.assertEqual(2, objects.select_related().get.call_count)
+
+    def test_c(self):
+        """Test the retrieval of an unknown configuration."""
+        self.assertRaises(Http404, configurations.get_configuration,
+                          'Aetsveldse polder Oost', 'esf1')
+
+    def test_d(self):
+        """Test an evicted generation does not make an older key valid."""
+        with patch.object(ConfigurationToValidate, 'objects') as objects:
+            objects.select_related().get.return_value = self.config
+            with patch.object(versions, 'initial_value',
+                              Mock(side_effect=[1000, 2000])):
+                configurations.get_configuration('Aetsveldse polder Oost',
+                                                 'waterbalans')
+                key = configurations.cache_key('Aetsveldse polder Oost',
+                                               'waterbalans')
+                config = cache.get(key)
+                configurations.invalidate()
+                # Evict the generation but not the obsolete configuration.
+                cache.clear()
+                cache.set(key, config)
+                configurations.get_configuration('Aetsveldse polder Oost',
+                                                 'waterbalans')
+        self.assertEqual(2, objects.select_related().get.call_count)
+
+    def test_e(self):
+        """Test a configuration is retrieved again after an area is saved."""
+        with patch.object(ConfigurationToValidate, 'objects') as objects:
+            objects.select_related().get.return_value = self.config
+            configurations.get_configuration('Aetsveldse polder Oost',
+                                             'waterbalans')
+            post_save.send(sender=Area, instance=self.config.area,
+                           created=False)
+            configurations.get_configuration('Aetsveldse polder Oost',
+                                             'waterbalans')
+        self.assertEqual(2, objects.select_related().get.call_count)
+
+
+class ViewBudgetTestSuite(TestCase):
+    """Tests the cost of the diff pages for fixture data of known size.
+
+    The fixture DBFs contain 2 areas, 11 buckets and 6 structures. The records
+    from the database are replaced by copies of the DBF records with a single
+    different value and the configuration is not looked up, so the page tests
+    only measure the cost of the code in this application. The cost of the
+    real lookup of the configuration and the number of exports of the
+    database, which run the queries of the exporters, are tested separately.
+
+    """
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.config = Mock()
+        self.config.area.name = 'Aetsveldse'
+        self.config.area.ident = '3201'
+        self.config.area_dbf = \
+            os.path.join(FIXTURES_DIR, 'aanafvoer_waterbalans.dbf')
+        self.config.grondwatergebieden_dbf = \
+            os.path.join(FIXTURES_DIR, 'grondwatergebieden.dbf')
+        self.config.pumpingstations_dbf = \
+            os.path.join(FIXTURES_DIR, 'pumpingstations.dbf')
+        self.current_records = {
+            'export_areaconfiguration':
+                [{'GAFIDENT': '3201', 'DIEPTE': 1.18}],
+            'export_bucketconfiguration':
+                [{'ID_GW': '3201-DGW-%d' % i, 'GEBIED_GW': '3201',
+                  'OPPERVL': 1000.0 * i + 1} for i in range(1, 11)],
+            'export_structureconfiguration':
+                [{'ID': '3201-PS-%d' % i, 'GEBIED': '3201',
+                  'CAPACITEIT': 0.5 * i + 1} for i in range(1, 6)],
+            }
+
+    def get_page(self, config_type):
+        self.config.config_type = config_type
+        current_records = self.current_records
+        def get_wb_records(retriever):
+            return current_records[retriever.export_method_name]
+        with patch('lizard_validation.views.get_configuration',
+                   Mock(return_value=self.config)):
+            with patch.object(WaterbalanceFromDatabaseRetriever,
+                              'get_records', get_wb_records):
+                with patch.object(DatabaseWrapper, 'get_records',
+                                  lambda wrapper: [{'GAFIDENT': '3201',
+                                                    'DIEPTE': 1.18}]):
+                    response = self.client.get(
+                        '/diff/Aetsveldse/%s' % config_type)
+        self.assertEqual(200, response.status_code)
+        return response
+
+    def assert_stages_within_budget(self):
+        for stage_name, seconds in instrumentation.last().timings.items():
+            self.assertTrue(seconds < STAGE_BUDGET,
+                            "stage '%s' took %.3fs" % (stage_name, seconds))
+
+    def test_a(self):
+        """Test the number of queries of the waterbalans diff page."""
+        self.assertNumQueries(0, self.get_page, 'waterbalans')
+
+    def test_b(self):
+        """Test the number of DBF opens of the waterbalans diff page."""
+        self.get_page('waterbalans')
+        self.assertEqual(3, instrumentation.last().counters['dbf_open'])
+
+    def test_c(self):
+        """Test the wall time of each stage of the waterbalans diff page."""
+        self.get_page('waterbalans')
+        self.assert_stages_within_budget()
+
+    def test_d(self):
+        """Test the number of queries of the ESF diff page."""
+        self.assertNumQueries(2, self.get_page, 'esf1')
+
+    def test_e(self):
+        """Test the number of DBF opens of the ESF diff page."""
+        self.get_page('esf1')
+        self.assertEqual(1, instrumentation.last().counters['dbf_open'])
+
+    def test_f(self):
+        """Test the wall time of each stage of the ESF diff page."""
+        self.get_page('esf1')
+        self.assert_stages_within_budget()
+
+    def test_g(self):
+        """Test the ESF diff page reports its queries in debug mode."""
+        with patch.object(settings, 'DEBUG', True):
+            response = self.get_page('esf1')
+        self.assertEqual('2', response['X-Query-Count'])
+
+    def test_h(self):
+        """Test the diff page does not report its queries otherwise."""
+        response = self.get_page('esf1')
+        self.assertFalse(response.has_header('X-Query-Count'))
+
+    def test_i(self):
+        """Test the real lookup of the configuration takes a single query.
+
+        The configuration does not exist in the test database, so the page is
+        not found.
+
+        """
+        responses = []
+        def get_page():
+            responses.append(self.client.get('/diff/Aetsveldse/waterbalans'))
+        self.assertNumQueries(1, get_page)
+        self.assertEqual(404, responses[0].status_code)
+
+    def test_j(self):
+        """Test the database is exported once for all areas of a data set."""
+        self.config.data_set = 'Waternet'
+        self.get_page('waterbalans')
+        self.config.area.ident = '3202'
+        self.get_page('waterbalans')
+        counters = instrumentation.last().counters
+        self.assertEqual((0, 3), (counters.get('export', 0),
+                                  counters.get('export_cache_hit', 0)))
+
+
+class EsfFieldTranslatorTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the number of queries does not depend on the number of fields."""
+        diff = dict(('FIELD%d' % i, (i, i + 1)) for i in range(50))
+        self.assertNumQueries(2, esf_field_translator, diff)
+
+
+class RevalidationTestSuite(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.config = Mock()
+        self.config.config_type = 'waterbalans'
+        self.config.area.ident = '3201'
+        self.config.data_set = 'Waternet'
+        self.config.area_dbf = \
+            os.path.join(FIXTURES_DIR, 'aanafvoer_waterbalans.dbf')
+        self.config.grondwatergebieden_dbf = \
+            os.path.join(FIXTURES_DIR, 'grondwatergebieden.dbf')
+        self.config.pumpingstations_dbf = \
+            os.path.join(FIXTURES_DIR, 'pumpingstations.dbf')
+        self.validate = Mock(
+            side_effect=lambda config, parts: dict((part, {}) for part in parts))
+        self.patcher = patch('lizard_validation.revalidation.validate',
+                             self.validate)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_sender(self, app_label, object_name):
+        sender = Mock()
+        sender._meta.app_label = app_label
+        sender._meta.object_name = object_name
+        return sender
+
+    def test_a(self):
+        """Test the differences of a configuration are computed only once."""
+        revalidation.get_result(self.config)
+        result = revalidation.get_result(self.config)
+        self.assertEqual(1, self.validate.call_count)
+        self.assertEqual({'area': {}, 'buckets': {}, 'structures': {}}, result)
+
+    def test_b(self):
+        """Test only the changed part of a configuration is computed again."""
+        revalidation.get_result(self.config)
+        bucket = Mock()
+        bucket.area.ident = '3201'
+        revalidation.record_change(
+            self.create_sender('lizard_wbconfiguration', 'Bucket'), bucket)
+        revalidation.get_result(self.config)
+        args, kwargs = self.validate.call_args
+        self.assertEqual(['buckets'], args[1])
+
+    def test_c(self):
+        """Test the change of another area does not affect the configuration."""
+        revalidation.get_result(self.config)
+        bucket = Mock()
+        bucket.area.ident = '3202'
+        bucket.data_set = 'HHNK'
+        revalidation.record_change(
+            self.create_sender('lizard_wbconfiguration', 'Bucket'), bucket)
+        revalidation.get_result(self.config)
+        self.assertEqual(1, self.validate.call_count)
+
+    def pop_touched(self, configs):
+        with patch.object(ConfigurationToValidate, 'objects') as objects:
+            objects.select_related.return_value = configs
+            with patch('lizard_validation.versions.is_shared',
+                       Mock(return_value=True)):
+                return revalidation.pop_touched_configurations()
+
+    def create_config(self, area_ident):
+        config = Mock()
+        config.config_type = 'waterbalans'
+        config.area.name = 'Area %s' % area_ident
+        config.area.ident = area_ident
+        return config
+
+    def test_d(self):
+        """Test the change of a model of another application is ignored."""
+        configs = [self.create_config('3201')]
+        self.pop_touched(configs)
+        revalidation.record_change(self.create_sender('auth', 'User'), Mock())
+        self.assertEqual([], self.pop_touched(configs))
+
+    def test_e(self):
+        """Test only the configurations of the touched areas are returned."""
+        configs = [self.create_config('3201'), self.create_config('3202')]
+        self.assertEqual(configs, self.pop_touched(configs))
+        bucket = Mock()
+        bucket.area.ident = '3201'
+        revalidation.record_change(
+            self.create_sender('lizard_wbconfiguration', 'Bucket'), bucket)
+        self.assertEqual(configs[:1], self.pop_touched(configs))
+        self.assertEqual([], self.pop_touched(configs))
+
+    def test_f(self):
+        """Test a change without area touches all configurations."""
+        configs = [self.create_config('3201'), self.create_config('3202')]
+        self.pop_touched(configs)
+        revalidation.touch('waterbalans', None, None, ('area',))
+        self.assertEqual(configs, self.pop_touched(configs))
+
+    def test_g(self):
+        """Test the touched configurations need a shared cache."""
+        self.assertFalse(versions.is_shared())
+        self.assertRaises(ImproperlyConfigured,
+                          revalidation.pop_touched_configurations)
+
+    def test_h(self):
+        """Test the differences are cached briefly without a shared cache."""
+        with patch('lizard_validation.revalidation.cache') as diff_cache:
+            diff_cache.get_many.return_value = {}
+            revalidation.get_result(self.config)
+            with patch('lizard_validation.versions.is_shared',
+                       Mock(return_value=True)):
+                revalidation.get_result(self.config)
+        self.assertEqual(
+            [revalidation.LOCAL_DIFF_CACHE_TIMEOUT,
+             revalidation.DIFF_CACHE_TIMEOUT],
+            [args[1] for args, kwargs in diff_cache.set_many.call_args_list])
+
+
+class AsyncDiffTestSuite(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.config = Mock()
+        self.config.area.name = 'Aetsveldse'
+        self.config.config_type = 'waterbalans'
+        self.result = {'area': {'3201': {'DIEPTE': (1.17, 1.18)}},
+                       'buckets': {}, 'structures': {}}
+        self.get_result = Mock(return_value=self.result)
+        self.patchers = [
+            patch('lizard_validation.jobs.get_configuration',
+                  Mock(return_value=self.config)),
+            patch('lizard_validation.jobs.get_result', self.get_result),
+            ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def submit(self):
+        response = self.client.get('/diff_async/Aetsveldse/waterbalans')
+        self.assertEqual(202, response.status_code)
+        return json.loads(response.content)
+
+    def test_a(self):
+        """Test the submission of a job returns its id and URL."""
+        state = self.submit()
+        jobs.queue.join()
+        self.assertEqual('pending', state['status'])
+        self.assertEqual('/diff_job/%s/' % state['job'], state['url'])
+
+    def test_b(self):
+        """Test the page of a job that is done shows the differences."""
+        state = self.submit()
+        jobs.queue.join()
+        response = self.client.get(state['url'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.result['area'], response.context['diff'])
+
+    def test_c(self):
+        """Test the page of a pending job returns its state."""
+        with patch('lizard_validation.jobs.queue', jobs.JobQueue(workers=0)):
+            state = self.submit()
+            response = self.client.get(state['url'])
+            self.assertEqual(202, response.status_code)
+            self.assertEqual('pending', json.loads(response.content)['status'])
+            self.assertEqual(state['job'], self.submit()['job'])
+
+    def test_d(self):
+        """Test the page of a job that has failed returns the error."""
+        self.get_result.side_effect = ValueError('broken DBF')
+        state = self.submit()
+        jobs.queue.join()
+        response = self.client.get(state['url'])
+        self.assertEqual(500, response.status_code)
+        self.assertEqual('broken DBF', json.loads(response.content)['error'])
+
+    def test_e(self):
+        """Test the page of a job reports the missing fields."""
+        self.get_result.side_effect = \
+            MissingFieldsError(self.config, 'area_dbf', ['GAFIDENT'])
+        state = self.submit()
+        jobs.queue.join()
+        response = self.client.get(state['url'])
+        self.assertEqual(['GAFIDENT'], response.context['missing_fields'])
+
+    def test_f(self):
+        """Test the page of an unknown job is not found."""
+        response = self.client.get('/diff_job/0123abcd/')
+        self.assertEqual(404, response.status_code)
+
+    def test_g(self):
+        """Test the diff is computed in the request when the queue is full."""
+        with patch('lizard_validation.jobs.JobQueue.submit',
+                   Mock(side_effect=jobs.QueueFull)):
+            with patch('lizard_validation.views.get_configuration',
+                       Mock(return_value=self.config)):
+                with patch('lizard_validation.views.get_result',
+                           Mock(return_value=self.result)):
+                    response = self.client.get(
+                        '/diff_async/Aetsveldse/waterbalans')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.result['area'], response.context['diff'])
+
+    def test_h(self):
+        """Test a job whose differences are too large to store fails."""
+        with patch('lizard_validation.jobs.MAX_STATE_SIZE', 100):
+            state = self.submit()
+            jobs.queue.join()
+        response = self.client.get(state['url'])
+        self.assertEqual(500, response.status_code)
+        self.assertEqual('the differences are too large to store',
+                         json.loads(response.content)['error'])
+
+    def test_i(self):
+        """Test a job whose differences the cache drops fails."""
+        cache_set = cache.set
+
+        def drop_result(key, value, *args, **kwargs):
+            if 'result' not in value:
+                cache_set(key, value, *args, **kwargs)
+
+        with patch.object(cache, 'set', drop_result):
+            state = self.submit()
+            jobs.queue.join()
+        response = self.client.get(state['url'])
+        self.assertEqual(500, response.status_code)
+        self.assertEqual('unable to store the state of the job',
+                         json.loads(response.content)['error'])
+
+
+class FieldIndexTestSuite(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.configs = [self.create_config('3201', 'Aetsveldse'),
+                        self.create_config('3202', 'Horstermeer')]
+        self.results = {
+            '3201': {'area': {'DIEPTE': (1.17, 1.18)},
+                     'buckets': {'3201-DGW-2': {'OPPERVL': (2.0, 3.0)},
+                                 '3201-DGW-1': {'OPPERVL': (1.0, 3.0)}},
+                     'structures': {}},
+            '3202': {'area': {}, 'buckets': {}, 'structures': {}},
+            }
+        validate = Mock(side_effect=lambda config, parts: dict(
+            (part, self.results[config.area.ident][part]) for part in parts))
+        self.patcher = patch('lizard_validation.revalidation.validate',
+                             validate)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def create_config(self, area_ident, area_name):
+        config = Mock()
+        config.config_type = 'waterbalans'
+        config.area.ident = area_ident
+        config.area.name = area_name
+        config.data_set = 'Waternet'
+        config.area_dbf = \
+            os.path.join(FIXTURES_DIR, 'aanafvoer_waterbalans.dbf')
+        config.grondwatergebieden_dbf = \
+            os.path.join(FIXTURES_DIR, 'grondwatergebieden.dbf')
+        config.pumpingstations_dbf = \
+            os.path.join(FIXTURES_DIR, 'pumpingstations.dbf')
+        return config
+
+    def search(self, field_name):
+        config_parts = [(config, part) for config in self.configs
+                        for part in ('area', 'buckets', 'structures')]
+        return field_index.search(field_name, config_parts)
+
+    def test_a(self):
+        """Test the records of a field are found once computed."""
+        for config in self.configs:
+            revalidation.get_result(config)
+        differences = self.search('OPPERVL')
+        self.assertEqual(
+            [('Aetsveldse', 'waterbalans', 'buckets', '3201-DGW-1'),
+             ('Aetsveldse', 'waterbalans', 'buckets', '3201-DGW-2')],
+            differences.records)
+        self.assertEqual([], differences.unindexed)
+
+    def test_b(self):
+        """Test the area record of a field is found."""
+        revalidation.get_result(self.configs[0])
+        self.assertEqual([('Aetsveldse', 'waterbalans', 'area', '')],
+                         self.search('DIEPTE').records)
+
+    def test_c(self):
+        """Test the configurations that have not been computed are reported."""
+        revalidation.get_result(self.configs[0])
+        self.assertEqual([('Horstermeer', 'waterbalans')],
+                         self.search('DIEPTE').unindexed)
+
+    def test_d(self):
+        """Test the configurations of a changed data set are not indexed."""
+        for config in self.configs:
+            revalidation.get_result(config)
+        revalidation.touch('waterbalans', '3201', 'Waternet', ('buckets',))
+        differences = self.search('OPPERVL')
+        self.assertEqual([], differences.records)
+        self.assertEqual([('Aetsveldse', 'waterbalans'),
+                          ('Horstermeer', 'waterbalans')],
+                         differences.unindexed)
+
+    def test_e(self):
+        """Test the index takes two cache requests."""
+        for config in self.configs:
+            revalidation.get_result(config)
+        with patch('lizard_validation.field_index.cache') as index_cache:
+            index_cache.get_many.return_value = {}
+            with patch('lizard_validation.versions.cache') as versions_cache:
+                versions_cache.get_many.return_value = {}
+                self.search('OPPERVL')
+        self.assertEqual(1, index_cache.get_many.call_count)
+        self.assertEqual(1, versions_cache.get_many.call_count)
+
+    def test_f(self):
+        """Test the fields of a record that is only in the database are
+        found."""
+        bucket = {'ID_GW': '3202-DGW-2', 'GEBIED_GW': '3202',
+                  'OPPERVL': 2000.0}
+        self.results['3202']['buckets'] = ConfigComparer().dict_compare(
+            {}, {'3202-DGW-2': bucket})
+        revalidation.get_result(self.configs[1])
+        self.assertEqual(
+            [('Horstermeer', 'waterbalans', 'buckets', '3202-DGW-2')],
+            self.search('OPPERVL').records)
@@ -12,8 +12,20 @@ urlpatterns = patterns(
     '',
     url(r'^admin/', include(admin.site.urls)),
 
+    url(r'^diff_async/(?P<area_name>.*)/(?P<config_type>.*)',
+        'lizard_validation.views.view_config_diff_async',
+        name="diff_async"),
+    url(r'^diff_job/(?P<job_id>[0-9a-f]+)/$',
+        'lizard_validation.views.view_diff_job',
+        name="diff_job"),
     url(r'^diff/(?P<area_name>.*)/(?P<config_type>.*)',
         'lizard_validation.views.view_config_diff',
         name="diff"),
+    url(r'^fields/(?P<field_name>[^/]+)/$',
+        'lizard_validation.views.view_field_differences',
+        name="field_differences"),
+    url(r'^statistics/$',
+        'lizard_validation.views.view_statistics',
+        name="statistics"),
     )
 urlpatterns += debugmode_urlpatterns()
@@ -0,0 +1,137 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+import copy
+import logging
+import os
+
+from lizard_validation import instrumentation
+from lizard_validation.config_comparer import COMPARISONS
+from lizard_validation.config_comparer import create_comparer
+from lizard_validation.config_comparer import create_snapshot_comparer
+from lizard_validation.config_comparer import create_upload_comparer
+from lizard_validation.sources import SnapshotSource
+from lizard_validation.sources import data_set_key
+from lizard_validation.sources import registry
+
+logger = logging.getLogger(__name__)
+
+# Parts of a water balance configuration in the order in which they are
+# validated.
+WB_PARTS = ('area', 'buckets', 'structures')
+
+# Maps each part of a configuration to the name of its comparison.
+WB_COMPARISONS = {'area': 'wb_area',
+                  'buckets': 'wb_bucket',
+                  'structures': 'wb_structure'}
+ESF_COMPARISONS = {'area': 'esf_area'}
+
+
+def validate(config, parts=None, snapshot=None, snapshot_dir=None,
+             previous_config=None):
+    """Return the differences of the given ConfigurationToValidate.
+
+    This function returns a dict that maps the name of each part of the
+    configuration to the dict of differences of that part. A water balance
+    configuration has the parts 'area', 'buckets' and 'structures', an ESF
+    configuration only has the part 'area'.
+
+    When parts are given, this function only validates those parts. When the
+    label of a snapshot is given, this function compares the configuration to
+    that snapshot of the database instead of to the database itself. The
+    snapshot is taken from the given directory or else from SNAPSHOT_DIR.
+
+    When a previous configuration is given, this function compares the DBFs
+    of the configuration to the DBFs of the previous configuration and does
+    not access the database at all, see get_previous_configuration.
+
+    This function raises a MissingFieldsError when the configuration does not
+    have the fields that identify its records.
+
+    """
+    comparisons = get_comparisons(config)
+    if parts is None:
+        parts = get_parts(config)
+    result = {}
+    for part in parts:
+        with instrumentation.stage(part):
+            if previous_config is not None:
+                comparer = create_upload_comparer(comparisons[part],
+                                                  previous_config)
+            elif snapshot is not None:
+                comparer = create_snapshot_comparer(comparisons[part],
+                                                    snapshot, snapshot_dir)
+            else:
+                comparer = create_comparer(comparisons[part])
+            result[part] = comparer.compare(config)
+    return result
+
+
+def get_comparisons(config):
+    """Return the dict that maps each part of the configuration to the name
+    of its comparison."""
+    if config.config_type == 'waterbalans':
+        return WB_COMPARISONS
+    return ESF_COMPARISONS
+
+
+def get_parts(config):
+    """Return the parts of the given configuration in validation order."""
+    if config.config_type == 'waterbalans':
+        return WB_PARTS
+    return ('area',)
+
+
+def get_previous_configuration(config, directory):
+    """Return the configuration of the previous upload of the given one.
+
+    The previous upload consists of the DBFs in the given directory that have
+    the same names as the DBFs of the given configuration. This function
+    returns a copy of the configuration that refers to those DBFs.
+
+    """
+    previous_config = copy.copy(config)
+    for comparison in get_comparisons(config).values():
+        attr_name = registry.get(COMPARISONS[comparison][1]).attr_name
+        file_name = os.path.basename(getattr(config, attr_name))
+        setattr(previous_config, attr_name, os.path.join(directory, file_name))
+    return previous_config
+
+
+def iter_differences(result):
+    """Yield each difference of the given result of validate.
+
+    This function yields each difference as a tuple of the part, the record
+    key, the field name, the new value and the current value. The record key
+    of the area part is the empty string.
+
+    """
+    for part, diff in sorted(result.items()):
+        if part == 'area':
+            records = [('', diff)]
+        else:
+            records = sorted(diff.items())
+        for key, record_diff in records:
+            for field_name, (new_value, current_value) in \
+                    sorted(record_diff.items()):
+                yield part, key, field_name, new_value, current_value
+
+
+def write_snapshots(configs, label='latest', directory=None):
+    """Write the snapshots of the database of the given configurations.
+
+    This function writes a snapshot of each export used by the given
+    configurations, once per data set, and returns the list of the paths of
+    the snapshots.
+
+    """
+    written = {}
+    for config in configs:
+        for comparison in get_comparisons(config).values():
+            current_source = COMPARISONS[comparison][2]
+            source = SnapshotSource(current_source, label, directory)
+            file_name = source.get_file_name(config)
+            if file_name not in written:
+                logger.debug("write snapshot '%s' of data set '%s'",
+                             file_name, data_set_key(config.data_set))
+                written[file_name] = source.write(config)
+    return sorted(written.values())
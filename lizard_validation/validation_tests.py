@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pylint: disable=C0111
+
+# Copyright (c) 2012 Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+
+import os
+
+from unittest import TestCase
+
+from django.utils.translation import ugettext as _
+
+from mock import Mock
+from mock import patch
+
+from lizard_validation.config_comparer import ConfigComparer
+from lizard_validation.sources import WaterbalanceFromDatabaseRetriever
+from lizard_validation.sources import registry
+from lizard_validation.validation import get_previous_configuration
+from lizard_validation.validation import iter_differences
+from lizard_validation.validation import validate
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class PreviousUploadTestSuite(TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.config = Mock()
+        self.config.config_type = 'waterbalans'
+        self.config.area.ident = '3201'
+        self.config.area_dbf = '/upload/new/aanafvoer_waterbalans.dbf'
+        self.config.grondwatergebieden_dbf = \
+            '/upload/new/grondwatergebieden.dbf'
+        self.config.pumpingstations_dbf = '/upload/new/pumpingstations.dbf'
+
+    def test_a(self):
+        """Test the previous upload refers to the DBFs in its directory."""
+        previous_config = get_previous_configuration(self.config,
+                                                     '/upload/previous')
+        self.assertEqual(
+            ['/upload/previous/aanafvoer_waterbalans.dbf',
+             '/upload/previous/grondwatergebieden.dbf',
+             '/upload/previous/pumpingstations.dbf'],
+            [previous_config.area_dbf, previous_config.grondwatergebieden_dbf,
+             previous_config.pumpingstations_dbf])
+        self.assertEqual('/upload/new/pumpingstations.dbf',
+                         self.config.pumpingstations_dbf)
+
+    def test_b(self):
+        """Test the previous upload is compared without the database."""
+        previous_config = get_previous_configuration(self.config,
+                                                     FIXTURES_DIR)
+        with patch.object(WaterbalanceFromDatabaseRetriever, 'get_records',
+                          Mock(side_effect=AssertionError('exported'))):
+            result = validate(previous_config, previous_config=previous_config)
+        self.assertEqual({'area': {}, 'buckets': {}, 'structures': {}},
+                         result)
+
+
+class IterDifferencesTestSuite(TestCase):
+
+    def test_a(self):
+        """Test the differences of an added and a removed bucket."""
+        result = {'area': {'DIEPTE': (1.17, 1.18)},
+                  'buckets': ConfigComparer().dict_compare(
+                      {'3201-DGW-1': {'OPPERVL': 1.0}},
+                      {'3201-DGW-2': {'OPPERVL': 2.0}})}
+        self.assertEqual(
+            [('area', '', 'DIEPTE', 1.17, 1.18),
+             ('buckets', '3201-DGW-1', 'OPPERVL', 1.0, _('not present')),
+             ('buckets', '3201-DGW-2', 'OPPERVL', _('not present'), 2.0)],
+            list(iter_differences(result)))
@@ -0,0 +1,76 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+
+"""Implements version counters that are shared by all processes.
+
+A version counter is identified by a sequence of names, for example the names
+('data_set', 3). Its value is kept in the Django cache so a counter bumped by
+one process is seen by all other processes. Cache keys that include the value
+of a counter become obsolete when the counter is bumped.
+
+This requires a cache backend that is shared by all processes, such as
+memcached. The local-memory cache, which is the default backend of Django, is
+private to each process: a counter bumped by one process is not seen by the
+others and a new process starts without counters. The users of the counters
+check is_shared to limit what they rely on in that case.
+
+A counter starts at the current time in milliseconds. In this way a counter
+that has been evicted from the cache does not return to a value it had
+before.
+
+"""
+
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Number of seconds a counter remains in the cache.
+VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def is_shared():
+    """Return whether the cache is shared by all processes."""
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def get(*names):
+    """Return the value of the counter with the given names."""
+    key = version_key(names)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, initial_value(), VERSION_TIMEOUT)
+        value = cache.get(key, 0)
+    return value
+
+
+def get_many(names_list):
+    """Return the values of the counters with the given sequences of names.
+
+    Unlike get, this function does not initialize the counters that are not
+    in the cache: it returns None for them.
+
+    """
+    keys = [version_key(names) for names in names_list]
+    values = cache.get_many(keys)
+    return [values.get(key) for key in keys]
+
+
+def bump(*names):
+    """Increment the counter with the given names."""
+    key = version_key(names)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, initial_value(), VERSION_TIMEOUT)
+
+
+def initial_value():
+    return int(time.time() * 1000)
+
+
+def version_key(names):
+    text = u'|'.join(u'%s' % (name,) for name in names)
+    digest = hashlib.md5(text.encode('utf-8'))
+    return 'lizard_validation.version.%s' % digest.hexdigest()
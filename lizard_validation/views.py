@@ -1,17 +1,24 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+import json
 import logging
 
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import Http404
+from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
-from lizard_esf.models import Configuration
-from lizard_portal.models import ConfigurationToValidate
-from lizard_validation.config_comparer import ConfigComparer
-from lizard_validation.config_comparer import create_wb_area_comparer
-from lizard_validation.config_comparer import create_wb_bucket_comparer
-from lizard_validation.config_comparer import create_wb_structure_comparer
+from lizard_validation import backends
+from lizard_validation import instrumentation
+from lizard_validation import jobs
+from lizard_validation.config_comparer import MissingFieldsError
+from lizard_validation.configurations import get_configuration
+from lizard_validation.diff_statistics import compute_statistics
+from lizard_validation.field_index import find_differences
+from lizard_validation.revalidation import get_result
 
 logger = logging.getLogger(__name__)
 
@@ -24,19 +31,26 @@ def esf_field_translator(diff):
     replaced by its human-readable version. If such a version cannot be found,
     this function does not trasnslate the field name.
 
+    This function retrieves the human-readable versions of all field names
+    using two queries, regardless of the number of field names.
+
     """
+    Configuration = backends.get('esf_configuration')
+    field_names = diff.keys()
+    value_names = dict(Configuration.objects.filter(
+        dbf_valuefield_name__in=field_names).values_list(
+        'dbf_valuefield_name', 'name'))
+    manual_names = dict(Configuration.objects.filter(
+        dbf_manualfield_name__in=field_names).values_list(
+        'dbf_manualfield_name', 'name'))
     translated_diff = {}
     for field_name, field_value in diff.items():
-        try:
-            translated_field_name = \
-                Configuration.objects.get(dbf_valuefield_name=field_name).name
-        except Configuration.DoesNotExist:
-            try:
-                translated_field_name = \
-                    Configuration.objects.get(dbf_manualfield_name=field_name).name + \
-                    ' (handmatig)'
-            except Configuration.DoesNotExist:
-                translated_field_name = field_name
+        if field_name in value_names:
+            translated_field_name = value_names[field_name]
+        elif field_name in manual_names:
+            translated_field_name = manual_names[field_name] + ' (handmatig)'
+        else:
+            translated_field_name = field_name
         translated_diff[translated_field_name] = field_value
     return translated_diff
 
@@ -45,29 +59,173 @@ def view_config_diff(request, area_name, config_type,
     logger.debug('lizard_validation.views.view_config_diff')
     logger.debug('look for ConfigurationToValidate for Area with name: %s',
                             area_name)
-    config = get_object_or_404(ConfigurationToValidate,
-        area__name=area_name, config_type=config_type)
+    instrumentation.begin('diff %s %s' % (area_name, config_type))
+    queries = len(connection.queries)
+    try:
+        with instrumentation.stage('configuration'):
+            config = get_configuration(area_name, config_type)
+        if config_type == 'waterbalans':
+            response = view_wb_config_diff(request, config)
+        else:
+            response = view_esf_config_diff(request, config, template)
+    finally:
+        instrumentation.end()
+    if settings.DEBUG:
+        # Django only records the queries in debug mode. The load test
+        # reports the number of queries from this header.
+        response['X-Query-Count'] = str(len(connection.queries) - queries)
+    return response
+
+def view_wb_config_diff(request, config,
+                        template='lizard_validation/wb_config_diff.html'):
+    try:
+        result = get_result(config)
+    except MissingFieldsError as e:
+        return view_missing_fields(request, config, e, template)
+    return render_wb_diff(request, config.area.name, config.config_type,
+                          result, template)
+
+def view_esf_config_diff(request, config,
+                         template='lizard_validation/config_diff.html'):
+    try:
+        result = get_result(config)
+    except MissingFieldsError as e:
+        return view_missing_fields(request, config, e, template)
+    return render_esf_diff(request, config.area.name, config.config_type,
+                           result, template)
 
-    if config_type == 'waterbalans':
+def render_wb_diff(request, name, config_type, result,
+                   template='lizard_validation/wb_config_diff.html'):
+    """Return the page with the given differences of a water balance."""
+    with instrumentation.stage('render'):
+        return render_to_response(
+            template,
+            { 'name': name,
+              'type': config_type,
+              'diff': result['area'],
+              'bucket_diff': result['buckets'],
+              'structure_diff': result['structures'],
+              },
+            context_instance=RequestContext(request))
 
-        diff = create_wb_area_comparer().compare(config)
-        bucket_diff = create_wb_bucket_comparer().compare(config)
-        structure_diff = create_wb_structure_comparer().compare(config)
+def render_esf_diff(request, name, config_type, result,
+                    template='lizard_validation/config_diff.html'):
+    """Return the page with the given differences of an ESF configuration."""
+    with instrumentation.stage('translation'):
+        diff = esf_field_translator(result['area'])
+    with instrumentation.stage('render'):
         return render_to_response(
-            'lizard_validation/wb_config_diff.html',
-            { 'name': config.area.name,
-              'type': config.config_type,
-              'diff': diff,
-              'bucket_diff': bucket_diff,
-              'structure_diff': structure_diff,
+            template,
+            { 'name': name,
+              'type': config_type,
+              'diff': sorted(diff.items())
               },
             context_instance=RequestContext(request))
 
-    diff = esf_field_translator(ConfigComparer().compare(config))
+def view_missing_fields(request, config, error, template):
+    """Return the page that reports the fields missing from a configuration."""
+    return render_missing_fields(request, config.area.name,
+                                 config.config_type, error.field_names,
+                                 template)
+
+def render_missing_fields(request, name, config_type, field_names, template):
     return render_to_response(
         template,
-        { 'name': config.area.name,
-          'type': config.config_type,
-          'diff': sorted(diff.items())
+        { 'name': name,
+          'type': config_type,
+          'missing_fields': field_names,
           },
         context_instance=RequestContext(request))
+
+def view_config_diff_async(request, area_name, config_type):
+    """Submit the computation of the differences and return its job as JSON.
+
+    The response has status 202 and contains the id of the job and the URL to
+    poll, see view_diff_job. When the queue of jobs is full, this view falls
+    back to view_config_diff, which computes the differences in the current
+    request.
+
+    """
+    try:
+        job_id = jobs.queue.submit(area_name, config_type)
+    except jobs.QueueFull:
+        logger.warning("job queue is full, compute the diff of '%s' (%s) "
+                       "synchronously", area_name, config_type)
+        return view_config_diff(request, area_name, config_type)
+    return job_response({'job': job_id, 'status': jobs.PENDING}, status=202)
+
+def view_diff_job(request, job_id):
+    """Return the state of the given job.
+
+    While the job is pending, this view returns its state as JSON with status
+    202. When the job has failed, it returns its state as JSON with status
+    500. When the job is done, it returns the same page as view_config_diff.
+
+    """
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise Http404
+    if job['status'] == jobs.PENDING:
+        return job_response({'job': job_id, 'status': job['status']},
+                            status=202)
+    if job['status'] == jobs.FAILED:
+        return job_response({'job': job_id, 'status': job['status'],
+                             'error': job['error']}, status=500)
+    if job['type'] == 'waterbalans':
+        template = 'lizard_validation/wb_config_diff.html'
+    else:
+        template = 'lizard_validation/config_diff.html'
+    if 'missing_fields' in job:
+        return render_missing_fields(request, job['name'], job['type'],
+                                     job['missing_fields'], template)
+    instrumentation.begin('job %s' % job_id)
+    try:
+        if job['type'] == 'waterbalans':
+            return render_wb_diff(request, job['name'], job['type'],
+                                  job['result'], template)
+        return render_esf_diff(request, job['name'], job['type'],
+                               job['result'], template)
+    finally:
+        instrumentation.end()
+
+def job_response(state, status):
+    state['url'] = reverse('diff_job', kwargs={'job_id': state['job']})
+    response = HttpResponse(json.dumps(state, sort_keys=True),
+                            mimetype='application/json')
+    response.status_code = status
+    return response
+
+def view_field_differences(request, field_name):
+    """Return the records whose value of the given field differs as JSON.
+
+    The optional GET parameters config_type and data_set restrict the query to
+    the configurations of that type and data set. The answer also lists the
+    configurations whose differences are not in the field index.
+
+    """
+    instrumentation.begin('field %s' % field_name)
+    try:
+        with instrumentation.stage('field index'):
+            differences = find_differences(field_name,
+                                           request.GET.get('config_type'),
+                                           request.GET.get('data_set'))
+    finally:
+        instrumentation.end()
+    return HttpResponse(json.dumps(differences.as_dict(), sort_keys=True),
+                        mimetype='application/json')
+
+def view_statistics(request):
+    """Return the statistics of the differences of all configurations as JSON.
+
+    The optional GET parameter config_type restricts the statistics to the
+    configurations of that type.
+
+    """
+    instrumentation.begin('statistics')
+    try:
+        with instrumentation.stage('statistics'):
+            statistics = compute_statistics(request.GET.get('config_type'))
+    finally:
+        instrumentation.end()
+    return HttpResponse(json.dumps(statistics.as_dict(), sort_keys=True),
+                        mimetype='application/json')
@@ -44,5 +44,7 @@ setup(name='lizard-validation',
       extras_require = {'test': tests_require},
       entry_points={
           'console_scripts': [
+              'validate_configurations = lizard_validation.scripts:main',
+              'load_test_diff_views = lizard_validation.loadtest:main',
           ]},
       )